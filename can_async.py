@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+asyncio adapter for ControlCAN.
+
+All driver I/O of a device runs on one dedicated thread which interleaves
+queued transmits with adaptive receive polls. Received batches and transmit
+results of a whole poll cycle are handed to the event loop with a single
+call_soon_threadsafe, so one loop can serve several adapters at full bus
+load:
+
+    async with AsyncControlCAN(dev) as bus:
+        await bus.send(0, 0x123, b"\\x01\\x02")
+        async for frame in bus.frames(1):
+            print(frame.ID, frame.Data[:frame.DataLen])
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import asyncio
+from collections import deque
+import logging
+import threading
+
+from can_receiver import AdaptiveReceiver
+
+__all__ = ["AsyncControlCAN"]
+
+log = logging.getLogger("controlcan.async")
+
+
+class AsyncControlCAN(object):
+    """
+    Async front end of an opened and started ControlCAN device.
+
+    channels: channels to receive from, frames of channels nobody iterates
+        over are drained and dropped
+    queue_size: batches buffered per subscriber before the oldest is dropped
+    Other keyword arguments are passed to AdaptiveReceiver.
+    """
+
+    def __init__(self, device, channels=(0, 1), queue_size=1000, **receiver_args):
+        self.device = device
+        self.queue_size = queue_size
+        self._receivers = [AdaptiveReceiver(device, ch, **receiver_args) for ch in channels]
+        self._min_interval = receiver_args.get("min_interval", 50e-6)
+        self._max_interval = receiver_args.get("max_interval", 500e-6)
+        self._subscribers = {ch: [] for ch in channels}
+        self._pending = deque()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._loop = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def start(self):
+        """Start the device thread, must be called from the event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"ControlCAN-{self.device.device_index}",
+                                        daemon=True)
+        self._thread.start()
+
+    async def close(self):
+        """Stop the device thread and end all frame iterators."""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            await self._loop.run_in_executor(None, self._thread.join)
+            self._thread = None
+        while self._pending:
+            self._pending.popleft()[0].cancel()
+        for queues in self._subscribers.values():
+            for q in queues:
+                q.put_nowait(None)
+
+    async def send_many(self, channel, ids, payloads, lengths=None, extended=None):
+        """Await ControlCAN.transmit_many on the device thread."""
+        fut = self._loop.create_future()
+        self._pending.append((fut, channel, (ids, payloads, lengths, extended)))
+        self._wakeup.set()
+        return await fut
+
+    async def send(self, channel, pid, data, extended=None):
+        """Send one data frame, returns the number of frames sent."""
+        return await self.send_many(channel, (pid,), (data,),
+                                    extended=None if extended is None else (extended,))
+
+    async def batches(self, channel):
+        """Iterate over the record arrays received on `channel`."""
+        q = asyncio.Queue()
+        self._subscribers[channel].append(q)
+        try:
+            while True:
+                batch = await q.get()
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            self._subscribers[channel].remove(q)
+
+    async def frames(self, channel):
+        """Iterate over the frames (numpy records) received on `channel`."""
+        async for batch in self.batches(channel):
+            for frame in batch:
+                yield frame
+
+    def _dispatch(self, batches, results):
+        for channel, batch in batches:
+            for q in self._subscribers[channel]:
+                if q.qsize() >= self.queue_size:
+                    q.get_nowait()
+                    log.warning(f"CAN{channel} subscriber too slow, batch dropped")
+                q.put_nowait(batch)
+        for fut, result, exc in results:
+            if fut.cancelled():
+                continue
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(result)
+
+    def _run(self):
+        interval = self._min_interval
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            results = []
+            while self._pending:
+                fut, channel, args = self._pending.popleft()
+                try:
+                    results.append((fut, self.device.transmit_many(channel, *args), None))
+                except Exception as e:
+                    results.append((fut, None, e))
+
+            batches = []
+            for receiver in self._receivers:
+                frames = receiver.poll()
+                if len(frames):
+                    batches.append((receiver.channel, frames.copy()))
+
+            if batches or results:
+                self._loop.call_soon_threadsafe(self._dispatch, batches, results)
+            if batches or self._pending:
+                interval = self._min_interval
+                continue
+            self._wakeup.wait(interval)
+            interval = min(interval * 2, self._max_interval)
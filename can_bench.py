@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the Python side hot paths, no hardware needed.
+
+Every case runs repeatedly for `--duration` seconds against a stub driver
+(can_sim.NullLibrary by default, which does no work, or the VCISimulator
+with `--driver sim`) and reports frames/s and p50/p99 latency per call:
+
+    python can_bench.py -o bench.json
+    python can_bench.py --compare bench.json
+
+Results are saved as JSON together with the commit and environment, so
+runs of different commits can be compared.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from ctypes import byref, cast
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from controlcan import *
+from can_capture import to_records
+from can_sim import NullLibrary, VCISimulator
+
+BATCH_SIZES = (1, 10, 100, 1000, 5000)
+
+
+def _device(driver):
+    if driver == "sim":
+        library = VCISimulator(realtime=False, fifo_size=1 << 30)
+    else:
+        library = NullLibrary(backlog=5000)
+    dev = ControlCAN(library=library)
+    dev.OpenDevice()
+    for ch in (0, 1):
+        dev.InitCAN(ch, VCI_INIT_CONFIG(baud=1000))
+        dev.StartCAN(ch)
+    return dev
+
+
+def _drain(dev, batch):
+    """Make sure `batch` frames are waiting on CAN1 of a simulated device."""
+    if isinstance(dev._l, VCISimulator) and dev.GetReceiveNum(1) < batch:
+        dev.transmit_many(0, np.arange(5000) & 0x7ff, np.zeros((5000, 8), dtype=np.uint8))
+
+
+# Every case is a factory taking (device, batch) and returning a callable
+# which processes `batch` frames per call. A `setup` attribute of the
+# callable is called before every timed call, outside the timing.
+
+def case_obj_init(dev, batch):
+    def call():
+        for i in range(batch):
+            VCI_CAN_OBJ(i, b"12345678")
+    return call
+
+
+def case_transmit_single(dev, batch):
+    objs = [VCI_CAN_OBJ(i, b"12345678") for i in range(batch)]
+    def call():
+        for obj in objs:
+            dev.Transmit(0, byref(obj), 1)
+    return call
+
+
+def case_transmit_array(dev, batch):
+    # what main.t_send used to do: build frames one by one, send once
+    def call():
+        pkts = (VCI_CAN_OBJ * batch)()
+        for i in range(batch):
+            pkts[i] = VCI_CAN_OBJ(i, b"12345678")
+        dev.Transmit(0, cast(pkts, PVCI_CAN_OBJ), batch)
+    return call
+
+
+def case_transmit_many(dev, batch):
+    ids = np.arange(batch, dtype=np.uint32) & 0x7ff
+    payloads = np.zeros((batch, 8), dtype=np.uint8)
+    def call():
+        dev.transmit_many(0, ids, payloads)
+    return call
+
+
+def case_receive_tuples(dev, batch):
+    # what main.t_recv used to do: one tuple per frame from ctypes fields
+    buf = (VCI_CAN_OBJ * batch)()
+    def call():
+        recv = dev.Receive(1, cast(buf, PVCI_CAN_OBJ), batch)
+        return [(buf[n].ID, buf[n].Data[:]) for n in range(recv)]
+    call.setup = lambda: _drain(dev, batch)
+    return call
+
+
+def case_receive_into(dev, batch):
+    buf = np.zeros(batch, dtype=VCI_CAN_OBJ_DTYPE)
+    def call():
+        return dev.receive_into(1, buf)
+    call.setup = lambda: _drain(dev, batch)
+    return call
+
+
+def case_to_records(dev, batch):
+    frames = np.zeros(batch, dtype=VCI_CAN_OBJ_DTYPE)
+    def call():
+        return to_records(frames, channel=1)
+    return call
+
+
+def case_raw_call(dev, batch):
+    # driver call without the wrapper, baseline of vci_call below
+    def call():
+        for i in range(batch):
+            dev._VCI_GetReceiveNum(dev.device_type, dev.device_index, 1)
+    return call
+
+
+def case_vci_call(dev, batch):
+    def call():
+        for i in range(batch):
+            dev.GetReceiveNum(1)
+    return call
+
+
+CASES = {
+    "obj_init": case_obj_init,
+    "transmit_single": case_transmit_single,
+    "transmit_array": case_transmit_array,
+    "transmit_many": case_transmit_many,
+    "receive_tuples": case_receive_tuples,
+    "receive_into": case_receive_into,
+    "to_records": case_to_records,
+    "raw_call": case_raw_call,
+    "vci_call": case_vci_call,
+}
+
+
+def run_case(call, batch, duration, min_calls=5):
+    latencies = []
+    setup = getattr(call, "setup", None)
+    clock = time.perf_counter_ns
+    deadline = time.perf_counter() + duration
+    while len(latencies) < min_calls or time.perf_counter() < deadline:
+        if setup is not None:
+            setup()
+        start = clock()
+        call()
+        latencies.append(clock() - start)
+    latencies = np.array(latencies) / 1e3
+    return {
+        "batch": batch,
+        "calls": len(latencies),
+        "fps": batch * len(latencies) / (latencies.sum() / 1e6),
+        "p50_us": float(np.percentile(latencies, 50)),
+        "p99_us": float(np.percentile(latencies, 99)),
+    }
+
+
+def environment(driver):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "driver": driver,
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-o", "--output", help="save results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--driver", choices=("null", "sim"), default="null")
+    parser.add_argument("--duration", type=float, default=0.2, help="seconds per case")
+    parser.add_argument("--batch", type=int, nargs="+", default=BATCH_SIZES)
+    parser.add_argument("--case", nargs="+", choices=sorted(CASES), default=list(CASES))
+    opts = parser.parse_args(args)
+
+    baseline = {}
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = {(r["case"], r["batch"]): r for r in json.load(f)["results"]}
+
+    dev = _device(opts.driver)
+    results = []
+    print(f"{'case':<16} {'batch':>6} {'frames/s':>12} {'p50 us':>10} {'p99 us':>10}"
+          + (f" {'vs base':>8}" if baseline else ""))
+    for name in opts.case:
+        for batch in opts.batch:
+            result = {"case": name, **run_case(CASES[name](dev, batch), batch, opts.duration)}
+            results.append(result)
+            line = (f"{name:<16} {batch:>6} {result['fps']:>12.0f} "
+                    f"{result['p50_us']:>10.2f} {result['p99_us']:>10.2f}")
+            base = baseline.get((name, batch))
+            if base:
+                line += f" {result['fps'] / base['fps']:>7.2f}x"
+            print(line)
+    dev.CloseDevice()
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump({"environment": environment(opts.driver), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Declarative device bring-up and supervision.
+
+A `DeviceSetup` describes the wanted state of a device (channels, bitrate,
+acceptance filter, mode) and applies it with readiness polling instead of
+fixed sleeps: every step is retried with a short exponential backoff until
+it succeeds, and a channel counts as up once VCI_ReadCANStatus shows its
+controller out of reset mode.
+
+    setup = bring_up(dev, channels=(0, 1), baud=500)
+
+A `DeviceSupervisor` watches the device: any call returning
+VCI_RET_NODEVICE (through ControlCAN.on_nodevice) or a failed periodic
+health check starts a reconnect loop with exponential backoff which
+re-applies the setup. Readers wait on `supervisor.ready` while the device
+is gone and resume once it is back; recovery times are kept in a
+histogram.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import logging
+import threading
+import time
+
+from controlcan import CANError, VCI_INIT_CONFIG, VCI_CAN_STATUS, VCI_RET_OK, VCI_RET_FAIL
+from can_metrics import Histogram
+
+__all__ = ["ChannelSetup", "DeviceSetup", "DeviceSupervisor", "bring_up"]
+
+log = logging.getLogger("controlcan.bringup")
+
+RECOVERY_BUCKETS = (1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _poll(check, timeout, first=0.001, longest=0.05):
+    """Call `check` with exponential backoff until it returns True or `timeout` elapses."""
+    deadline = time.monotonic() + timeout
+    delay = first
+    while True:
+        if check():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, longest)
+
+
+def channel_running(device, channel):
+    """
+    Channel started and reachable. Drivers not implementing
+    VCI_ReadCANStatus are trusted once StartCAN succeeded.
+    """
+    status = VCI_CAN_STATUS()
+    ret = device.ReadCANStatus(channel, status, mute=True)
+    if ret == VCI_RET_OK:
+        return not status.in_reset
+    return ret == VCI_RET_FAIL
+
+
+class ChannelSetup(object):
+    """
+    Wanted configuration of one channel.
+
+    baud: bitrate in kbit/s, see VCI_INIT_CONFIG.TIMING_REGS
+    frame_filter: optional can_filter.AcceptanceFilter compiled into the
+        device acceptance filter
+    config: explicit VCI_INIT_CONFIG, overrides the other arguments
+    Other keyword arguments are passed to VCI_INIT_CONFIG.
+    """
+
+    def __init__(self, channel, baud=500, frame_filter=None, config=None, **config_args):
+        self.channel = channel
+        self.frame_filter = frame_filter
+        if config is None:
+            if frame_filter is not None:
+                config = frame_filter.init_config(baud=baud, **config_args)
+            else:
+                config = VCI_INIT_CONFIG(baud=baud, **config_args)
+        self.config = config
+
+
+class DeviceSetup(object):
+    """
+    Wanted state of a device: opened, with `channels` initialized and
+    started. `channels` items are channel numbers, configured from the
+    other arguments, or ChannelSetup instances.
+
+    timeout: max time each bring-up step may take, in seconds
+    """
+
+    def __init__(self, channels=(0, 1), baud=500, frame_filter=None, timeout=2.0, **config_args):
+        self.channels = [c if isinstance(c, ChannelSetup) else ChannelSetup(c, baud, frame_filter, **config_args)
+                         for c in channels]
+        self.timeout = timeout
+        self.duration = None
+
+    def apply(self, device, open_timeout=None):
+        """
+        Open the device and bring every channel up. `open_timeout` bounds
+        the OpenDevice retries (default: `timeout`, 0 for a single try).
+        Raises CANError when a step does not succeed in time, returns the
+        bring-up duration in seconds.
+        """
+        start = time.perf_counter()
+        open_timeout = self.timeout if open_timeout is None else open_timeout
+
+        def open_device():
+            if device.OpenDevice(mute=True) == VCI_RET_OK:
+                return True
+            device.CloseDevice(mute=True)
+            return False
+
+        if not _poll(open_device, open_timeout):
+            raise CANError(f"device {device.device_index} did not open", device)
+        for ch in self.channels:
+            if not _poll(lambda: device.InitCAN(ch.channel, ch.config, mute=True) == VCI_RET_OK, self.timeout):
+                raise CANError(f"CAN{ch.channel} init failed", device)
+            if not _poll(lambda: device.StartCAN(ch.channel, mute=True) == VCI_RET_OK, self.timeout):
+                raise CANError(f"CAN{ch.channel} start failed", device)
+        for ch in self.channels:
+            if not _poll(lambda: channel_running(device, ch.channel), self.timeout):
+                raise CANError(f"CAN{ch.channel} not running after start", device)
+        self.duration = time.perf_counter() - start
+        log.info(f"device {device.device_index} CAN{[ch.channel for ch in self.channels]} "
+                 f"up in {self.duration * 1e3:.1f} ms")
+        return self.duration
+
+
+def bring_up(device, channels=(0, 1), baud=500, frame_filter=None, timeout=2.0, **config_args):
+    """Build a DeviceSetup, apply it to `device` and return it."""
+    setup = DeviceSetup(channels, baud, frame_filter, timeout, **config_args)
+    setup.apply(device)
+    return setup
+
+
+class DeviceSupervisor(object):
+    """
+    Reconnects `device` with `setup` whenever it disappears.
+
+    min_backoff, max_backoff: bounds of the delay between reconnect
+        attempts, in seconds
+    check_interval: period of the health check, which catches a lost
+        device while nobody calls the driver
+    on_down, on_up: lists of callables called (from the supervisor thread)
+        when the device is lost and when it is back up
+
+    `ready` is set while the device is usable; readers should wait on it
+    instead of polling a missing device.
+    """
+
+    def __init__(self, device, setup, min_backoff=0.005, max_backoff=2.0, check_interval=0.1):
+        self.device = device
+        self.setup = setup
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.check_interval = check_interval
+        self.on_down = []
+        self.on_up = []
+        self.ready = threading.Event()
+        self._lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.disconnects = 0
+        self.attempts = 0
+        self.last_recovery = None
+        self.recovery = Histogram(RECOVERY_BUCKETS)
+
+    def start(self, bring_up=True):
+        """Apply the setup (unless the device is already up) and start supervising."""
+        if bring_up:
+            self.setup.apply(self.device)
+        self.ready.set()
+        self.device.on_nodevice = self._notify
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"DeviceSupervisor-{self.device.device_index}",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._lost.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.device.on_nodevice = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def stats(self):
+        """Reconnect counters, recovery times in seconds."""
+        return {
+            "ready": self.ready.is_set(),
+            "disconnects": self.disconnects,
+            "attempts": self.attempts,
+            "last_recovery": self.last_recovery,
+            "recovery": self.recovery.snapshot(),
+        }
+
+    def _notify(self, device):
+        self._lost.set()
+
+    def _run(self):
+        channel = self.setup.channels[0].channel
+        while not self._stop.is_set():
+            # a call returning VCI_RET_NODEVICE sets _lost, the probe
+            # below does so as well when nobody else calls the driver
+            if not self._lost.wait(self.check_interval):
+                self.device.GetReceiveNum(channel, mute=True)
+            if self._stop.is_set():
+                break
+            if self._lost.is_set():
+                self._lost.clear()
+                self._recover()
+
+    def _recover(self):
+        start = time.perf_counter()
+        self.ready.clear()
+        self.disconnects += 1
+        log.warning(f"device {self.device.device_index} lost, reconnecting")
+        for callback in self.on_down:
+            callback()
+
+        delay = self.min_backoff
+        while not self._stop.is_set():
+            self.attempts += 1
+            self.device.CloseDevice(mute=True)
+            try:
+                self.setup.apply(self.device, open_timeout=0)
+                break
+            except CANError as e:
+                log.debug(f"reconnect attempt failed: {e}")
+            self._stop.wait(delay)
+            delay = min(delay * 2, self.max_backoff)
+        else:
+            return
+
+        self.last_recovery = time.perf_counter() - start
+        self.recovery.observe(self.last_recovery)
+        self._lost.clear()
+        self.ready.set()
+        log.warning(f"device {self.device.device_index} recovered in {self.last_recovery * 1e3:.1f} ms")
+        for callback in self.on_up:
+            callback()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Frame timing model, bus load and transmit pacing.
+
+`frame_bits()` computes the exact on-wire length of classical CAN frames,
+stuff bits included, for whole batches at once: the bit stream of every
+frame (SOF up to the CRC) is built as a 128 bit integer, the CRC-15 is
+looked up byte by byte (it is linear, byte contributions XOR up) and the
+stuff bits are counted a byte at a time through a state table. Stuffing
+depends on the ID and payload, a frame of 8 bytes is 111 to 135 bits long
+with a standard ID, 131 to 160 with an extended one (interframe space
+included).
+
+On top of it:
+
+- `BusLoadMeter` is the share of the bus time used by the frames it is fed
+  over a sliding window; MeteredControlCAN keeps one per channel.
+- `TransmitLimiter` is a token bucket pacing batched transmits to a bus
+  load ceiling, so the device TX FIFO never overflows:
+
+    limiter = TransmitLimiter(dev, 0, max_load=0.8)
+    limiter.transmit_many(ids, payloads)
+
+The bitrate defaults to the one the channel was initialized with, decoded
+from the VCI_INIT_CONFIG timing registers.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+from controlcan import PVCI_CAN_OBJ, VCI_RET_NODEVICE
+
+__all__ = ["frame_bits", "BusLoadMeter", "TransmitLimiter"]
+
+log = logging.getLogger("controlcan.busload")
+
+CRC15_POLY = 0x4599
+# CRC delimiter, ACK slot, ACK delimiter, end of frame, intermission
+_TAIL_BITS = 13
+_HEADER_BITS = np.array([19, 39])
+# top `8 * n` bits of a big endian payload word
+_DATA_MASK = np.array([((1 << (8 * n)) - 1) << (64 - 8 * n) for n in range(9)], dtype=np.uint64)
+_U = np.uint64
+
+
+def _crc_tables():
+    """
+    CRC-15 of every byte value at each of the 13 byte positions of a right
+    aligned 104 bit message; the CRC is linear, a message's CRC is the XOR
+    of the entries of its bytes.
+    """
+    rows = np.zeros(104, dtype=np.int64)
+    crc = CRC15_POLY
+    for i in range(103, -1, -1):
+        rows[i] = crc
+        crc = ((crc << 1) & 0x7fff) ^ (CRC15_POLY if crc & 0x4000 else 0)
+    bits = (np.arange(256)[:, None] >> np.arange(7, -1, -1)) & 1
+    tables = np.zeros((13, 256), dtype=np.int64)
+    for k in range(13):
+        for j in range(8):
+            tables[k] ^= bits[:, j] * rows[8 * k + j]
+    return tables
+
+
+def _stuff_tables():
+    """
+    Stuffing state machine over bytes. States 0-7 are the last bit * 4 +
+    run length - 1, state 8 is the start of the frame. Returns the state
+    (times 256 * 9) and the stuff bit count after the first k (0..8) bits
+    of a byte, both indexed by (state * 256 + byte) * 9 + k.
+    """
+    state = np.repeat(np.arange(9), 256)
+    byte = np.tile(np.arange(256), 9)
+    states = np.empty((9 * 256, 9), dtype=np.int64)
+    stuffs = np.zeros((9 * 256, 9), dtype=np.int64)
+    states[:, 0] = state
+    for k in range(8):
+        bit = (byte >> (7 - k)) & 1
+        run = np.where((state < 8) & (state // 4 == bit), state % 4 + 2, 1)
+        # after five equal bits comes a complement bit, which starts the next run
+        five = run == 5
+        state = np.where(five, (1 - bit) * 4, bit * 4 + run - 1)
+        states[:, k + 1] = state
+        stuffs[:, k + 1] = stuffs[:, k] + five
+    return states.reshape(-1) * (256 * 9), stuffs.reshape(-1)
+
+
+_CRC = _crc_tables()
+_STUFF_STATE, _STUFF_COUNT = _stuff_tables()
+
+
+def frame_bits(frames, stuffing=True):
+    """
+    On-wire length in bits of every frame of `frames` (VCI_CAN_OBJ_DTYPE or
+    capture records), from the start of frame to the end of the 3 bit
+    interframe space. Without `stuffing`, the nominal length without stuff
+    bits.
+    """
+    n = len(frames)
+    ext = frames["ExternFlag"].astype(bool)
+    remote = frames["RemoteFlag"].astype(bool)
+    dlc = frames["DataLen"].astype(np.int64) & 0xf
+    nbytes = np.where(remote, 0, np.minimum(dlc, 8))
+    size = _HEADER_BITS[ext.astype(np.intp)] + 8 * nbytes + 15
+    if not stuffing or not n:
+        return size + _TAIL_BITS
+
+    # the bit streams are handled as 128 bit (hi, lo) integers, shifts by
+    # 64 bits or more give 0
+    pid = frames["ID"].astype(_U)
+    tail = remote.astype(_U) << _U(6) | dlc.astype(_U)
+    header = np.where(ext,
+                      (pid >> _U(18) & _U(0x7ff)) << _U(27) | _U(3 << 25) | (pid & _U(0x3ffff)) << _U(7) | tail,
+                      (pid & _U(0x7ff)) << _U(7) | tail)
+    data = np.ascontiguousarray(frames["Data"]).view(">u8")[:, 0] & _DATA_MASK[nbytes]
+    shift = (8 * nbytes).astype(_U)
+    # message up to the CRC, right aligned (the SOF is a leading zero)
+    hi = header >> (_U(64) - shift)
+    lo = data >> (_U(64) - shift) | header << shift
+    message = np.stack([hi, lo], axis=1).astype(">u8").view(np.uint8)[:, 3:]
+    # leading zeros do not change a CRC with zero initial value
+    crc = np.bitwise_xor.reduce(_CRC[np.arange(13), message], axis=1).astype(_U)
+
+    # SOF to CRC, left aligned
+    hi, lo = hi << _U(15) | lo >> _U(49), lo << _U(15) | crc
+    shift = 128 - size
+    hi = hi << shift.astype(_U) | lo >> (64 - shift).astype(_U) | lo << (shift - 64).astype(_U)
+    lo = lo << shift.astype(_U)
+    stream = np.stack([hi, lo], axis=1).astype(">u8").view(np.uint8)
+
+    chunks = (int(size.max()) + 7) // 8
+    index = stream[:, :chunks].astype(np.int64) * 9 + np.clip(size[:, None] - 8 * np.arange(chunks), 0, 8)
+    state = np.full(n, 8 * 256 * 9, dtype=np.int64)
+    stuff = np.zeros(n, dtype=np.int64)
+    for k in range(chunks):
+        i = state + index[:, k]
+        stuff += _STUFF_COUNT[i]
+        state = _STUFF_STATE[i]
+    return size + stuff + _TAIL_BITS
+
+
+class BusLoadMeter(object):
+    """
+    Share of the bus time used by the frames added over the last `window`
+    seconds, counted in `slots` steps.
+    """
+
+    def __init__(self, bitrate, window=1.0, slots=10, clock=time.perf_counter):
+        self.bitrate = bitrate
+        self.window = window
+        self.clock = clock
+        self._slot_time = window / slots
+        self._bits = np.zeros(slots, dtype=np.int64)
+        self._start = clock()
+        self._slot = int(self._start / self._slot_time)
+        self.frames = 0
+        self.bits = 0
+
+    def _advance(self, now):
+        slot = int(now / self._slot_time)
+        if slot != self._slot:
+            stale = min(slot - self._slot, len(self._bits))
+            self._bits[(self._slot + 1 + np.arange(stale)) % len(self._bits)] = 0
+            self._slot = slot
+        return slot
+
+    def add(self, frames):
+        """Count a batch of frames (VCI_CAN_OBJ_DTYPE or capture records)."""
+        if len(frames):
+            self.add_bits(int(frame_bits(frames).sum()), len(frames))
+
+    def add_bits(self, bits, frames=0):
+        slot = self._advance(self.clock())
+        self._bits[slot % len(self._bits)] += bits
+        self.frames += frames
+        self.bits += bits
+
+    @property
+    def load(self):
+        """Bus load over the window as a fraction, 1.0 is a saturated bus."""
+        now = self.clock()
+        slot = self._advance(now)
+        # the current slot is only partly elapsed
+        elapsed = min((len(self._bits) - 1) * self._slot_time + now - slot * self._slot_time,
+                      now - self._start)
+        if elapsed <= 0:
+            return 0.0
+        return float(self._bits.sum()) / (self.bitrate * elapsed)
+
+
+class TransmitLimiter(object):
+    """
+    Token bucket pacing the transmits of one channel to `max_load` of the
+    bus. Tokens are bits, the bucket fills at `max_load * bitrate` bit/s
+    and holds `burst` seconds of it: a batch is handed to the driver as
+    far as the tokens go, the rest waits for the bucket to refill. Only
+    the traffic of this limiter counts, leave room for the other nodes.
+
+    bitrate: bus bitrate in bit/s, defaults to the one `channel` was
+        initialized with
+    burst: bucket size in seconds, keep it below the time the device TX
+        buffer takes to drain
+    min_batch: smallest batch handed to the driver while pacing, in
+        seconds of bus time (fewer, bigger Transmit calls)
+    timeout: how long frames the driver refuses are retried, in seconds
+    """
+
+    def __init__(self, device, channel, max_load=0.9, bitrate=None, burst=0.01, min_batch=0.001,
+                 timeout=1.0, clock=time.perf_counter, sleep=time.sleep):
+        if bitrate is None:
+            bitrate = device.bitrates.get(channel)
+            if bitrate is None:
+                raise ValueError(f"CAN{channel} not initialized, pass its bitrate")
+        self.device = device
+        self.channel = channel
+        self.bitrate = bitrate
+        self.max_load = max_load
+        self.rate = bitrate * max_load
+        # at least the longest frame, or it would never pass
+        self.capacity = max(self.rate * burst, 160)
+        # a min_batch above the bucket could never be waited for
+        self._batch_bits = min(self.rate * min_batch, self.capacity)
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self._refilled = clock()
+        self._lock = threading.Lock()
+
+        self.frames = 0
+        self.bits = 0
+        self.calls = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.refused = 0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.tokens + (now - self._refilled) * self.rate, self.capacity)
+        self._refilled = now
+
+    def _wait(self, seconds):
+        seconds = float(seconds)
+        self.waits += 1
+        self.wait_time += seconds
+        self.sleep(seconds)
+
+    def transmit(self, frames, mute=True):
+        """
+        Send a contiguous VCI_CAN_OBJ_DTYPE array, blocking until it passed
+        the bucket. Returns the number of frames the driver accepted, less
+        than the batch only when it refused frames for `timeout` seconds or
+        the device is gone.
+        """
+        count = len(frames)
+        if not count:
+            return 0
+        total = np.cumsum(frame_bits(frames))
+        with self._lock:
+            sent = 0
+            spent = 0
+            refused_since = None
+            while sent < count:
+                self._refill()
+                # tokens for a min_batch worth of frames, or the rest of the batch
+                need = min(max(self._batch_bits, total[sent] - spent), total[-1] - spent)
+                if self.tokens < need:
+                    self._wait((need - self.tokens) / self.rate)
+                    continue
+                n = int(np.searchsorted(total, spent + self.tokens, side="right")) - sent
+                ret = self.device.Transmit(self.channel, frames[sent:sent + n].ctypes.data_as(PVCI_CAN_OBJ),
+                                           n, mute=mute)
+                self.calls += 1
+                if ret == VCI_RET_NODEVICE:
+                    break
+                if ret <= 0:
+                    # TX buffer full: the bus is busier than the ceiling allows
+                    now = self.clock()
+                    if refused_since is None:
+                        refused_since = now
+                        self.refused += 1
+                    elif now - refused_since >= self.timeout:
+                        log.warning(f"CAN{self.channel} transmit refused for {self.timeout} s, "
+                                    f"{count - sent} frames not sent")
+                        break
+                    self._wait((total[sent] - spent) / self.rate)
+                    continue
+                refused_since = None
+                bits = int(total[sent + ret - 1]) - spent
+                self.tokens -= bits
+                spent += bits
+                sent += ret
+            self.frames += sent
+            self.bits += spent
+        return sent
+
+    def transmit_many(self, ids, payloads, lengths=None, extended=None, mute=True):
+        """Like ControlCAN.transmit_many(), paced."""
+        return self.transmit(self.device.tx_frames(self.channel, ids, payloads, lengths, extended), mute)
+
+    def stats(self):
+        return {
+            "bitrate": self.bitrate,
+            "max_load": self.max_load,
+            "frames": self.frames,
+            "bits": self.bits,
+            "calls": self.calls,
+            "waits": self.waits,
+            "wait_time": self.wait_time,
+            "refused": self.refused,
+        }
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Last-value cache of received frames.
+
+A `LastValueCache` keeps, per CAN ID of one channel, the latest payload,
+DLC and time, the frame count and the observed mean period. It is updated
+batch by batch from the receive thread with vectorized numpy code, lookups
+are O(1) and readers in other threads get consistent values without
+locking (the single writer bumps a sequence counter around every update,
+readers retry when it moved).
+
+Subscriptions deliver only the frames whose payload or DLC changed, plus
+an unchanged frame whenever an ID was not delivered for `timeout` seconds,
+which turns mostly cyclic traffic into a trickle:
+
+    cache = LastValueCache(0)
+    cache.subscribe(handle_changes, timeout=1.0)
+    AdaptiveReceiver(dev, 0).run(cache.update, stop)
+
+    cache.get(0x123).data
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from collections import namedtuple
+
+import numpy as np
+
+__all__ = ["LastValueCache", "LastValue", "Subscription"]
+
+# payload bytes beyond DataLen are ignored by change detection
+_DLC_MASK = np.array([(1 << (8 * n)) - 1 for n in range(8)] + [(1 << 64) - 1], dtype=np.uint64)
+
+LastValue = namedtuple("LastValue", "id data dlc time count period")
+
+
+def _key(pid, extended):
+    return pid | int(extended) << 32
+
+
+def _payload_keys(frames):
+    """Payload of every frame as one uint64, masked to its DataLen."""
+    data = np.ascontiguousarray(frames["Data"]).view("<u8")[:, 0]
+    return data & _DLC_MASK[np.minimum(frames["DataLen"], 8)]
+
+
+class _Table(object):
+    """Per-slot arrays; replaced as a whole when the cache grows."""
+
+    def __init__(self, capacity, old=None):
+        self.ids = np.zeros(capacity, dtype=np.uint32)
+        self.extended = np.zeros(capacity, dtype=np.uint8)
+        self.data = np.zeros((capacity, 8), dtype=np.uint8)
+        self.dlc = np.zeros(capacity, dtype=np.uint8)
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.first = np.zeros(capacity, dtype=np.float64)
+        self.count = np.zeros(capacity, dtype=np.int64)
+        if old is not None:
+            n = len(old.ids)
+            for name in ("ids", "extended", "data", "dlc", "keys", "time", "first", "count"):
+                getattr(self, name)[:n] = getattr(old, name)
+
+
+class Subscription(object):
+    """
+    On-change subscription, see LastValueCache.subscribe(). Keeps the time
+    each ID was last delivered.
+    """
+
+    def __init__(self, callback, timeout=None, ids=None):
+        self.callback = callback
+        self.timeout = timeout
+        self.ids = None if ids is None else np.unique(np.asarray(ids, dtype=np.uint32))
+        self.delivered_at = np.full(0, -np.inf)
+        self.frames = 0
+        self.delivered = 0
+
+    def _select(self, slots, slot_ids, times, starts, changed, group):
+        """Mask of the frames (sorted by slot, then time) to deliver."""
+        if len(self.delivered_at) < slots.max() + 1:
+            grown = np.full(max(slots.max() + 1, 2 * len(self.delivered_at)), -np.inf)
+            grown[:len(self.delivered_at)] = self.delivered_at
+            self.delivered_at = grown
+        deliver = changed.copy()
+        if self.timeout is not None:
+            index = np.arange(len(slots))
+            seed = self.delivered_at[slots]
+            while True:
+                # time of the last delivery before each frame of its ID
+                last = np.maximum.accumulate(np.where(deliver, index, -1))
+                ref = np.where(last >= starts[group], times[np.maximum(last, 0)], seed)
+                due = ~deliver & (times - ref >= self.timeout)
+                if not due.any():
+                    break
+                # only the first due frame of each ID, later ones depend on it
+                pos = np.flatnonzero(due)
+                first = np.ones(len(pos), dtype=bool)
+                first[1:] = group[pos[1:]] != group[pos[:-1]]
+                deliver[pos[first]] = True
+        if self.ids is not None:
+            deliver &= np.isin(slot_ids, self.ids)
+        return deliver
+
+
+class LastValueCache(object):
+    """
+    Last value of every ID of `channel`; standard and extended frames with
+    the same numeric ID are kept apart.
+
+    capacity: initial number of ID slots, grown as new IDs appear
+    """
+
+    def __init__(self, channel=0, capacity=256):
+        self.channel = channel
+        self._table = _Table(capacity)
+        self._slots = {}
+        self._seq = 0
+        self.subscriptions = []
+        self.frames = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, pid):
+        return _key(pid, pid > 0x7ff) in self._slots
+
+    def subscribe(self, callback, timeout=None, ids=None):
+        """
+        Call `callback(frames)` from the updating thread with the frames of
+        every update whose payload or DLC changed, or whose ID was not
+        delivered for `timeout` seconds. The first frame of an ID always
+        counts as changed.
+
+        ids: only deliver these IDs
+        Returns the Subscription, pass it to unsubscribe().
+        """
+        sub = Subscription(callback, timeout, ids)
+        self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        self.subscriptions.remove(sub)
+
+    def update(self, frames, times=None):
+        """
+        Add a batch of received frames: driver frames (VCI_CAN_OBJ_DTYPE)
+        or capture records. `times` defaults to the records' host_time, or
+        to the driver TimeStamp in seconds.
+        """
+        n = len(frames)
+        if not n:
+            return
+        names = frames.dtype.names
+        if times is None:
+            times = frames["host_time"] if "host_time" in names else frames["TimeStamp"] * 1e-4
+        times = np.broadcast_to(np.asarray(times, dtype=np.float64), (n,))
+        ids = frames["ID"]
+
+        # slot of every frame, allocating slots of new (ID, ExternFlag) keys
+        keys = ids.astype(np.int64) | (frames["ExternFlag"] != 0).astype(np.int64) << 32
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        uniq_slots = np.empty(len(uniq), dtype=np.int64)
+        new = []
+        for i, key in enumerate(uniq.tolist()):
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = len(self._slots) + len(new)
+                new.append((key, slot))
+            uniq_slots[i] = slot
+        slots = uniq_slots[inverse]
+
+        # frames grouped by slot, in arrival order within a group
+        order = np.argsort(slots, kind="stable")
+        slots = slots[order]
+        times = times[order]
+        keys = _payload_keys(frames)[order]
+        dlc = frames["DataLen"][order]
+        starts = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1]])
+        ends = np.r_[starts[1:], n]
+        group = np.repeat(np.arange(len(starts)), ends - starts)
+        group_slots = slots[starts]
+        last = order[ends - 1]
+
+        table = self._table
+        total = len(self._slots) + len(new)
+        if total > len(table.ids):
+            table = _Table(max(total, 2 * len(table.ids)), table)
+        is_new = np.zeros(len(starts), dtype=bool)
+        if new:
+            is_new = np.isin(group_slots, [slot for _, slot in new])
+
+        changed = np.ones(n, dtype=bool)
+        changed[1:] = (keys[1:] != keys[:-1]) | (dlc[1:] != dlc[:-1])
+        # first frame of a known ID compares against the cached value
+        changed[starts] = is_new | (keys[starts] != table.keys[group_slots]) | (dlc[starts] != table.dlc[group_slots])
+
+        # write under the sequence counter, readers retry while it is odd
+        self._seq += 1
+        if table is not self._table:
+            self._table = table
+        for key, slot in new:
+            table.ids[slot] = key & 0xffffffff
+            table.extended[slot] = key >> 32
+            table.first[slot] = times[starts[np.searchsorted(group_slots, slot)]]
+            self._slots[key] = slot
+        table.data[group_slots] = frames["Data"][last]
+        table.dlc[group_slots] = dlc[ends - 1]
+        table.keys[group_slots] = keys[ends - 1]
+        table.time[group_slots] = times[ends - 1]
+        table.count[group_slots] += ends - starts
+        self._seq += 1
+        self.frames += n
+
+        slot_ids = ids[order]
+        for sub in self.subscriptions:
+            deliver = sub._select(slots, slot_ids, times, starts, changed, group)
+            sub.frames += n
+            if not deliver.any():
+                continue
+            pos = np.flatnonzero(deliver)
+            sub.delivered_at[slots[pos]] = times[pos]
+            delivered = frames[np.sort(order[pos])]
+            sub.delivered += len(delivered)
+            sub.callback(delivered)
+
+    def get(self, pid, extended=None):
+        """
+        Last value of `pid` as a LastValue, None if never received.
+        `extended` defaults to ID > 0x7ff.
+        """
+        key = _key(pid, pid > 0x7ff if extended is None else extended)
+        while True:
+            seq = self._seq
+            slot = self._slots.get(key)
+            if slot is None:
+                return None
+            table = self._table
+            count = int(table.count[slot])
+            t = float(table.time[slot])
+            value = LastValue(pid, bytes(table.data[slot, :table.dlc[slot]]), int(table.dlc[slot]), t, count,
+                              (t - table.first[slot]) / (count - 1) if count > 1 else None)
+            if seq == self._seq and not seq & 1:
+                return value
+
+    def snapshot(self):
+        """
+        Consistent copy of the whole cache as a dict of arrays: ID,
+        ExternFlag, Data, DataLen, time, count and period (NaN until an ID
+        was seen twice).
+        """
+        while True:
+            seq = self._seq
+            table = self._table
+            n = len(self._slots)
+            snap = {
+                "ID": table.ids[:n].copy(),
+                "ExternFlag": table.extended[:n].copy(),
+                "Data": table.data[:n].copy(),
+                "DataLen": table.dlc[:n].copy(),
+                "time": table.time[:n].copy(),
+                "count": table.count[:n].copy(),
+                "first": table.first[:n].copy(),
+            }
+            if seq == self._seq and not seq & 1:
+                break
+        first = snap.pop("first")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            snap["period"] = np.where(snap["count"] > 1, (snap["time"] - first) / (snap["count"] - 1), np.nan)
+        return snap
+
+    @property
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "ids": len(self._slots),
+            "subscriptions": [{"frames": s.frames, "delivered": s.delivered,
+                               "ratio": s.delivered / s.frames if s.frames else 0.0}
+                              for s in self.subscriptions],
+        }
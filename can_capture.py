@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Binary capture file format for received frames.
+
+A capture is a 64 byte header followed by fixed size 40 byte records:
+
+    offset  size  field
+    0       8     host_time   float64, host wall clock at reception (s)
+    8       24    VCI_CAN_OBJ ID .. Reserved, as returned by the driver
+    32      1     channel
+    33      1     device
+    34      2     frame_flags CAPTURE_FLAG_*
+    36      4     reserved
+
+Files are appended to batch by batch while recording, and opened without
+loading them with `open_capture()`, which memory-maps the records as a numpy
+record array: slicing and field access never copy the file.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import os
+import struct
+import time
+
+import numpy as np
+
+from controlcan import VCI_CAN_OBJ, VCI_CAN_OBJ_DTYPE
+
+__all__ = [
+    "CAPTURE_DTYPE", "CAPTURE_FLAG_TX",
+    "CaptureWriter", "open_capture", "to_records",
+]
+
+CAPTURE_MAGIC = b"VCICAP\x00\x01"
+CAPTURE_VERSION = 1
+CAPTURE_FLAG_TX = 0x0001
+
+_HEADER = struct.Struct("<8sHHIdI36x")
+HEADER_SIZE = _HEADER.size
+
+_FRAME_OFFSET = 8
+_frame_fields = [name for name, _ in VCI_CAN_OBJ._fields_]
+
+CAPTURE_DTYPE = np.dtype({
+    "names": ["host_time"] + _frame_fields + ["channel", "device", "frame_flags"],
+    "formats": ["<f8"] + [VCI_CAN_OBJ_DTYPE.fields[name][0] for name in _frame_fields]
+               + ["u1", "u1", "<u2"],
+    "offsets": [0] + [_FRAME_OFFSET + getattr(VCI_CAN_OBJ, name).offset for name in _frame_fields]
+               + [32, 33, 34],
+    "itemsize": 40,
+})
+
+# the raw VCI_CAN_OBJ part of a record, to copy driver frames in one go
+_FRAME_VIEW = np.dtype({
+    "names": ["frame"],
+    "formats": [VCI_CAN_OBJ_DTYPE],
+    "offsets": [_FRAME_OFFSET],
+    "itemsize": CAPTURE_DTYPE.itemsize,
+})
+
+
+def to_records(frames, channel=0, device=0, host_time=None, flags=0):
+    """
+    Convert a VCI_CAN_OBJ_DTYPE array (e.g. from ControlCAN.receive_into)
+    into capture records. `host_time` defaults to the current time.
+    """
+    records = np.zeros(len(frames), dtype=CAPTURE_DTYPE)
+    records.view(_FRAME_VIEW)["frame"] = frames
+    records["host_time"] = time.time() if host_time is None else host_time
+    records["channel"] = channel
+    records["device"] = device
+    records["frame_flags"] = flags
+    return records.view(np.recarray)
+
+
+class CaptureWriter(object):
+    """
+    Append-only capture file writer.
+
+    An existing capture is appended to, a trailing partial record left by
+    an interrupted recording is discarded first. With `append=False` it is
+    replaced instead.
+    """
+
+    def __init__(self, filename, flush=True, append=True):
+        self.filename = filename
+        self.flush = flush
+        self.count = 0
+        if append and os.path.exists(filename) and os.path.getsize(filename) > 0:
+            self._f = open(filename, "r+b")
+            _read_header(self._f)
+            size = os.path.getsize(filename) - HEADER_SIZE
+            self.count = size // CAPTURE_DTYPE.itemsize
+            self._f.truncate(HEADER_SIZE + self.count * CAPTURE_DTYPE.itemsize)
+            self._f.seek(0, os.SEEK_END)
+        else:
+            self._f = open(filename, "wb")
+            self._f.write(_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, CAPTURE_DTYPE.itemsize,
+                                       HEADER_SIZE, time.time(), 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, frames, channel=0, device=0, host_time=None, flags=0):
+        """Append a batch of driver frames."""
+        self.write_records(to_records(frames, channel, device, host_time, flags))
+
+    def write_records(self, records):
+        """Append capture records (CAPTURE_DTYPE)."""
+        self._f.write(np.ascontiguousarray(records, dtype=CAPTURE_DTYPE).data)
+        self.count += len(records)
+        if self.flush:
+            self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+def _read_header(f):
+    magic, version, record_size, header_size, start_time, _ = _HEADER.unpack(f.read(HEADER_SIZE))
+    if magic != CAPTURE_MAGIC:
+        raise ValueError(f"{f.name} is not a capture file")
+    if version != CAPTURE_VERSION or record_size != CAPTURE_DTYPE.itemsize:
+        raise ValueError(f"unsupported capture version {version} (record size {record_size})")
+    return start_time
+
+
+def open_capture(filename):
+    """
+    Memory-map a capture file, returns a read-only record array. Records
+    being appended by a writer become visible by opening the file again.
+    """
+    with open(filename, "rb") as f:
+        _read_header(f)
+    count = (os.path.getsize(filename) - HEADER_SIZE) // CAPTURE_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=CAPTURE_DTYPE).view(np.recarray)
+    return np.memmap(filename, dtype=CAPTURE_DTYPE, mode="r",
+                     offset=HEADER_SIZE, shape=(count,)).view(np.recarray)
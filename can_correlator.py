@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Request/response correlation over one receive loop.
+
+A `Correlator` thread owns the receive loop of a channel: requests queued
+from any thread are sent in batches, and every received frame is matched
+against the outstanding requests by response ID and an optional payload
+predicate, so any number of requests can be in flight without a poll loop
+each:
+
+    with Correlator(dev, 0) as corr:
+        response = corr.request(0x7e0, b"\\x02\\x01\\x0c", 0x7e8, match=b"\\x04\\x41\\x0c")
+        futures = [corr.submit(0x7e0, req, 0x7e8) for req in requests]
+        response = await corr.arequest(0x7e0, b"\\x02\\x01\\x0d", 0x7e8)
+
+Requests waiting for the same response ID are served oldest first. Frames
+answering no request are passed to `on_frame`, so other consumers can
+share the loop.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import asyncio
+from collections import deque, namedtuple
+from concurrent.futures import Future, InvalidStateError
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+
+from can_receiver import AdaptiveReceiver
+
+__all__ = ["Correlator", "Response"]
+
+log = logging.getLogger("controlcan.correlator")
+
+Response = namedtuple("Response", "id data time rtt")
+
+
+class _Request(object):
+    def __init__(self, pid, data, extended, key, match, submitted, deadline):
+        self.pid = pid
+        self.data = data
+        self.extended = extended
+        self.key = key
+        self.match = match
+        self.submitted = submitted
+        self.deadline = deadline
+        self.sent_at = None
+        self.scheduled = False
+        self.done = False
+        self.future = Future()
+
+    def matches(self, data):
+        if self.match is None:
+            return True
+        if isinstance(self.match, bytes):
+            return data.startswith(self.match)
+        return self.match(data)
+
+
+def _key(pid, extended):
+    return pid | int(extended) << 32
+
+
+class Correlator(object):
+    """
+    Request/response matching on one channel of an opened and started
+    device.
+
+    timeout: default response timeout in seconds
+    max_batch: max requests per transmit call
+    samples: number of recent round-trip times kept for the percentiles
+    on_frame: optional callback(frames) receiving the batches with frames
+        answering no request, as the correlator owns the receive loop
+    Other keyword arguments are passed to AdaptiveReceiver.
+    """
+
+    def __init__(self, device, channel, timeout=1.0, max_batch=1000, samples=10000, on_frame=None,
+                 clock=time.perf_counter, **receiver_args):
+        self.device = device
+        self.channel = channel
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.on_frame = on_frame
+        self.clock = clock
+        self._receiver = AdaptiveReceiver(device, channel, **receiver_args)
+        self._tx = deque()
+        # (response ID, extended) key -> requests sent and not answered yet
+        self._pending = {}
+        self._pending_keys = np.zeros(0, dtype=np.int64)
+        # len of all the deques, `pending` is read from other threads
+        self._pending_count = 0
+        self._deadlines = []
+        self._seq = itertools.count()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._rtt = np.zeros(samples)
+        self._samples = 0
+        self.requests = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self.transmit_calls = 0
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"Correlator-{self.channel}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def submit(self, pid, data, response_id, match=None, timeout=None, extended=None, response_extended=None):
+        """
+        Queue a request frame and return a concurrent.futures.Future
+        resolved with the first matching Response, or failed with
+        TimeoutError after `timeout` seconds.
+
+        match: payload predicate of the response, a callable(bytes) or a
+            bytes prefix
+        extended, response_extended: ExternFlag of the request and of the
+            response, default to ID > 0x7ff
+        """
+        data = bytes(data)
+        if len(data) > 8:
+            raise ValueError("VCI_CAN_OBJ only support payloads under 8 bytes")
+        extended = pid > 0x7ff if extended is None else bool(extended)
+        response_extended = response_id > 0x7ff if response_extended is None else bool(response_extended)
+        now = self.clock()
+        req = _Request(pid, data, extended, _key(response_id, response_extended), match, now,
+                       now + (self.timeout if timeout is None else timeout))
+        self._tx.append(req)
+        self._wakeup.set()
+        return req.future
+
+    def request(self, pid, data, response_id, match=None, timeout=None, extended=None, response_extended=None):
+        """Send a request and wait for its Response, see submit()."""
+        return self.submit(pid, data, response_id, match, timeout, extended, response_extended).result()
+
+    async def arequest(self, pid, data, response_id, match=None, timeout=None, extended=None,
+                       response_extended=None):
+        """asyncio version of request()."""
+        return await asyncio.wrap_future(self.submit(pid, data, response_id, match, timeout,
+                                                     extended, response_extended))
+
+    @property
+    def pending(self):
+        """Requests sent and not answered or timed out yet."""
+        return self._pending_count
+
+    def stats(self):
+        """Counters and round-trip time percentiles in seconds."""
+        samples = self._rtt[:min(self._samples, len(self._rtt))]
+        p50, p90, p99, worst = np.percentile(samples, (50, 90, 99, 100)) if len(samples) else (0.0,) * 4
+        return {
+            "requests": self.requests,
+            "responses": self.responses,
+            "timeouts": self.timeouts,
+            "pending": self.pending,
+            "queued": len(self._tx),
+            "unmatched": self.unmatched,
+            "transmit_calls": self.transmit_calls,
+            "rtt_p50": float(p50),
+            "rtt_p90": float(p90),
+            "rtt_p99": float(p99),
+            "rtt_max": float(worst),
+        }
+
+    # everything below runs on the correlator thread
+
+    def _register(self, req):
+        reqs = self._pending.get(req.key)
+        if reqs is None:
+            reqs = self._pending[req.key] = deque()
+            self._pending_keys = np.array(list(self._pending), dtype=np.int64)
+        reqs.append(req)
+        self._pending_count += 1
+
+    def _unregister(self, req):
+        reqs = self._pending.get(req.key)
+        if reqs is None or req not in reqs:
+            return
+        reqs.remove(req)
+        self._pending_count -= 1
+        if not reqs:
+            del self._pending[req.key]
+            self._pending_keys = np.array(list(self._pending), dtype=np.int64)
+
+    def _send(self):
+        batch = []
+        while self._tx and len(batch) < self.max_batch:
+            req = self._tx.popleft()
+            if req.done or req.future.cancelled():
+                continue
+            if not req.scheduled:
+                req.scheduled = True
+                heapq.heappush(self._deadlines, (req.deadline, next(self._seq), req))
+            batch.append(req)
+        if not batch:
+            return 0
+        # registered first, the response may be in the very next poll
+        for req in batch:
+            self._register(req)
+        data = np.zeros((len(batch), 8), dtype=np.uint8)
+        for i, req in enumerate(batch):
+            data[i, :len(req.data)] = np.frombuffer(req.data, dtype=np.uint8)
+        now = self.clock()
+        try:
+            sent = self.device.transmit_many(self.channel, [req.pid for req in batch], data,
+                                             lengths=[len(req.data) for req in batch],
+                                             extended=[req.extended for req in batch], mute=True)
+        except Exception:
+            log.exception(f"CAN{self.channel} request transmit failed")
+            sent = 0
+        self.transmit_calls += 1
+        for req in batch[:sent]:
+            req.sent_at = now
+        self.requests += sent
+        # driver buffer full: retried with the next batch
+        for req in reversed(batch[sent:]):
+            self._unregister(req)
+            self._tx.appendleft(req)
+        return sent
+
+    def _dispatch(self, frames, now):
+        keys = frames["ID"].astype(np.int64) | frames["ExternFlag"].astype(np.int64) << 32
+        candidates = np.flatnonzero(np.isin(keys, self._pending_keys))
+        matched = np.zeros(len(frames), dtype=bool)
+        rtts = []
+        for i in candidates.tolist():
+            reqs = self._pending.get(int(keys[i]))
+            if reqs is None:
+                continue
+            data = bytes(frames["Data"][i, :min(frames["DataLen"][i], 8)])
+            for req in list(reqs):
+                if req.future.cancelled():
+                    req.done = True
+                    self._unregister(req)
+                    continue
+                if not req.matches(data):
+                    continue
+                req.done = True
+                self._unregister(req)
+                rtt = now - req.sent_at
+                rtts.append(rtt)
+                matched[i] = True
+                try:
+                    req.future.set_result(Response(int(frames["ID"][i]), data, now, rtt))
+                except InvalidStateError:
+                    pass  # cancelled meanwhile
+                break
+        if rtts:
+            self.responses += len(rtts)
+            self._record(np.array(rtts))
+        self.unmatched += len(frames) - len(rtts)
+        if self.on_frame is not None and len(rtts) < len(frames):
+            self.on_frame(frames[~matched])
+
+    def _expire(self, now):
+        """Fail the requests past their deadline, returns the next deadline."""
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, req = heapq.heappop(self._deadlines)
+            if req.done:
+                continue
+            req.done = True
+            self._unregister(req)
+            if req.future.cancelled():
+                continue
+            self.timeouts += 1
+            try:
+                req.future.set_exception(TimeoutError(
+                    f"no response to 0x{req.pid:x} within {req.deadline - req.submitted:g} s"))
+            except InvalidStateError:
+                pass
+        return self._deadlines[0][0] if self._deadlines else None
+
+    def _record(self, rtts):
+        rtts = rtts[-len(self._rtt):]
+        index = (self._samples + np.arange(len(rtts))) % len(self._rtt)
+        self._rtt[index] = rtts
+        self._samples += len(rtts)
+
+    def _run(self):
+        interval = self._receiver.min_interval
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            sent = self._send() if self._tx else 0
+            frames = self._receiver.poll()
+            now = self.clock()
+            if len(frames):
+                self._dispatch(frames, now)
+            due = self._expire(now)
+            if len(frames) or sent:
+                interval = self._receiver.min_interval
+                continue
+            if self._tx:
+                # driver refused the requests, back off before retrying
+                due = now + interval if due is None else min(due, now + interval)
+            wait = interval
+            if due is not None:
+                wait = min(wait, max(due - self.clock(), 0))
+            if wait:
+                self._wakeup.wait(wait)
+            interval = min(interval * 2, self._receiver.max_interval)
+
+        # fail whatever is left
+        for req in list(self._tx) + [item[2] for item in self._deadlines]:
+            if not req.done:
+                req.done = True
+                try:
+                    req.future.set_exception(TimeoutError("correlator stopped"))
+                except InvalidStateError:
+                    pass
+        self._tx.clear()
+        self._deadlines = []
+        self._pending.clear()
+        self._pending_count = 0
+        self._pending_keys = np.zeros(0, dtype=np.int64)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Cyclic transmit scheduler.
+
+All periodic messages of a channel live in one heap ordered by due time and
+are served by a single thread. Messages due within the same tick are copied
+from their prepared VCI_CAN_OBJ rows into a preallocated batch and sent
+with one VCI_Transmit call. Deadlines are kept on an absolute grid (due +
+period), so the schedule does not drift, and the scheduler sleeps until
+shortly before the next tick then spins for the last `spin` seconds.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+
+from controlcan import PVCI_CAN_OBJ, VCI_CAN_OBJ_DTYPE
+
+__all__ = ["CyclicScheduler"]
+
+log = logging.getLogger("controlcan.cyclic")
+
+
+class _Message(object):
+    def __init__(self, key, slot, period):
+        self.key = key
+        self.slot = slot
+        self.period = period
+        self.due = 0.0
+
+
+class CyclicScheduler(object):
+    """
+    Periodic transmit scheduler of one channel.
+
+    tick: frames due within `tick` seconds of each other are sent together
+    spin: time spent busy-waiting before a tick instead of sleeping
+    samples: number of recent lateness samples kept for the percentiles
+    """
+
+    def __init__(self, device, channel, tick=0.001, spin=0.0002, samples=10000,
+                 clock=time.perf_counter):
+        self.device = device
+        self.channel = channel
+        self.tick = tick
+        self.spin = spin
+        self.clock = clock
+        self._rows = np.zeros(64, dtype=VCI_CAN_OBJ_DTYPE)
+        self._batch = np.zeros(64, dtype=VCI_CAN_OBJ_DTYPE)
+        self._free = list(range(63, -1, -1))
+        self._messages = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._lateness = np.zeros(samples)
+        self._samples = 0
+        self.sent = 0
+        self.ticks = 0
+        self.missed = 0
+        self.short = 0
+
+    def add(self, pid, data, period, extended=None, key=None, phase=0.0):
+        """
+        Schedule `data` on `pid` every `period` seconds, starting `phase`
+        seconds from now. Returns the message key (defaults to `pid`).
+        """
+        key = pid if key is None else key
+        with self._lock:
+            if key in self._messages:
+                raise KeyError(f"message {key} already scheduled")
+            if not self._free:
+                self._grow()
+            msg = _Message(key, self._free.pop(), period)
+            row = self._rows[msg.slot]
+            row["ID"] = pid
+            row["SendType"] = 1
+            row["ExternFlag"] = pid > 0x7ff if extended is None else extended
+            self._set_data(msg, data)
+            msg.due = self.clock() + phase
+            self._messages[key] = msg
+            heapq.heappush(self._heap, (msg.due, next(self._seq), msg))
+        self._wakeup.set()
+        return key
+
+    def remove(self, key):
+        with self._lock:
+            msg = self._messages.pop(key)
+            self._free.append(msg.slot)
+
+    def update(self, key, data):
+        """Replace the payload of a scheduled message from its next send on."""
+        with self._lock:
+            self._set_data(self._messages[key], data)
+
+    def _set_data(self, msg, data):
+        if len(data) > 8:
+            raise ValueError("VCI_CAN_OBJ only support byte array data under 8 bytes")
+        row = self._rows[msg.slot]
+        row["DataLen"] = len(data)
+        row["Data"][:] = 0
+        row["Data"][:len(data)] = np.frombuffer(bytes(data), dtype=np.uint8)
+
+    def _grow(self):
+        size = len(self._rows)
+        rows = np.zeros(2 * size, dtype=VCI_CAN_OBJ_DTYPE)
+        rows[:size] = self._rows
+        self._rows = rows
+        self._batch = np.zeros(2 * size, dtype=VCI_CAN_OBJ_DTYPE)
+        self._free.extend(range(2 * size - 1, size - 1, -1))
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"CyclicScheduler-{self.channel}",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _sleep_until(self, deadline):
+        """
+        Sleep until `spin` seconds before `deadline`, then busy-wait. Returns
+        False when woken up before (schedule changed or stopping).
+        """
+        remaining = deadline - self.clock() - self.spin
+        if remaining > 0 and self._wakeup.wait(remaining):
+            self._wakeup.clear()
+            return False
+        while self.clock() < deadline:
+            pass
+        return True
+
+    def _collect(self, now):
+        """Pop the messages due in this tick into the batch, returns count."""
+        horizon = now + self.tick / 2
+        slots = []
+        lateness = []
+        while self._heap and self._heap[0][0] <= horizon:
+            due, _, msg = heapq.heappop(self._heap)
+            if self._messages.get(msg.key) is not msg:
+                continue  # removed
+            slots.append(msg.slot)
+            lateness.append(now - due)
+            msg.due = due + msg.period
+            if msg.due < now:
+                skipped = int((now - msg.due) // msg.period) + 1
+                self.missed += skipped
+                msg.due += skipped * msg.period
+            heapq.heappush(self._heap, (msg.due, next(self._seq), msg))
+        self._batch[:len(slots)] = self._rows[slots]
+        self._record(lateness)
+        return len(slots)
+
+    def _record(self, lateness):
+        index = (self._samples + np.arange(len(lateness))) % len(self._lateness)
+        self._lateness[index] = lateness
+        self._samples += len(lateness)
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                next_due = self._heap[0][0] if self._heap else None
+            if next_due is None:
+                self._wakeup.wait(0.1)
+                self._wakeup.clear()
+                continue
+            if not self._sleep_until(next_due):
+                continue
+            with self._lock:
+                count = self._collect(self.clock())
+                batch = self._batch
+            if not count:
+                continue
+            self.ticks += 1
+            sent = 0
+            while sent < count:
+                ret = self.device.Transmit(self.channel, batch[sent:count].ctypes.data_as(PVCI_CAN_OBJ),
+                                           count - sent, mute=True)
+                if ret <= 0:
+                    break
+                sent += ret
+            self.sent += sent
+            if sent < count:
+                self.short += count - sent
+                log.warning(f"CAN{self.channel} {count - sent} of {count} cyclic frames not sent")
+
+    def stats(self):
+        """Send counters and lateness (jitter) percentiles in seconds."""
+        samples = self._lateness[:min(self._samples, len(self._lateness))]
+        p50, p99, worst = np.percentile(samples, (50, 99, 100)) if len(samples) else (0.0, 0.0, 0.0)
+        return {
+            "messages": len(self._messages),
+            "sent": self.sent,
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "short": self.short,
+            "lateness_p50": float(p50),
+            "lateness_p99": float(p99),
+            "lateness_max": float(worst),
+        }
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+DBC signal database with compiled, vectorized codecs.
+
+`load_dbc()` parses a DBC file into a `Database` of `Message`s. Every
+message compiles its signals once into shift/mask tables, which are then
+used both for single frames (`decode(data)`, `encode(values)`) and for
+whole NumPy batches of VCI_CAN_OBJ records (`decode_batch(frames)`,
+`encode_batch(values)`), where a signal is extracted from all frames with
+a handful of array operations on 64 bit words:
+
+    db = load_dbc("vehicle.dbc")
+    frames = dev.receive_into(0, buf)
+    for name, signals in db.decode_frames(frames).items():
+        ...
+
+Intel (@1) and Motorola (@0) byte order, signed and IEEE float signals
+(SIG_VALTYPE_), scale/offset, value tables (VAL_) and simple multiplexing
+(one M multiplexer, m<n> signals) are supported. Extended multiplexing
+(SG_MUL_VAL_) is not.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import logging
+import re
+
+import numpy as np
+
+__all__ = ["Signal", "Message", "Database", "load_dbc", "parse_dbc"]
+
+log = logging.getLogger("controlcan.dbc")
+
+# bit 31 of a DBC message ID flags an extended frame
+DBC_EXTENDED = 0x80000000
+
+_COMMENT = re.compile(r'^\s*CM_[ \t].*?"(?:[^"\\]|\\.)*"\s*;', re.M | re.S)
+_MESSAGE = re.compile(r'^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)\s+(\w+)')
+_SIGNAL = re.compile(r'^SG_\s+(\w+)\s*(M|m\d+M?)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*'
+                     r'\(([^,]+),([^)]+)\)\s*\[([^|]*)\|([^\]]*)\]\s*"([^"]*)"\s*(.*)$')
+_VALUES = re.compile(r'^VAL_\s+(\d+)\s+(\w+)\s+(.*?)\s*;')
+_VALUE = re.compile(r'(-?\d+)\s+"([^"]*)"')
+_VALTYPE = re.compile(r'^SIG_VALTYPE_\s+(\d+)\s+(\w+)\s*:?\s*([012])\s*;')
+
+
+def _number(text):
+    value = float(text)
+    return int(value) if value.is_integer() and "." not in text and "e" not in text.lower() else value
+
+
+class Signal(object):
+    """
+    One signal of a message.
+
+    start, length: start bit and length as written in the DBC, the start
+        bit is the LSB for Intel and the MSB for Motorola signals
+    little_endian: Intel (@1) byte order
+    signed: two's complement raw value
+    float_bits: 32 or 64 for IEEE float signals, else None
+    multiplexer: True for the multiplexer (M) signal
+    multiplex_id: multiplexer value selecting this signal (m<n>), or None
+    choices: value table, raw value -> description
+    """
+
+    def __init__(self, name, start, length, little_endian=True, signed=False, factor=1,
+                 offset=0, minimum=None, maximum=None, unit="", receivers=(),
+                 multiplexer=False, multiplex_id=None):
+        self.name = name
+        self.start = start
+        self.length = length
+        self.little_endian = little_endian
+        self.signed = signed
+        self.factor = factor
+        self.offset = offset
+        self.minimum = minimum
+        self.maximum = maximum
+        self.unit = unit
+        self.receivers = tuple(receivers)
+        self.multiplexer = multiplexer
+        self.multiplex_id = multiplex_id
+        self.float_bits = None
+        self.choices = {}
+
+    def __repr__(self):
+        return f"Signal({self.name!r}, {self.start}|{self.length}@{int(self.little_endian)}" \
+               f"{'-' if self.signed else '+'}, ({self.factor},{self.offset}))"
+
+    @property
+    def shift(self):
+        """Position of the LSB in the little (Intel) or big (Motorola) endian 64 bit word."""
+        if self.little_endian:
+            return self.start
+        msb = (7 - self.start // 8) * 8 + self.start % 8
+        return msb - self.length + 1
+
+    @property
+    def end_byte(self):
+        """Number of payload bytes the signal needs."""
+        if self.little_endian:
+            return (self.start + self.length - 1) // 8 + 1
+        return 8 - self.shift // 8
+
+    @property
+    def integer(self):
+        """Physical values are integers (no float raw value, integral scale)."""
+        return self.float_bits is None and isinstance(self.factor, int) and isinstance(self.offset, int)
+
+
+class Message(object):
+    """
+    One message of the database, with its compiled codec.
+
+    frame_id: CAN ID without the extended flag
+    length: DLC in bytes
+    """
+
+    def __init__(self, frame_id, name, length, sender="", extended=False, signals=()):
+        self.frame_id = frame_id
+        self.name = name
+        self.length = length
+        self.sender = sender
+        self.extended = extended
+        self.signals = list(signals)
+        self._codec = None
+
+    def __repr__(self):
+        return f"Message(0x{self.frame_id:x}, {self.name!r}, {len(self.signals)} signals)"
+
+    @property
+    def key(self):
+        """ID as written in the DBC, with bit 31 set for extended frames."""
+        return self.frame_id | (DBC_EXTENDED if self.extended else 0)
+
+    @property
+    def multiplexer(self):
+        return next((s for s in self.signals if s.multiplexer), None)
+
+    @property
+    def min_length(self):
+        """Payload bytes needed by the signals."""
+        return max((s.end_byte for s in self.signals), default=0)
+
+    def signal(self, name):
+        return next(s for s in self.signals if s.name == name)
+
+    def _compile(self):
+        """(signal, shift, mask, sign bit) tuples, built on first use."""
+        if self._codec is None:
+            codec = []
+            for s in self.signals:
+                if s.shift < 0 or s.shift + s.length > 64:
+                    raise ValueError(f"signal {s.name} of {self.name} does not fit in 8 bytes")
+                sign = 1 << (s.length - 1) if s.signed and s.float_bits is None else 0
+                codec.append((s, s.shift, (1 << s.length) - 1, sign))
+            self._codec = codec
+        return self._codec
+
+    # single frame
+
+    def decode(self, data, choices=False):
+        """
+        Decode the payload `data` (bytes) into a {signal: value} dict. Only
+        the signals selected by the multiplexer value are included. With
+        `choices`, values found in a value table are replaced by their
+        description.
+        """
+        data = bytes(data).ljust(8, b"\0")
+        words = (int.from_bytes(data[:8], "little"), int.from_bytes(data[:8], "big"))
+        mux = None
+        result = {}
+        for s, shift, mask, sign in self._compile():
+            raw = (words[0 if s.little_endian else 1] >> shift) & mask
+            if s.multiplexer:
+                mux = raw
+            result[s.name] = self._physical(s, raw, sign, choices)
+        if mux is not None:
+            for s in self.signals:
+                if s.multiplex_id is not None and s.multiplex_id != mux:
+                    del result[s.name]
+        return result
+
+    def _physical(self, s, raw, sign, choices):
+        if s.float_bits:
+            dtype = np.float32 if s.float_bits == 32 else np.float64
+            raw = float(np.array(raw, dtype=f"u{s.float_bits // 8}").view(dtype))
+        elif sign:
+            raw = (raw ^ sign) - sign
+        if choices and raw in s.choices:
+            return s.choices[raw]
+        if s.integer and s.factor == 1 and s.offset == 0:
+            return raw
+        return raw * s.factor + s.offset
+
+    def encode(self, values):
+        """
+        Encode a {signal: physical value} dict into `length` payload bytes.
+        Missing signals are encoded as 0, multiplexed signals not selected
+        by the multiplexer value are left out.
+        """
+        words = [0, 0]
+        mux = None
+        if self.multiplexer is not None:
+            mux = self._raw(self.multiplexer, values.get(self.multiplexer.name, 0))
+        for s, shift, mask, sign in self._compile():
+            if s.multiplex_id is not None and s.multiplex_id != mux:
+                continue
+            raw = self._raw(s, values.get(s.name, 0))
+            words[0 if s.little_endian else 1] |= (raw & mask) << shift
+        data = (words[0].to_bytes(8, "little")[:8], words[1].to_bytes(8, "big"))
+        payload = bytes(a | b for a, b in zip(*data))
+        return payload[:self.length]
+
+    def _raw(self, s, value):
+        if isinstance(value, str):
+            # value table description
+            return next(raw for raw, text in s.choices.items() if text == value)
+        # same conversion as _raw_batch()
+        if s.float_bits:
+            dtype = np.float32 if s.float_bits == 32 else np.float64
+            return int(np.array((value - s.offset) / s.factor, dtype=dtype).view(f"u{s.float_bits // 8}"))
+        return int(np.rint((value - s.offset) / s.factor))
+
+    # batches
+
+    def decode_batch(self, frames):
+        """
+        Decode a batch of frames of this message (a record array with a
+        "Data" field, e.g. from ControlCAN.receive_into) into a dict of
+        arrays, one value per frame. Multiplexed signals are masked arrays,
+        masked where the multiplexer selects another signal.
+        """
+        data = np.ascontiguousarray(frames["Data"], dtype=np.uint8).reshape(-1, 8)
+        words = {True: data.view("<u8")[:, 0], False: data.view(">u8")[:, 0]}
+        result = {}
+        mux = None
+        for s, shift, mask, sign in self._compile():
+            raw = (words[s.little_endian] >> np.uint64(shift)) & np.uint64(mask)
+            if s.multiplexer:
+                mux = raw
+            result[s.name] = self._physical_batch(s, raw, sign)
+        if mux is not None:
+            for s in self.signals:
+                if s.multiplex_id is not None:
+                    result[s.name] = np.ma.masked_array(result[s.name], mask=mux != s.multiplex_id)
+        return result
+
+    def _physical_batch(self, s, raw, sign):
+        if s.float_bits == 32:
+            return raw.astype(np.uint32).view(np.float32).astype(np.float64) * s.factor + s.offset
+        if s.float_bits == 64:
+            return raw.view(np.float64) * s.factor + s.offset
+        if sign:
+            raw = raw.view(np.int64) if s.length == 64 else (raw ^ np.uint64(sign)).astype(np.int64) - sign
+        elif s.length < 64:
+            raw = raw.astype(np.int64)
+        if s.integer:
+            return raw * s.factor + s.offset if s.factor != 1 or s.offset != 0 else raw
+        return raw * float(s.factor) + float(s.offset)
+
+    def encode_batch(self, values, count=None):
+        """
+        Encode a {signal: array of physical values} dict into an (n, 8)
+        uint8 payload array, suitable for ControlCAN.transmit_many.
+        """
+        if count is None:
+            count = len(next(iter(values.values())))
+        words = {True: np.zeros(count, dtype="<u8"), False: np.zeros(count, dtype=">u8")}
+        mux = None
+        if self.multiplexer is not None:
+            mux = self._raw_batch(self.multiplexer, values.get(self.multiplexer.name, 0), count)
+        for s, shift, mask, sign in self._compile():
+            raw = self._raw_batch(s, values.get(s.name, 0), count)
+            if s.multiplex_id is not None:
+                raw = np.where(mux == s.multiplex_id, raw, np.uint64(0))
+            words[s.little_endian] |= (raw & np.uint64(mask)) << np.uint64(shift)
+        return words[True].view(np.uint8).reshape(-1, 8) | words[False].view(np.uint8).reshape(-1, 8)
+
+    def _raw_batch(self, s, value, count):
+        value = np.broadcast_to(np.asarray(value), (count,))
+        if s.float_bits:
+            dtype = np.float32 if s.float_bits == 32 else np.float64
+            raw = ((value - s.offset) / s.factor).astype(dtype).view(f"u{s.float_bits // 8}")
+            return raw.astype(np.uint64)
+        raw = np.rint((value - s.offset) / s.factor).astype(np.int64)
+        return raw.view(np.uint64)
+
+
+class Database(object):
+    """Messages of a DBC file, by name and by (DBC) ID."""
+
+    def __init__(self, messages=()):
+        self.messages = list(messages)
+        self._by_name = {m.name: m for m in self.messages}
+        self._by_key = {m.key: m for m in self.messages}
+
+    def __repr__(self):
+        return f"Database({len(self.messages)} messages)"
+
+    def message(self, name):
+        return self._by_name[name]
+
+    def message_by_id(self, frame_id, extended=None):
+        if extended is None:
+            extended = frame_id > 0x7ff
+        return self._by_key.get(frame_id | (DBC_EXTENDED if extended else 0))
+
+    def decode(self, frame_id, data, extended=None, choices=False):
+        """Decode a single frame, returns (message name, signals) or None."""
+        msg = self.message_by_id(frame_id, extended)
+        if msg is None:
+            return None
+        return msg.name, msg.decode(data, choices)
+
+    def encode(self, name, values):
+        """Encode message `name`, returns (ID, extended, payload bytes)."""
+        msg = self._by_name[name]
+        return msg.frame_id, msg.extended, msg.encode(values)
+
+    def decode_frames(self, frames):
+        """
+        Decode a batch of mixed frames (VCI_CAN_OBJ_DTYPE, capture or store
+        records) in one pass per message present. Returns {message name:
+        signals dict}, each signals dict also holding the positions of the
+        frames in the batch under "index". Unknown IDs, and frames shorter
+        than the signals of their message, are skipped.
+        """
+        ids = np.asarray(frames["ID"], dtype=np.uint32)
+        if "ExternFlag" in frames.dtype.names:
+            extended = np.asarray(frames["ExternFlag"]) != 0
+        else:
+            extended = ids > 0x7ff
+        keys = ids | np.where(extended, np.uint32(DBC_EXTENDED), np.uint32(0))
+        present, inverse = np.unique(keys, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(present) + 1))
+
+        result = {}
+        for i, key in enumerate(present):
+            msg = self._by_key.get(int(key))
+            if msg is None:
+                continue
+            index = order[bounds[i]:bounds[i + 1]]
+            if "DataLen" in frames.dtype.names:
+                index = index[np.asarray(frames["DataLen"])[index] >= msg.min_length]
+            signals = msg.decode_batch(frames[index])
+            signals["index"] = index
+            result[msg.name] = signals
+        return result
+
+
+def parse_dbc(text):
+    """Parse the content of a DBC file into a Database."""
+    text = _COMMENT.sub("", text)
+    messages = []
+    by_key = {}
+    current = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("BO_ "):
+            m = _MESSAGE.match(line)
+            if m is None:
+                raise ValueError(f"malformed message: {line}")
+            key = int(m.group(1))
+            current = Message(key & ~DBC_EXTENDED, m.group(2), int(m.group(3)), m.group(4),
+                              extended=bool(key & DBC_EXTENDED))
+            messages.append(current)
+            by_key[key] = current
+        elif line.startswith("SG_ "):
+            m = _SIGNAL.match(line)
+            if m is None or current is None:
+                raise ValueError(f"malformed signal: {line}")
+            name, mux, start, length, order, sign, factor, offset, lo, hi, unit, receivers = m.groups()
+            current.signals.append(Signal(
+                name, int(start), int(length), little_endian=order == "1", signed=sign == "-",
+                factor=_number(factor), offset=_number(offset),
+                minimum=_number(lo) if lo.strip() else None, maximum=_number(hi) if hi.strip() else None,
+                unit=unit, receivers=[r for r in re.split(r"[\s,]+", receivers) if r],
+                multiplexer=bool(mux) and mux.endswith("M"),
+                multiplex_id=int(mux.strip("mM")) if mux and mux.startswith("m") else None))
+        elif line.startswith("VAL_ "):
+            m = _VALUES.match(line)
+            msg = by_key.get(int(m.group(1))) if m else None
+            if msg is not None:
+                msg.signal(m.group(2)).choices = {int(v): d for v, d in _VALUE.findall(m.group(3))}
+        elif line.startswith("SIG_VALTYPE_ "):
+            m = _VALTYPE.match(line)
+            msg = by_key.get(int(m.group(1))) if m else None
+            if msg is not None:
+                msg.signal(m.group(2)).float_bits = {"0": None, "1": 32, "2": 64}[m.group(3)]
+        elif line.startswith("SG_MUL_VAL_ "):
+            log.warning("extended multiplexing (SG_MUL_VAL_) is not supported, ignored")
+    return Database(messages)
+
+
+def load_dbc(filename, encoding="cp1252"):
+    with open(filename, encoding=encoding, errors="replace") as f:
+        return parse_dbc(f.read())
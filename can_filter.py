@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Acceptance filter compiler.
+
+An `AcceptanceFilter` collects accepted IDs, ID ranges and ID/mask pairs,
+then compiles them into
+
+- the tightest single AccCode/AccMask/Filter setting of the device filter
+  covering all of them, so that most unwanted traffic never leaves the
+  adapter, and
+- a residual software filter applied to every received batch: a 2048
+  entry bitmap for standard IDs and sorted ID/range/mask tables for
+  extended IDs.
+
+The device filter works like an SJA1000 single filter: a standard ID is
+compared against AccCode bits 31..21, an extended ID against bits 31..3,
+and AccMask bits set to 1 are "don't care".
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import numpy as np
+
+from controlcan import VCI_INIT_CONFIG
+
+__all__ = ["AcceptanceFilter"]
+
+STD_MAX = 0x7ff
+EXT_MAX = 0x1fffffff
+
+# register bits not holding ID bits, ignored by the compiled filter
+_STD_SHIFT, _STD_REST = 21, (1 << 21) - 1
+_EXT_SHIFT, _EXT_REST = 3, (1 << 3) - 1
+
+
+def _union(a, b):
+    """Smallest (code, dontcare) pair covering both pairs."""
+    if a is None:
+        return b
+    dontcare = a[1] | b[1] | (a[0] ^ b[0])
+    return a[0] & ~dontcare, dontcare
+
+
+class AcceptanceFilter(object):
+    """
+    Set of accepted frame IDs.
+
+    A mask rule accepts `pid` when `pid & mask == code & mask`. An empty
+    filter accepts nothing in software and everything in hardware.
+    """
+
+    def __init__(self):
+        self._std = np.zeros(STD_MAX + 1, dtype=bool)
+        self._ext_ids = set()
+        self._ext_ranges = []
+        self._ext_masks = []
+        # hardware cover of the standard and extended rules, in ID space
+        self._std_cover = None
+        self._ext_cover = None
+        self._compiled = None
+
+    def add_id(self, pid, extended=False):
+        return self.add_ids((pid,), extended)
+
+    def add_ids(self, ids, extended=False):
+        for pid in ids:
+            if extended:
+                self._ext_ids.add(pid & EXT_MAX)
+                self._ext_cover = _union(self._ext_cover, (pid & EXT_MAX, 0))
+            else:
+                self._std[pid & STD_MAX] = True
+                self._std_cover = _union(self._std_cover, (pid & STD_MAX, 0))
+        self._compiled = None
+        return self
+
+    def add_range(self, lo, hi, extended=False):
+        """Accept IDs from `lo` to `hi`, both included."""
+        dontcare = (1 << (lo ^ hi).bit_length()) - 1
+        cover = (lo & ~dontcare, dontcare)
+        if extended:
+            self._ext_ranges.append((lo, hi))
+            self._ext_cover = _union(self._ext_cover, cover)
+        else:
+            self._std[lo:hi + 1] = True
+            self._std_cover = _union(self._std_cover, cover)
+        self._compiled = None
+        return self
+
+    def add_mask(self, code, mask, extended=False):
+        id_max = EXT_MAX if extended else STD_MAX
+        cover = (code & mask & id_max, ~mask & id_max)
+        if extended:
+            self._ext_masks.append((code & mask, mask))
+            self._ext_cover = _union(self._ext_cover, cover)
+        else:
+            self._std[(np.arange(STD_MAX + 1) & mask) == (code & mask)] = True
+            self._std_cover = _union(self._std_cover, cover)
+        self._compiled = None
+        return self
+
+    def hardware(self):
+        """Return the (AccCode, AccMask, Filter) setting covering all rules."""
+        reg = None
+        if self._std_cover is not None:
+            code, dontcare = self._std_cover
+            reg = (code << _STD_SHIFT, (dontcare << _STD_SHIFT) | _STD_REST)
+        if self._ext_cover is not None:
+            code, dontcare = self._ext_cover
+            ext = (code << _EXT_SHIFT, (dontcare << _EXT_SHIFT) | _EXT_REST)
+            if reg is not None:
+                # standard frames carry data bits below bit 21
+                reg = _union(reg, (ext[0], ext[1] | _STD_REST))
+            else:
+                reg = ext
+        if reg is None:
+            return 0, 0xffffffff, VCI_INIT_CONFIG.FILTER_PRESERVE_ALL
+        if self._ext_cover is None:
+            filter_mode = VCI_INIT_CONFIG.FILTER_PRESERVE_NORMAL
+        elif self._std_cover is None:
+            filter_mode = VCI_INIT_CONFIG.FILTER_PRESERVE_EXT
+        else:
+            filter_mode = VCI_INIT_CONFIG.FILTER_PRESERVE_ALL
+        return reg[0] & 0xffffffff, reg[1] & 0xffffffff, filter_mode
+
+    def init_config(self, **kwargs):
+        """VCI_INIT_CONFIG with the compiled device filter, see VCI_INIT_CONFIG()."""
+        code, mask, filter_mode = self.hardware()
+        return VCI_INIT_CONFIG(pid=code, mask=mask, filter_mode=filter_mode, **kwargs)
+
+    def _compile(self):
+        if self._compiled is None:
+            ranges = np.array(self._ext_ranges, dtype=np.uint32).reshape(-1, 2)
+            masks = np.array(self._ext_masks, dtype=np.uint32).reshape(-1, 2)
+            self._compiled = (np.array(sorted(self._ext_ids), dtype=np.uint32), ranges, masks)
+        return self._compiled
+
+    def accepts(self, pid, extended=False):
+        """Check a single frame ID."""
+        if not extended:
+            return pid <= STD_MAX and bool(self._std[pid])
+        return (pid in self._ext_ids
+                or any(lo <= pid <= hi for lo, hi in self._ext_ranges)
+                or any(pid & mask == code for code, mask in self._ext_masks))
+
+    def match(self, ids, extended):
+        """Vectorized accepts(): boolean array telling which IDs pass."""
+        ids = np.asarray(ids, dtype=np.uint32)
+        extended = np.asarray(extended, dtype=bool)
+        keep = np.zeros(len(ids), dtype=bool)
+
+        std = ~extended
+        std_ids = ids[std]
+        keep[std] = self._std[std_ids & STD_MAX] & (std_ids <= STD_MAX)
+
+        if extended.any():
+            ext_ids, ranges, masks = self._compile()
+            e = ids[extended]
+            hit = np.isin(e, ext_ids, assume_unique=False)
+            for lo, hi in ranges:
+                hit |= (e >= lo) & (e <= hi)
+            for code, mask in masks:
+                hit |= (e & mask) == code
+            keep[extended] = hit
+        return keep
+
+    def apply(self, frames):
+        """Return the frames of a received batch accepted by the filter."""
+        return frames[self.match(frames["ID"], frames["ExternFlag"])]
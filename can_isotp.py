@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""
+ISO-TP (ISO 15765-2) transport over ControlCAN, normal addressing, classic
+CAN frames.
+
+One `IsoTpTransport` thread owns the receive loop of a channel and serves
+any number of `IsoTpSession`s, each keyed by its (tx ID, rx ID) pair:
+
+    with IsoTpTransport(dev, 0) as tp:
+        ecu = tp.open(0x7e0, 0x7e8)
+        ecu.send(firmware_block)
+        response = ecu.recv(timeout=1)
+
+Consecutive frames are built in bulk from the payload and handed to
+ControlCAN.transmit_many: with STmin 0, a whole block (or the whole
+message when the block size is 0) goes out in one call, and frames of
+all sessions due in the same loop iteration share that call. A non-zero
+STmin is honored by pacing single frames. Payloads above 4095 bytes use
+the escaped first frame of ISO 15765-2:2016.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from collections import deque
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from can_receiver import AdaptiveReceiver
+
+__all__ = ["IsoTpTransport", "IsoTpSession", "IsoTpError"]
+
+log = logging.getLogger("controlcan.isotp")
+
+PCI_SF = 0x0
+PCI_FF = 0x1
+PCI_CF = 0x2
+PCI_FC = 0x3
+
+FC_CTS = 0x0
+FC_WAIT = 0x1
+FC_OVFLW = 0x2
+
+MAX_FF_LENGTH = 0xfff
+MAX_LENGTH = 0xffffffff
+
+
+def encode_st_min(seconds):
+    """STmin byte for a separation time in seconds."""
+    if seconds <= 0:
+        return 0
+    if seconds < 1e-3:
+        return 0xf0 + max(1, min(9, round(seconds * 1e4)))
+    return min(127, round(seconds * 1e3))
+
+
+def decode_st_min(value):
+    """Separation time in seconds of a STmin byte, reserved values read as 127 ms."""
+    if value <= 0x7f:
+        return value * 1e-3
+    if 0xf1 <= value <= 0xf9:
+        return (value - 0xf0) * 1e-4
+    return 0.127
+
+
+class IsoTpError(Exception):
+    """ISO-TP protocol errors: timeouts, overflow, sequence errors."""
+
+
+class _Transfer(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.future = Future()
+        self.offset = 0
+        self.seq = 1
+        self.waiting_fc = False
+        self.block_left = 0
+        self.st_min = 0.0
+        self.next_time = 0.0
+        self.deadline = None
+        self.wait_frames = 0
+        self.started = None
+
+
+class IsoTpSession(object):
+    """
+    One ISO-TP link between a local and a remote address.
+
+    Created by IsoTpTransport.open(). `send()` and `recv()` may be called
+    from any thread, the protocol itself runs on the transport thread.
+    """
+
+    def __init__(self, transport, tx_id, rx_id, extended=None):
+        self.transport = transport
+        self.tx_id = tx_id
+        self.rx_id = rx_id
+        self.extended = tx_id > 0x7ff if extended is None else extended
+        # transport routing key: (rx ID, ExternFlag) of the received frames
+        self._key = (rx_id, rx_id > 0x7ff if extended is None else bool(extended))
+        self._tx = deque()
+        self._current = None
+        self._queued = 0
+        self._rx = queue.Queue()
+        self._rx_buf = None
+        self._rx_length = 0
+        self._rx_seq = 0
+        self._rx_block = 0
+        self._rx_deadline = None
+        self._rx_started = None
+
+        self.tx_messages = 0
+        self.tx_bytes = 0
+        self.tx_time = 0.0
+        self.rx_messages = 0
+        self.rx_bytes = 0
+        self.rx_time = 0.0
+        self.errors = 0
+
+    def __repr__(self):
+        return f"IsoTpSession(0x{self.tx_id:x}, 0x{self.rx_id:x})"
+
+    def send_async(self, payload):
+        """Queue `payload` for sending, returns a Future resolved once it is sent."""
+        payload = bytes(payload)
+        if len(payload) > MAX_LENGTH:
+            raise ValueError("ISO-TP payload too long")
+        transfer = _Transfer(payload)
+        self._tx.append(transfer)
+        self.transport._wakeup.set()
+        return transfer.future
+
+    def send(self, payload, timeout=None):
+        """Send `payload` and wait until its last frame is handed to the driver."""
+        return self.send_async(payload).result(timeout)
+
+    def recv(self, timeout=None):
+        """Next reassembled payload, or None after `timeout` seconds."""
+        try:
+            return self._rx.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    @property
+    def stats(self):
+        """Counters and average throughput (bytes/s) per direction."""
+        return {
+            "tx_messages": self.tx_messages,
+            "tx_bytes": self.tx_bytes,
+            "tx_throughput": self.tx_bytes / self.tx_time if self.tx_time else 0.0,
+            "rx_messages": self.rx_messages,
+            "rx_bytes": self.rx_bytes,
+            "rx_throughput": self.rx_bytes / self.rx_time if self.rx_time else 0.0,
+            "errors": self.errors,
+        }
+
+    # transport thread
+
+    def _fail(self, transfer, message):
+        self.errors += 1
+        log.warning(f"{self} send failed: {message}")
+        transfer.future.set_exception(IsoTpError(message))
+        if transfer is self._current:
+            self._current = None
+
+    def _finish(self, transfer, now):
+        self.tx_messages += 1
+        self.tx_bytes += len(transfer.payload)
+        self.tx_time += now - transfer.started
+        transfer.future.set_result(len(transfer.payload))
+
+    def _flow_control(self, status, out):
+        tp = self.transport
+        bs = tp.block_size if status == FC_CTS else 0
+        self._rx_block = bs
+        out.append(tp._block(self, [bytes((0x30 | status, bs, encode_st_min(tp.st_min)))]))
+
+    def _on_frame(self, data, now, out):
+        pci = data[0] >> 4 if data else None
+        if pci == PCI_SF:
+            length = data[0] & 0xf
+            if 0 < length < len(data):
+                self._abort_rx("interrupted by a single frame")
+                self._deliver(data[1:1 + length], now, now)
+        elif pci == PCI_FF and len(data) == 8:
+            length = ((data[0] & 0xf) << 8) | data[1]
+            first = data[2:]
+            if length == 0:
+                length = int.from_bytes(data[2:6], "big")
+                first = data[6:]
+            self._abort_rx("interrupted by a first frame")
+            if length > self.transport.max_rx_size:
+                self.errors += 1
+                self._flow_control(FC_OVFLW, out)
+                return
+            self._rx_buf = bytearray(first)
+            self._rx_length = length
+            self._rx_seq = 1
+            self._rx_started = now
+            self._rx_deadline = now + self.transport.timeout
+            self._flow_control(FC_CTS, out)
+        elif pci == PCI_CF and self._rx_buf is not None:
+            if data[0] & 0xf != self._rx_seq & 0xf:
+                self._abort_rx(f"wrong sequence number {data[0] & 0xf}, expected {self._rx_seq & 0xf}")
+                return
+            self._rx_seq += 1
+            self._rx_buf += data[1:1 + self._rx_length - len(self._rx_buf)]
+            if len(self._rx_buf) >= self._rx_length:
+                self._deliver(bytes(self._rx_buf), self._rx_started, now)
+                self._rx_buf = None
+                return
+            self._rx_deadline = now + self.transport.timeout
+            if self._rx_block:
+                self._rx_block -= 1
+                if not self._rx_block:
+                    self._flow_control(FC_CTS, out)
+        elif pci == PCI_FC and len(data) >= 3:
+            transfer = self._current
+            if transfer is None or not transfer.waiting_fc:
+                return
+            status = data[0] & 0xf
+            if status == FC_CTS:
+                transfer.waiting_fc = False
+                transfer.block_left = data[1]
+                transfer.st_min = decode_st_min(data[2])
+                transfer.next_time = now
+                transfer.deadline = None
+            elif status == FC_WAIT:
+                transfer.wait_frames += 1
+                if transfer.wait_frames > self.transport.max_wait_frames:
+                    self._fail(transfer, "too many FC WAIT frames")
+                else:
+                    transfer.deadline = now + self.transport.timeout
+            else:
+                self._fail(transfer, "receiver overflow (FC OVFLW)")
+
+    def _abort_rx(self, reason):
+        if self._rx_buf is not None:
+            self.errors += 1
+            log.warning(f"{self} reception aborted: {reason}")
+            self._rx_buf = None
+
+    def _deliver(self, payload, started, now):
+        self.rx_messages += 1
+        self.rx_bytes += len(payload)
+        self.rx_time += now - started
+        self._rx.put(payload)
+
+    def _service(self, now, out):
+        """Append the frames due now to `out`, returns the next due time or None."""
+        if self._rx_buf is not None and now > self._rx_deadline:
+            self._abort_rx("consecutive frame timeout (N_Cr)")
+
+        transfer = self._current
+        if transfer is None:
+            if not self._tx:
+                return None
+            transfer = self._current = self._tx.popleft()
+            if not transfer.future.set_running_or_notify_cancel():
+                self._current = None
+                return now
+            transfer.started = now
+            payload = transfer.payload
+            tp = self.transport
+            if len(payload) <= 7:
+                out.append(tp._block(self, [bytes((len(payload),)) + payload],
+                                     lambda: self._sent(transfer)))
+                return None
+            if len(payload) <= MAX_FF_LENGTH:
+                first = bytes((0x10 | len(payload) >> 8, len(payload) & 0xff)) + payload[:6]
+                transfer.offset = 6
+            else:
+                first = b"\x10\x00" + len(payload).to_bytes(4, "big") + payload[:2]
+                transfer.offset = 2
+            transfer.waiting_fc = True
+            transfer.deadline = now + tp.timeout
+            out.append(tp._block(self, [first]))
+            return transfer.deadline
+
+        if transfer.waiting_fc:
+            if transfer.deadline is not None and now > transfer.deadline:
+                self._fail(transfer, "flow control timeout (N_Bs)")
+                return now
+            return transfer.deadline
+        if transfer.offset >= len(transfer.payload):
+            return None  # last frames in flight
+        if now < transfer.next_time:
+            return transfer.next_time
+        if self._queued:
+            return None  # wait for the driver to take the previous frames
+
+        remaining = -(-(len(transfer.payload) - transfer.offset) // 7)
+        count = min(remaining, self.transport.max_batch) if not transfer.st_min else 1
+        if transfer.block_left:
+            count = min(count, transfer.block_left)
+            transfer.block_left -= count
+            if not transfer.block_left and count < remaining:
+                transfer.waiting_fc = True
+                transfer.deadline = now + self.transport.timeout
+        last = count == remaining
+        out.append(self.transport._cf_block(self, transfer, count,
+                                            (lambda: self._sent(transfer)) if last else None))
+        transfer.next_time = now + transfer.st_min
+        return None if last else (transfer.deadline if transfer.waiting_fc else transfer.next_time)
+
+    def _sent(self, transfer):
+        self._finish(transfer, self.transport.clock())
+        if self._current is transfer:
+            self._current = None
+
+
+class IsoTpTransport(object):
+    """
+    ISO-TP sessions on one channel of an opened and started device.
+
+    block_size, st_min: flow control parameters sent to our peers (BS, and
+        STmin in seconds)
+    padding: fill byte of frames shorter than 8 bytes, None to send
+        shorter frames
+    timeout: N_Bs/N_Cr timeout in seconds
+    max_rx_size: longest payload accepted, longer ones are refused with
+        FC OVFLW
+    max_wait_frames: FC WAIT frames accepted in a row before giving up
+    max_batch: max consecutive frames of a session per transmit call, so
+        that a large transfer does not hold back the other sessions
+    on_frame: optional callback(frames) receiving the batches with frames
+        of no session, as the transport owns the receive loop of the channel
+    Other keyword arguments are passed to AdaptiveReceiver.
+    """
+
+    def __init__(self, device, channel, block_size=0, st_min=0.0, padding=0xcc, timeout=1.0,
+                 max_rx_size=MAX_LENGTH, max_wait_frames=10, max_batch=1000, on_frame=None,
+                 clock=time.perf_counter, **receiver_args):
+        self.device = device
+        self.channel = channel
+        self.block_size = block_size
+        self.st_min = st_min
+        self.padding = padding
+        self.timeout = timeout
+        self.max_rx_size = max_rx_size
+        self.max_wait_frames = max_wait_frames
+        self.max_batch = max_batch
+        self.on_frame = on_frame
+        self.clock = clock
+        self._receiver = AdaptiveReceiver(device, channel, **receiver_args)
+        self._sessions = {}
+        self._backlog = deque()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.transmit_calls = 0
+        self.frames_sent = 0
+
+    def open(self, tx_id, rx_id, extended=None):
+        """Session sending on `tx_id` and receiving on `rx_id`."""
+        session = IsoTpSession(self, tx_id, rx_id, extended)
+        if session._key in self._sessions:
+            raise KeyError(f"rx ID 0x{rx_id:x} already has a session")
+        self._sessions[session._key] = session
+        return session
+
+    def close_session(self, session):
+        del self._sessions[session._key]
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"IsoTp-{self.channel}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def stats(self):
+        return {
+            "transmit_calls": self.transmit_calls,
+            "frames_sent": self.frames_sent,
+            "frames_per_call": self.frames_sent / self.transmit_calls if self.transmit_calls else 0.0,
+            "sessions": {(s.tx_id, s.rx_id): s.stats for s in list(self._sessions.values())},
+        }
+
+    # frame blocks: [session, (n, 8) data, (n,) lengths, callback when sent]
+
+    def _block(self, session, payloads, on_sent=None):
+        lengths = np.array([8 if self.padding is not None else len(p) for p in payloads], dtype=np.uint8)
+        fill = b"\0" if self.padding is None else bytes((self.padding,))
+        data = np.frombuffer(b"".join(p.ljust(8, fill) for p in payloads), dtype=np.uint8).reshape(-1, 8)
+        session._queued += len(data)
+        return [session, data, lengths, on_sent]
+
+    def _cf_block(self, session, transfer, count, on_sent=None):
+        """`count` consecutive frames of `transfer`, built in one go."""
+        start = transfer.offset
+        chunk = transfer.payload[start:start + 7 * count]
+        transfer.offset += len(chunk)
+        data = np.full((count, 8), 0 if self.padding is None else self.padding, dtype=np.uint8)
+        body = np.frombuffer(chunk.ljust(7 * count, b"\0"), dtype=np.uint8).reshape(count, 7)
+        data[:, 1:] = body
+        data[:, 0] = 0x20 | ((transfer.seq + np.arange(count)) & 0xf)
+        transfer.seq += count
+        lengths = np.full(count, 8, dtype=np.uint8)
+        if self.padding is None:
+            lengths[-1] = 1 + len(chunk) - 7 * (count - 1)
+            data[-1, lengths[-1]:] = 0
+        session._queued += count
+        return [session, data, lengths, on_sent]
+
+    def _transmit(self, blocks):
+        """Send the frame blocks in one transmit_many call, keep the rest for later."""
+        self._backlog.extend(blocks)
+        blocks = list(self._backlog)
+        ids = np.concatenate([np.full(len(b[1]), b[0].tx_id, dtype=np.uint32) for b in blocks])
+        extended = np.concatenate([np.full(len(b[1]), b[0].extended, dtype=bool) for b in blocks])
+        data = np.concatenate([b[1] for b in blocks])
+        lengths = np.concatenate([b[2] for b in blocks])
+        try:
+            sent = self.device.transmit_many(self.channel, ids, data, lengths=lengths,
+                                             extended=extended, mute=True)
+        except Exception:
+            log.exception(f"CAN{self.channel} ISO-TP transmit failed")
+            sent = 0
+        self.transmit_calls += 1
+        self.frames_sent += sent
+        while sent and self._backlog:
+            block = self._backlog[0]
+            if sent < len(block[1]):
+                block[0]._queued -= sent
+                block[1], block[2] = block[1][sent:], block[2][sent:]
+                break
+            sent -= len(block[1])
+            block[0]._queued -= len(block[1])
+            self._backlog.popleft()
+            if block[3] is not None:
+                block[3]()
+
+    def _dispatch(self, frames, now, out):
+        ids = frames["ID"].tolist()
+        extended = frames["ExternFlag"].tolist()
+        lengths = frames["DataLen"].tolist()
+        raw = np.ascontiguousarray(frames["Data"]).tobytes()
+        unknown = []
+        for i, (pid, ext, length) in enumerate(zip(ids, extended, lengths)):
+            session = self._sessions.get((pid, bool(ext)))
+            if session is None:
+                unknown.append(i)
+                continue
+            session._on_frame(raw[8 * i:8 * i + min(length, 8)], now, out)
+        if unknown and self.on_frame is not None:
+            self.on_frame(frames[unknown])
+
+    def _run(self):
+        interval = self._receiver.min_interval
+        retry_delay = interval
+        retry_at = 0.0
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            frames = self._receiver.poll()
+            now = self.clock()
+            out = []
+            if len(frames):
+                self._dispatch(frames, now, out)
+            due = None
+            for session in list(self._sessions.values()):
+                t = session._service(now, out)
+                if t is not None:
+                    due = t if due is None else min(due, t)
+            if out or (self._backlog and now >= retry_at):
+                self._transmit(out)
+                if self._backlog:
+                    # driver buffer full, back off before retrying
+                    retry_at = now + retry_delay
+                    retry_delay = min(retry_delay * 2, self._receiver.max_interval)
+                    due = retry_at if due is None else min(due, retry_at)
+                else:
+                    retry_delay = self._receiver.min_interval
+
+            if (len(frames) or out) and not self._backlog:
+                interval = self._receiver.min_interval
+                continue
+            wait = interval
+            if due is not None:
+                wait = min(wait, max(due - self.clock(), 0))
+            if wait:
+                self._wakeup.wait(wait)
+            interval = min(interval * 2, self._receiver.max_interval)
@@ -0,0 +1,839 @@
+#!/usr/bin/env python3
+"""
+Streaming readers and writers of candump, Vector ASC and BLF logs.
+
+Readers yield batches of capture records (can_capture.CAPTURE_DTYPE: the
+VCI_CAN_OBJ fields plus host_time, channel and the TX flag), writers take
+such batches, so a conversion never holds more than one chunk of the file
+in memory:
+
+    with open_reader("trace.blf") as reader, open_writer("trace.asc") as writer:
+        for records in reader:
+            writer.write_records(records)
+
+Text formats are parsed and formatted a chunk at a time with numpy
+(tokenizing, hex/decimal conversion and line assembly work on whole
+columns), BLF objects are decoded with vectorized field gathers, so no
+Python code runs per frame. `.vcz` recordings of can_recorder are
+supported too.
+
+Only classic CAN data and remote frames are converted; CAN FD frames,
+error frames and other events are skipped. Channels are 0-based like
+VCI channels: ASC/BLF channel 1 is channel 0, candump `can0` is 0.
+
+Command line:
+
+    python can_logfile.py input.blf output.log
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import argparse
+import datetime
+import logging
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from can_capture import CAPTURE_DTYPE, CAPTURE_FLAG_TX, to_records
+
+__all__ = [
+    "CandumpReader", "CandumpWriter", "AscReader", "AscWriter", "BlfReader", "BlfWriter",
+    "open_reader", "open_writer", "convert",
+]
+
+log = logging.getLogger("controlcan.logfile")
+
+CHUNK_SIZE = 1 << 20
+
+
+# --- vectorized text helpers
+
+_DIGIT = np.full(256, 255, dtype=np.uint8)
+for _i, _c in enumerate("0123456789abcdef"):
+    _DIGIT[ord(_c)] = _DIGIT[ord(_c.upper())] = _i
+_POW = {base: np.uint64(base) ** np.arange(20, dtype=np.uint64) for base in (10, 16)}
+_WEIGHT = {base: float(base) ** np.arange(16) for base in (10, 16)}
+_FRAC = 10.0 ** -np.arange(16)
+_PAD = b" " * 32
+_HEX_UPPER = np.frombuffer(b"0123456789ABCDEF", dtype=np.uint8)
+_HEX_LOWER = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+
+def _text_chunks(f, chunk_size):
+    """Chunks of whole lines, each ending with a newline."""
+    rest = b""
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            if rest.strip():
+                yield rest + b"\n"
+            return
+        data = rest + data
+        cut = data.rfind(b"\n") + 1
+        rest = data[cut:]
+        if cut:
+            yield data[:cut]
+
+
+def _tokenize(arr, max_tokens):
+    """
+    Split a padded chunk into lines of whitespace separated tokens. Returns
+    the (lines, max_tokens) start and length matrices (length 0: no token)
+    and the token count of every line.
+    """
+    lines = np.flatnonzero(arr == 10)
+    # whitespace and control chars; the padding makes edges alternate
+    # token start, token end
+    edges = np.flatnonzero(np.diff((arr <= 32).view(np.int8))) + 1
+    starts = edges[0::2]
+    ends = edges[1::2]
+    line = np.searchsorted(lines, starts)
+    # token number within its line
+    index = np.arange(len(starts))
+    first = np.r_[True, line[1:] != line[:-1]]
+    k = index - np.maximum.accumulate(np.where(first, index, 0))
+    count = np.bincount(line, minlength=len(lines))
+    keep = k < max_tokens
+    S = np.zeros((len(lines), max_tokens), dtype=np.int64)
+    L = np.zeros((len(lines), max_tokens), dtype=np.int64)
+    S[line[keep], k[keep]] = starts[keep]
+    L[line[keep], k[keep]] = (ends - starts)[keep]
+    return S, L, count
+
+
+def _padded(chunk):
+    """Chunk as a uint8 array with room for the widest token window on both sides."""
+    return np.frombuffer(_PAD + chunk + _PAD, dtype=np.uint8)
+
+
+def _chars(arr, start, width):
+    """(..., width) matrix of the chars from every `start`, one contiguous copy per row."""
+    return sliding_window_view(arr, width)[np.clip(start, 0, len(arr) - width)]
+
+
+def _int(arr, start, length, width, base=16):
+    """
+    Integer value of the `length` chars of `arr` at every `start` (any
+    shape), and a validity mask. Tokens are read right-aligned on `width`
+    columns so that every column has a constant weight; exact below 2**53.
+    """
+    chars = _chars(arr, start + length - width, width)
+    digits = chars - np.uint8(48) if base == 10 else np.take(_DIGIT, chars)
+    digits *= np.arange(-width, 0) >= -length[..., None]
+    ok = (length > 0) & (length <= width) & np.all(digits < base, axis=-1)
+    return (digits.astype(np.float64) @ _WEIGHT[base][width - 1::-1]).astype(np.int64), ok
+
+
+def _hex_bytes(arr, start, nbytes):
+    """(n, 8) bytes written as hex pairs from every `start`, and a validity mask."""
+    digits = np.take(_DIGIT, _chars(arr, start, 16)).reshape(-1, 8, 2)
+    inside = np.arange(8) < nbytes[:, None]
+    ok = np.all(~inside | ((digits[..., 0] < 16) & (digits[..., 1] < 16)), axis=1)
+    return np.where(inside, (digits[..., 0] << 4) | digits[..., 1], 0).astype(np.uint8), ok
+
+
+def _decimal(arr, start, length, width=24):
+    """Value of decimal numbers like 12.345678 at every `start`, and a validity mask."""
+    dot = (_chars(arr, start, width) == 46) & (np.arange(width) < length[:, None])
+    dot_pos = np.where(dot.any(axis=1), dot.argmax(axis=1), length)
+    frac_len = np.clip(length - dot_pos - 1, 0, 15)
+    integer, int_ok = _int(arr, start, dot_pos, 12, 10)
+    frac, frac_ok = _int(arr, start + dot_pos + 1, frac_len, 9, 10)
+    ok = ((length > 0) & (length <= width) & (dot.sum(axis=1) <= 1) & (int_ok | (dot_pos == 0))
+          & (frac_ok | (frac_len == 0)) & (int_ok | frac_ok))
+    return integer + frac * _FRAC[frac_len], ok
+
+
+def _digits(values, n, base=10, table=_HEX_UPPER):
+    """(len(values), n) chars of `values` zero padded to n digits."""
+    values = np.asarray(values, dtype=np.uint64)[:, None]
+    return table[(values // _POW[base][n - 1::-1]) % np.uint64(base)]
+
+
+def _significant(chars, keep_last=1):
+    """Mask dropping the leading zeros of digit columns, keeping at least `keep_last`."""
+    n = chars.shape[1]
+    nonzero = chars != 48
+    nonzero[:, n - keep_last:] = True
+    return np.maximum.accumulate(nonzero, axis=1)
+
+
+def _assemble(columns, n):
+    """
+    Join (chars, keep) column groups into `n` lines: the kept chars of
+    every row, in column order. A `keep` of None keeps the whole group.
+    """
+    chars = np.hstack([np.broadcast_to(c, (n, np.shape(c)[-1])) for c, _ in columns])
+    keep = np.hstack([np.ones((n, np.shape(c)[-1]), dtype=bool) if k is None
+                      else np.broadcast_to(k, (n, np.shape(c)[-1])) for c, k in columns])
+    return chars[keep].tobytes()
+
+
+def _const(text):
+    return np.frombuffer(text.encode(), dtype=np.uint8)[None, :]
+
+
+def _fixed(values, decimals, width):
+    """Columns of `values` formatted like "{:>{width}.{decimals}f}" (non-negative values)."""
+    scaled = np.round(np.asarray(values, dtype=np.float64) * 10 ** decimals).astype(np.uint64)
+    integer = _digits(scaled // np.uint64(10 ** decimals), 12)
+    frac = _digits(scaled % np.uint64(10 ** decimals), decimals)
+    significant = _significant(integer)
+    int_len = significant.sum(axis=1)
+    pad = np.full((len(scaled), width), 32, dtype=np.uint8)
+    pad_keep = np.arange(width) < (width - int_len - 1 - decimals)[:, None]
+    return [(pad, pad_keep), (integer, significant), (_const("."), None), (frac, None)]
+
+
+def _new_records(n):
+    records = np.zeros(n, dtype=CAPTURE_DTYPE)
+    records["TimeFlag"] = 1
+    return records
+
+
+def _set_timestamps(records, t0):
+    """Device TimeStamp (100 us ticks) relative to the first frame of the file."""
+    ticks = np.round((records["host_time"] - t0) * 1e4).astype(np.int64)
+    records["TimeStamp"] = ticks & 0xffffffff
+
+
+def _open(file, mode):
+    """File object of a file name or an already opened binary file."""
+    if hasattr(file, "read") or hasattr(file, "write"):
+        return file, False
+    return open(file, mode), True
+
+
+class _Reader(object):
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self._f, self._owned = _open(file, "rb")
+        self.chunk_size = chunk_size
+        self.frames = 0
+        self._t0 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        for records in self._batches():
+            if len(records):
+                if self._t0 is None:
+                    self._t0 = records["host_time"][0]
+                _set_timestamps(records, self._t0)
+                self.frames += len(records)
+                yield records.view(np.recarray)
+
+    def close(self):
+        if self._owned:
+            self._f.close()
+
+
+class _Writer(object):
+    def __init__(self, file):
+        self._f, self._owned = _open(file, "wb")
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, frames, channel=0, device=0, host_time=None, flags=0):
+        """Write a batch of driver frames (VCI_CAN_OBJ_DTYPE)."""
+        self.write_records(to_records(frames, channel, device, host_time, flags))
+
+    def write_records(self, records):
+        """Write a batch of capture records (CAPTURE_DTYPE)."""
+        if len(records):
+            self._write(records)
+            self.frames += len(records)
+
+    def close(self):
+        if self._owned:
+            self._f.close()
+
+
+# --- candump
+
+class CandumpReader(_Reader):
+    """
+    Reader of `candump -l` logs: "(1436509052.249713) can0 123#DEADBEEF".
+    The channel is the number ending the interface name.
+    """
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        super().__init__(file, chunk_size)
+        self.channels = {}
+
+    def _channel(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            digits = re.search(rb"(\d+)$", name)
+            channel = self.channels[name] = int(digits.group(1)) if digits else 0
+        return channel
+
+    def _batches(self):
+        for chunk in _text_chunks(self._f, self.chunk_size):
+            yield self._parse(_padded(chunk))
+
+    def _parse(self, arr):
+        S, L, count = _tokenize(arr, 3)
+        ok = count >= 3
+
+        # "(seconds.micros)"
+        ok &= (arr[S[:, 0]] == ord("(")) & (arr[S[:, 0] + np.maximum(L[:, 0] - 1, 0)] == ord(")"))
+        times, valid = _decimal(arr, S[:, 0] + 1, L[:, 0] - 2)
+        ok &= valid
+
+        # "ID#DATA", "ID#R", "ID#R5"
+        start = S[:, 2]
+        length = L[:, 2]
+        hash_ = (_chars(arr, start, 9) == ord("#")) & (np.arange(9) < length[:, None])
+        hash_pos = hash_.argmax(axis=1)
+        ok &= hash_.any(axis=1) & ((hash_pos == 3) | (hash_pos == 8))
+        ids, valid = _int(arr, start, hash_pos, 8)
+        ok &= valid & (ids <= 0x1fffffff)
+        body = start + hash_pos + 1
+        body_len = length - hash_pos - 1
+        first = arr[np.minimum(body, len(arr) - 1)]
+        remote = (body_len > 0) & (first == ord("R"))
+        ok &= (body_len == 0) | (first != ord("#"))  # CAN FD
+        rtr_dlc, valid = _int(arr, body + 1, np.minimum(body_len - 1, 1), 1, 10)
+        rtr_dlc = np.where(valid, rtr_dlc, 0)
+        nbytes = body_len // 2
+        ok &= remote | ((body_len % 2 == 0) & (body_len <= 16))
+        values, valid = _hex_bytes(arr, body, np.where(remote, 0, nbytes))
+        ok &= valid
+
+        rows = np.flatnonzero(ok)
+        records = _new_records(len(rows))
+        records["host_time"] = times[rows]
+        records["ID"] = ids[rows]
+        records["ExternFlag"] = hash_pos[rows] == 8
+        records["RemoteFlag"] = remote[rows]
+        records["DataLen"] = np.where(remote, rtr_dlc, nbytes)[rows]
+        records["Data"] = values[rows]
+
+        # interface names, looked up once per distinct name
+        names = _chars(arr, S[rows, 1], 16)
+        names = np.where(np.arange(16) < L[rows, 1][:, None], names, 0)
+        unique, inverse = np.unique(names.view("S16")[:, 0], return_inverse=True)
+        records["channel"] = np.array([self._channel(n) for n in unique], dtype=np.uint8)[inverse]
+        return records
+
+
+class CandumpWriter(_Writer):
+    """Writer of `candump -l` logs, channels named `interface` + number."""
+
+    def __init__(self, file, interface="can"):
+        super().__init__(file)
+        self.interface = interface
+        names = [f"{interface}{ch} ".encode() for ch in range(256)]
+        width = max(len(n) for n in names)
+        self._names = np.zeros((256, width), dtype=np.uint8)
+        self._name_keep = np.zeros((256, width), dtype=bool)
+        for ch, name in enumerate(names):
+            self._names[ch, :len(name)] = np.frombuffer(name, dtype=np.uint8)
+            self._name_keep[ch, :len(name)] = True
+
+    def _write(self, records):
+        micros = np.round(records["host_time"] * 1e6).astype(np.uint64)
+        ext = records["ExternFlag"].astype(bool)
+        remote = records["RemoteFlag"].astype(bool)
+        dlc = np.minimum(records["DataLen"], 8)
+        channel = records["channel"]
+        data = records["Data"]
+        hex_data = np.stack([_HEX_UPPER[data >> 4], _HEX_UPPER[data & 15]], axis=2).reshape(-1, 16)
+        columns = [
+            (_const("("), None),
+            (_digits(micros // np.uint64(1000000), 10), None),
+            (_const("."), None),
+            (_digits(micros % np.uint64(1000000), 6), None),
+            (_const(") "), None),
+            (self._names[channel], self._name_keep[channel]),
+            (_digits(records["ID"], 8, 16), np.where(ext[:, None], True, np.arange(8) >= 5)),
+            (_const("#"), None),
+            (hex_data, ~remote[:, None] & (np.arange(16) < 2 * dlc[:, None])),
+            (_const("R"), remote[:, None]),
+            (_digits(dlc, 1), (remote & (dlc > 0))[:, None]),
+            (_const("\n"), None),
+        ]
+        self._f.write(_assemble(columns, len(records)))
+
+
+# --- Vector ASC
+
+_ASC_DATE_FORMATS = ("%a %b %d %I:%M:%S.%f %p %Y", "%a %b %d %H:%M:%S.%f %Y",
+                     "%a %b %d %I:%M:%S %p %Y", "%a %b %d %H:%M:%S %Y")
+
+
+def _asc_date(text):
+    for fmt in _ASC_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text.strip(), fmt).timestamp()
+        except ValueError:
+            pass
+    log.warning(f"unknown ASC date format {text!r}, times start at 0")
+    return 0.0
+
+
+class AscReader(_Reader):
+    """
+    Reader of Vector ASC logs. host_time is the "date" of the header plus
+    the event time; hex and dec bases, absolute and relative timestamps
+    are supported.
+    """
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        super().__init__(file, chunk_size)
+        self.start_time = 0.0
+        self.base = 16
+        self.relative = False
+        self._last = 0.0
+
+    def _header(self, chunk):
+        head = chunk[:1 << 16]
+        date = re.search(rb"^date (.+)$", head, re.M)
+        if date:
+            self.start_time = _asc_date(date.group(1).decode("ascii", "replace"))
+        base = re.search(rb"^base (hex|dec)\s+timestamps (absolute|relative)", head, re.M)
+        if base:
+            self.base = 16 if base.group(1) == b"hex" else 10
+            self.relative = base.group(2) == b"relative"
+
+    def _batches(self):
+        for i, chunk in enumerate(_text_chunks(self._f, self.chunk_size)):
+            if i == 0:
+                self._header(chunk)
+            yield self._parse(_padded(chunk))
+
+    def _parse(self, arr):
+        S, L, count = _tokenize(arr, 14)
+        times, is_event = _decimal(arr, S[:, 0], L[:, 0])
+        if self.relative:
+            deltas = np.where(is_event, times, 0.0)
+            times = self._last + np.cumsum(deltas)
+            if len(times):
+                self._last = times[-1]
+
+        channel, ok = _int(arr, S[:, 1], L[:, 1], 3, 10)
+        ok &= is_event & (count >= 5) & (channel >= 1)
+
+        # "123" or "1ABCDEFx"
+        ext = arr[S[:, 2] + np.maximum(L[:, 2] - 1, 0)] == ord("x")
+        ids, valid = _int(arr, S[:, 2], L[:, 2] - ext, 8, self.base)
+        ok &= valid & (ids <= 0x1fffffff)
+
+        direction = _chars(arr, S[:, 3], 2)
+        ok &= (L[:, 3] == 2) & np.isin(direction[:, 0], (ord("R"), ord("T"))) & (direction[:, 1] == ord("x"))
+        kind = arr[S[:, 4]]
+        remote = kind == ord("r")
+        ok &= (L[:, 4] == 1) & (remote | (kind == ord("d")))
+
+        dlc, valid = _int(arr, S[:, 5], L[:, 5], 1, 16)
+        dlc = np.where(valid, dlc, 0)
+        ok &= (valid | remote) & (dlc <= 8)
+        ok &= remote | (count >= 6 + dlc)
+        inside = np.arange(8) < dlc[:, None]
+        if self.base == 16:
+            hi, lo = _DIGIT[arr[S[:, 6:14]]], _DIGIT[arr[S[:, 6:14] + 1]]
+            valid = (L[:, 6:14] == 2) & (hi < 16) & (lo < 16)
+            values = (hi << 4) | lo
+        else:
+            values, valid = _int(arr, S[:, 6:14], L[:, 6:14], 3, 10)
+            valid &= values <= 255
+        ok &= remote | np.all(~inside | valid, axis=1)
+
+        rows = np.flatnonzero(ok)
+        records = _new_records(len(rows))
+        records["host_time"] = self.start_time + times[rows]
+        records["ID"] = ids[rows]
+        records["ExternFlag"] = ext[rows]
+        records["RemoteFlag"] = remote[rows]
+        records["DataLen"] = dlc[rows]
+        records["Data"] = np.where(inside & ~remote[:, None], values, 0)[rows]
+        records["channel"] = channel[rows] - 1
+        records["frame_flags"] = np.where(direction[rows, 0] == ord("T"), CAPTURE_FLAG_TX, 0)
+        return records
+
+
+class AscWriter(_Writer):
+    """
+    Writer of Vector ASC logs with absolute hex timestamps, relative to
+    the first frame (or to `start_time`).
+    """
+
+    def __init__(self, file, start_time=None):
+        super().__init__(file)
+        self.start_time = start_time
+        self._started = False
+
+    def _begin(self, start_time):
+        # the header date has millisecond resolution
+        start_time = self.start_time = np.floor(start_time * 1000) / 1000
+        t = datetime.datetime.fromtimestamp(start_time)
+        date = f"{t:%a %b %d %I:%M:%S}.{t.microsecond // 1000:03d} {t:%p %Y}"
+        self._f.write((f"date {date}\nbase hex  timestamps absolute\ninternal events logged\n"
+                       f"// version 9.0.0\nBegin Triggerblock {date}\n"
+                       f"{0:>10.6f} Start of measurement\n").encode())
+        self._started = True
+
+    def _write(self, records):
+        if not self._started:
+            self._begin(self.start_time if self.start_time is not None else float(records["host_time"][0]))
+        n = len(records)
+        ext = records["ExternFlag"].astype(bool)
+        remote = records["RemoteFlag"].astype(bool)
+        dlc = np.minimum(records["DataLen"], 8)
+        tx = (records["frame_flags"] & CAPTURE_FLAG_TX).astype(bool)
+        id_chars = _digits(records["ID"], 8, 16)
+        id_keep = _significant(id_chars)
+        id_len = id_keep.sum(axis=1) + ext
+        data = records["Data"]
+        hex_data = np.stack([np.full(data.shape, 32, dtype=np.uint8), _HEX_UPPER[data >> 4], _HEX_UPPER[data & 15]],
+                            axis=2).reshape(n, 24)
+        channel = _digits(records["channel"].astype(np.uint64) + 1, 3)
+        columns = _fixed(np.maximum(records["host_time"] - self.start_time, 0), 6, 10) + [
+            (_const(" "), None),
+            (channel, _significant(channel)),
+            (_const("  "), None),
+            (id_chars, id_keep),
+            (_const("x"), ext[:, None]),
+            (np.full((1, 15), 32, dtype=np.uint8), np.arange(15) < (15 - id_len)[:, None]),
+            (_const(" "), None),
+            (np.where(tx[:, None], _const("Tx  "), _const("Rx  ")), None),
+            (_const(" "), None),
+            (np.where(remote[:, None], _const("r "), _const("d ")), None),
+            (_HEX_LOWER[dlc][:, None], None),
+            (hex_data, ~remote[:, None] & (np.arange(24) < 3 * dlc[:, None])),
+            (_const("\n"), None),
+        ]
+        self._f.write(_assemble(columns, len(records)))
+
+    def close(self):
+        if self._f.closed:
+            return
+        if not self._started:
+            self._begin(self.start_time if self.start_time is not None else time.time())
+        self._f.write(b"End TriggerBlock\n")
+        super().close()
+
+
+# --- BLF
+
+_BLF_FILE_HEADER = struct.Struct("<4sLBBBBBBBBQQLL8H8H")
+_BLF_FILE_HEADER_SIZE = 144
+_BLF_OBJ_BASE = struct.Struct("<4sHHLL")
+_BLF_CONTAINER = struct.Struct("<H6xL4x")
+_BLF_LOG_CONTAINER = 10
+_BLF_CAN_MESSAGE = 1
+_BLF_CAN_MESSAGE2 = 86
+_BLF_TIME_TEN_MICS = 1
+_BLF_TIME_ONE_NANS = 2
+_BLF_CAN_EXT = 0x80000000
+_BLF_DIR_TX = 0x01
+_BLF_REMOTE = 0x80
+_BLF_MAX_CONTAINER = 128 * 1024
+
+# a CAN_MESSAGE object with a version 1 object header
+_BLF_CAN_DTYPE = np.dtype([
+    ("signature", "S4"), ("header_size", "<u2"), ("header_version", "<u2"),
+    ("object_size", "<u4"), ("object_type", "<u4"),
+    ("flags", "<u4"), ("client_index", "<u2"), ("object_version", "<u2"), ("timestamp", "<u8"),
+    ("channel", "<u2"), ("msg_flags", "u1"), ("dlc", "u1"), ("id", "<u4"), ("data", "u1", (8,)),
+])
+
+
+def _systemtime(timestamp):
+    t = datetime.datetime.fromtimestamp(round(max(timestamp, 631152000), 3))
+    return (t.year, t.month, t.isoweekday() % 7, t.day, t.hour, t.minute, t.second, t.microsecond // 1000)
+
+
+def _from_systemtime(st):
+    try:
+        return datetime.datetime(st[0], st[1], st[3], st[4], st[5], st[6], st[7] * 1000).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def _le(arr, offsets, size):
+    """Little endian unsigned integers of `size` bytes at `offsets`."""
+    raw = arr[offsets[:, None] + np.arange(size)].astype(np.uint64)
+    return (raw << (np.arange(size, dtype=np.uint64) * np.uint64(8))).sum(axis=1)
+
+
+def _blf_objects(arr):
+    """
+    Offsets of the complete objects at the start of `arr`, and where the
+    incomplete tail begins. Runs of equally sized objects, the usual case,
+    are validated at once instead of walked object by object.
+    """
+    found = []
+    pos = 0
+    size = len(arr)
+    while pos + _BLF_OBJ_BASE.size <= size:
+        if arr[pos:pos + 4].tobytes() != b"LOBJ":
+            # objects are padded, the next one starts within a few bytes
+            nxt = arr[pos:pos + 8].tobytes().find(b"LOBJ")
+            if nxt < 0:
+                if pos + 8 <= size:
+                    raise ValueError("corrupt BLF object stream")
+                break
+            pos += nxt
+            continue
+        obj_size = int(_le(arr, np.array([pos + 8]), 4)[0])
+        if obj_size < _BLF_OBJ_BASE.size:
+            raise ValueError("corrupt BLF object stream")
+        if pos + obj_size > size:
+            break
+        stride = obj_size + obj_size % 4
+        n = min((size - pos - obj_size) // stride + 1, 1 << 14)
+        if n > 1:
+            offsets = pos + stride * np.arange(n)
+            same = ((_le(arr, offsets, 4) == 0x4a424f4c)  # b"LOBJ"
+                    & (_le(arr, offsets + 8, 4) == obj_size))
+            run = int(np.argmin(same)) if not same.all() else n
+            offsets = offsets[:max(run, 1)]
+        else:
+            offsets = np.array([pos])
+        found.append(offsets)
+        pos = int(offsets[-1]) + obj_size
+    return (np.concatenate(found) if found else np.zeros(0, dtype=np.int64)), pos
+
+
+class BlfReader(_Reader):
+    """Reader of Vector BLF logs (CAN_MESSAGE and CAN_MESSAGE2 objects)."""
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        super().__init__(file, chunk_size)
+        header = self._f.read(_BLF_FILE_HEADER.size)
+        fields = _BLF_FILE_HEADER.unpack(header)
+        if fields[0] != b"LOGG":
+            raise ValueError("not a BLF file")
+        self._f.read(fields[1] - _BLF_FILE_HEADER.size)
+        self.object_count = fields[12]
+        self.start_time = _from_systemtime(fields[14:22])
+        self.stop_time = _from_systemtime(fields[22:30])
+
+    def _top_level(self):
+        """Object stream of the file, containers decompressed."""
+        while True:
+            base = self._f.read(_BLF_OBJ_BASE.size)
+            if len(base) < _BLF_OBJ_BASE.size:
+                return
+            signature, _, _, obj_size, obj_type = _BLF_OBJ_BASE.unpack(base)
+            if signature != b"LOBJ":
+                raise ValueError("corrupt BLF file")
+            body = self._f.read(obj_size - _BLF_OBJ_BASE.size)
+            self._f.read(obj_size % 4)
+            if obj_type == _BLF_LOG_CONTAINER:
+                method, _ = _BLF_CONTAINER.unpack_from(body)
+                data = body[_BLF_CONTAINER.size:]
+                yield zlib.decompress(data) if method == 2 else data
+            else:
+                yield base + body + bytes(obj_size % 4)
+
+    def _batches(self):
+        pending = []
+        pending_size = 0
+        tail = b""
+        for data in self._top_level():
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size >= self.chunk_size:
+                records, tail = self._parse(tail + b"".join(pending))
+                pending, pending_size = [], 0
+                yield records
+        records, tail = self._parse(tail + b"".join(pending))
+        yield records
+
+    def _parse(self, data):
+        arr = np.frombuffer(data, dtype=np.uint8)
+        offsets, end = _blf_objects(arr)
+        obj_type = _le(arr, offsets + 12, 4)
+        offsets = offsets[(obj_type == _BLF_CAN_MESSAGE) | (obj_type == _BLF_CAN_MESSAGE2)]
+
+        header_size = _le(arr, offsets + 4, 2).astype(np.int64)
+        flags = _le(arr, offsets + 16, 4)
+        stamp = _le(arr, offsets + 24, 8).astype(np.float64)
+        scale = np.where(flags == _BLF_TIME_TEN_MICS, 1e-5, 1e-9)
+        body = offsets + header_size
+        channel = _le(arr, body, 2).astype(np.int64)
+        msg_flags = arr[body + 2]
+        can_id = _le(arr, body + 4, 4)
+
+        records = _new_records(len(offsets))
+        records["host_time"] = self.start_time + stamp * scale
+        records["ID"] = can_id & 0x1fffffff
+        records["ExternFlag"] = (can_id & _BLF_CAN_EXT) != 0
+        records["RemoteFlag"] = (msg_flags & _BLF_REMOTE) != 0
+        records["DataLen"] = np.minimum(arr[body + 3], 8)
+        records["Data"] = arr[body[:, None] + 8 + np.arange(8)]
+        records["channel"] = np.maximum(channel - 1, 0)
+        records["frame_flags"] = np.where(msg_flags & _BLF_DIR_TX, CAPTURE_FLAG_TX, 0)
+        return records, data[end:]
+
+
+class BlfWriter(_Writer):
+    """
+    Writer of Vector BLF logs: CAN_MESSAGE objects with nanosecond
+    timestamps, in zlib compressed containers.
+    """
+
+    def __init__(self, file, compression_level=6):
+        super().__init__(file)
+        self.compression_level = compression_level
+        self.start_time = None
+        self.stop_time = None
+        self.object_count = 0
+        self.uncompressed_size = _BLF_FILE_HEADER_SIZE
+        self._buffer = []
+        self._buffer_size = 0
+        self._write_header(0)
+
+    def _write_header(self, file_size):
+        header = _BLF_FILE_HEADER.pack(
+            b"LOGG", _BLF_FILE_HEADER_SIZE, 0, 0, 0, 0, 2, 6, 8, 1,
+            file_size, self.uncompressed_size, self.object_count, 0,
+            *_systemtime(self.start_time or 0), *_systemtime(self.stop_time or 0))
+        self._f.write(header + bytes(_BLF_FILE_HEADER_SIZE - len(header)))
+
+    def _write(self, records):
+        if self.start_time is None:
+            # SYSTEMTIME has millisecond resolution
+            self.start_time = np.floor(records["host_time"][0] * 1000) / 1000
+        self.stop_time = float(records["host_time"][-1])
+        objects = np.zeros(len(records), dtype=_BLF_CAN_DTYPE)
+        objects["signature"] = b"LOBJ"
+        objects["header_size"] = 32
+        objects["header_version"] = 1
+        objects["object_size"] = _BLF_CAN_DTYPE.itemsize
+        objects["object_type"] = _BLF_CAN_MESSAGE
+        objects["flags"] = _BLF_TIME_ONE_NANS
+        objects["timestamp"] = np.round(np.maximum(records["host_time"] - self.start_time, 0) * 1e9)
+        objects["channel"] = records["channel"].astype(np.uint16) + 1
+        objects["msg_flags"] = (np.where(records["frame_flags"] & CAPTURE_FLAG_TX, _BLF_DIR_TX, 0)
+                                | np.where(records["RemoteFlag"], _BLF_REMOTE, 0))
+        objects["dlc"] = records["DataLen"]
+        objects["id"] = records["ID"] | np.where(records["ExternFlag"], _BLF_CAN_EXT, 0).astype(np.uint32)
+        objects["data"] = records["Data"]
+        data = objects.tobytes()
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self.object_count += len(records)
+        if self._buffer_size >= _BLF_MAX_CONTAINER:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        data = b"".join(self._buffer)
+        self._buffer, self._buffer_size = [], 0
+        compressed = zlib.compress(data, self.compression_level)
+        obj_size = _BLF_OBJ_BASE.size + _BLF_CONTAINER.size + len(compressed)
+        self._f.write(_BLF_OBJ_BASE.pack(b"LOBJ", _BLF_OBJ_BASE.size, 1, obj_size, _BLF_LOG_CONTAINER))
+        self._f.write(_BLF_CONTAINER.pack(2, len(data)))
+        self._f.write(compressed)
+        self._f.write(bytes(obj_size % 4))
+        self.uncompressed_size += _BLF_OBJ_BASE.size + _BLF_CONTAINER.size + len(data)
+
+    def close(self):
+        if self._f.closed:
+            return
+        self._flush()
+        size = self._f.tell()
+        self._f.seek(0)
+        self._write_header(size)
+        super().close()
+
+
+# --- recordings of can_recorder
+
+class _RecordingReader(object):
+    def __init__(self, file, chunk_size=None):
+        from can_recorder import open_recording
+        self._recording = open_recording(file)
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        for records in self._recording:
+            self.frames += len(records)
+            yield records
+
+    def close(self):
+        self._recording.close()
+
+
+def _recording_writer(file):
+    from can_recorder import Recorder
+    return Recorder(file, rotate_bytes=None)
+
+
+READERS = {".log": CandumpReader, ".asc": AscReader, ".blf": BlfReader, ".vcz": _RecordingReader}
+WRITERS = {".log": CandumpWriter, ".asc": AscWriter, ".blf": BlfWriter, ".vcz": _recording_writer}
+
+
+def _format(filename, formats, fmt):
+    ext = "." + fmt if fmt else os.path.splitext(filename)[1].lower()
+    if ext not in formats:
+        raise ValueError(f"unknown log format {ext!r} of {filename}, expected one of {list(formats)}")
+    return formats[ext]
+
+
+def open_reader(filename, fmt=None, **kwargs):
+    """Reader of `filename`, format from its extension (.log, .asc, .blf, .vcz) or `fmt`."""
+    return _format(filename, READERS, fmt)(filename, **kwargs)
+
+
+def open_writer(filename, fmt=None, **kwargs):
+    """Writer of `filename`, format from its extension (.log, .asc, .blf, .vcz) or `fmt`."""
+    return _format(filename, WRITERS, fmt)(filename, **kwargs)
+
+
+def convert(source, destination, chunk_size=CHUNK_SIZE):
+    """Convert a log file, returns (frames, seconds)."""
+    start = time.perf_counter()
+    frames = 0
+    with open_reader(source, chunk_size=chunk_size) as reader, open_writer(destination) as writer:
+        for records in reader:
+            writer.write_records(records)
+            frames += len(records)
+    return frames, time.perf_counter() - start
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description="Convert candump (.log), ASC, BLF and .vcz CAN logs.")
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="bytes read at a time")
+    opts = parser.parse_args(args)
+
+    frames, elapsed = convert(opts.source, opts.destination, opts.chunk_size)
+    size = os.path.getsize(opts.source) / 1e6
+    elapsed = max(elapsed, 1e-9)
+    print(f"{frames} frames, {size:.1f} MB in {elapsed:.2f} s: "
+          f"{frames / elapsed:.0f} frames/s, {size / elapsed:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
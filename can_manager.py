@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Multi-device, multi-channel manager.
+
+`CANManager` brings up several ControlCAN devices in parallel, runs one
+reader thread per device and exposes all channels as a single stream of
+capture records (can_capture.CAPTURE_DTYPE) ordered by time, with device
+and channel tags:
+
+    with CANManager(library, devices=(0, 1), baud=500) as mgr:
+        while True:
+            records = mgr.read(timeout=1)
+            ...
+
+Per-channel batches are merged with a k-way heap merge which moves whole
+runs of frames at once. A frame is released once every channel has either
+delivered a later frame or been silent for `lateness` seconds.
+
+With `supervise`, every device gets a can_bringup.DeviceSupervisor which
+reconnects it when it disappears; its reader pauses meanwhile.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import heapq
+import logging
+import threading
+import time
+
+import numpy as np
+
+from controlcan import ControlCAN, VCI_INIT_CONFIG
+from can_bringup import ChannelSetup, DeviceSetup, DeviceSupervisor
+from can_capture import CAPTURE_DTYPE, to_records
+from can_receiver import AdaptiveReceiver
+from can_timestamp import TimestampReconstructor
+
+__all__ = ["CANManager", "merge_batches"]
+
+log = logging.getLogger("controlcan.manager")
+
+
+def merge_batches(batches):
+    """
+    k-way merge of record arrays each sorted by host_time. Runs of frames
+    are moved with one slice per heap pop instead of one pop per frame.
+    """
+    heap = [(b["host_time"][0], i) for i, b in enumerate(batches) if len(b)]
+    heapq.heapify(heap)
+    pos = [0] * len(batches)
+    runs = []
+    while heap:
+        _, i = heapq.heappop(heap)
+        times = batches[i]["host_time"]
+        limit = heap[0][0] if heap else np.inf
+        end = pos[i] + int(np.searchsorted(times[pos[i]:], limit, "right"))
+        runs.append(batches[i][pos[i]:end])
+        pos[i] = end
+        if end < len(times):
+            heapq.heappush(heap, (times[end], i))
+    if not runs:
+        return np.zeros(0, dtype=CAPTURE_DTYPE).view(np.recarray)
+    return np.concatenate(runs).view(np.recarray)
+
+
+class _Stream(object):
+    """Pending records of one channel."""
+
+    def __init__(self, device_index, channel):
+        self.device_index = device_index
+        self.channel = channel
+        self.pending = deque()
+        self.last_time = -np.inf
+
+
+class CANManager(object):
+    """
+    Manager of `devices` (device indexes) x `channels` of one library.
+
+    config: VCI_INIT_CONFIG used for every channel, built from the other
+        keyword arguments (baud, ...) when not given
+    lateness: how long a silent channel may hold back the merged stream
+    receiver_args: keyword arguments of the AdaptiveReceiver of each channel
+    supervise: reconnect devices which disappear
+    """
+
+    def __init__(self, library, devices=(0,), channels=(0, 1), config=None,
+                 device_type=ControlCAN.TYPE_VCI_USBCAN2, lateness=0.01,
+                 receiver_args=None, supervise=False, **config_args):
+        self.devices = [ControlCAN(library, device_type, index) for index in devices]
+        self.channels = tuple(channels)
+        self.config = config if config is not None else VCI_INIT_CONFIG(**config_args)
+        self.lateness = lateness
+        self.receiver_args = receiver_args or {}
+        self._streams = {(dev.device_index, ch): _Stream(dev.device_index, ch)
+                         for dev in self.devices for ch in self.channels}
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._readers = []
+        # one per channel: the monotonic clamp must not order frames across channels
+        self._timebases = {key: TimestampReconstructor() for key in self._streams}
+        self.setup = DeviceSetup([ChannelSetup(ch, config=self.config) for ch in self.channels])
+        self.supervisors = {}
+        if supervise:
+            for dev in self.devices:
+                sup = self.supervisors[dev.device_index] = DeviceSupervisor(dev, self.setup)
+                # the device counter restarts with the device
+                for ch in self.channels:
+                    sup.on_up.append(self._timebases[dev.device_index, ch].reset)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        """Bring up all devices in parallel and start one reader per device."""
+        with ThreadPoolExecutor(max_workers=len(self.devices)) as pool:
+            list(pool.map(self.setup.apply, self.devices))
+        for sup in self.supervisors.values():
+            sup.start(bring_up=False)
+        self._stop.clear()
+        for dev in self.devices:
+            t = threading.Thread(target=self._read_device, args=(dev,),
+                                 name=f"CANManager-{dev.device_index}", daemon=True)
+            t.start()
+            self._readers.append(t)
+
+    def close(self):
+        self._stop.set()
+        for t in self._readers:
+            t.join()
+        self._readers.clear()
+        for sup in self.supervisors.values():
+            sup.stop()
+        for dev in self.devices:
+            dev.CloseDevice(mute=True)
+
+    def _device_time(self, dev, channel, frames):
+        """Wall clock time of frames of `channel` from the device TimeStamp."""
+        timebase = self._timebases[dev.device_index, channel]
+        return timebase.wall(timebase.update(frames["TimeStamp"]))
+
+    def _read_device(self, dev):
+        receivers = [AdaptiveReceiver(dev, ch, **self.receiver_args) for ch in self.channels]
+        interval = receivers[0].min_interval
+        sup = self.supervisors.get(dev.device_index)
+        while not self._stop.is_set():
+            if sup is not None and not sup.ready.is_set():
+                sup.ready.wait(0.1)
+                continue
+            batches = []
+            for receiver in receivers:
+                frames = receiver.poll()
+                if len(frames):
+                    records = to_records(frames, receiver.channel, dev.device_index,
+                                         self._device_time(dev, receiver.channel, frames))
+                    batches.append((receiver.channel, records))
+            if batches:
+                with self._cond:
+                    for ch, records in batches:
+                        stream = self._streams[dev.device_index, ch]
+                        stream.pending.append(records)
+                        stream.last_time = records["host_time"][-1]
+                    self._cond.notify_all()
+                interval = receivers[0].min_interval
+            else:
+                self._stop.wait(interval)
+                interval = min(interval * 2, receivers[0].max_interval)
+
+    def _take_ready(self):
+        """Cut every stream at the watermark, returns the ready batches."""
+        now = time.time()
+        watermark = min(max(s.last_time, now - self.lateness) for s in self._streams.values())
+        ready = []
+        for stream in self._streams.values():
+            while stream.pending:
+                records = stream.pending[0]
+                end = int(np.searchsorted(records["host_time"], watermark, "right"))
+                if end == len(records):
+                    ready.append(stream.pending.popleft())
+                    continue
+                if end:
+                    ready.append(records[:end])
+                    stream.pending[0] = records[end:]
+                break
+        return ready
+
+    def read(self, timeout=None):
+        """
+        Return the merged records released so far, waiting up to `timeout`
+        seconds for at least one. May return an empty array.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                ready = self._take_ready()
+                if ready:
+                    return merge_batches(ready)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return merge_batches(ready)
+                # silent channels release the others after `lateness`
+                self._cond.wait(self.lateness if remaining is None else min(remaining, self.lateness))
+
+    def __iter__(self):
+        while not self._stop.is_set():
+            records = self.read(timeout=0.1)
+            if len(records):
+                yield records
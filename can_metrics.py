@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Runtime metrics of ControlCAN devices.
+
+`MeteredControlCAN` is a drop-in ControlCAN which counts, per channel and
+direction, frames and payload bytes, short (nothing accepted) and partial
+transmits and errors, and keeps histograms of the VCI_Transmit/VCI_Receive
+call latency and of the GetReceiveNum backlog samples. Channels
+initialized through it also report their bus load, from the exact on-wire
+length of the frames sent and received (see can_busload; in loopback mode
+own frames count twice). Metrics are exposed
+as a snapshot dict and in the Prometheus text exposition format:
+
+    dev = MeteredControlCAN(library)
+    ...
+    dev.snapshot()
+    prometheus_text(dev)
+
+Counters are updated without locking, a snapshot taken while I/O is
+running may miss the calls in flight.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from bisect import bisect_left
+from ctypes import c_char, c_void_p, cast, addressof, sizeof
+import time
+
+import numpy as np
+
+from can_busload import BusLoadMeter
+from controlcan import ControlCAN, CANError, VCI_CAN_OBJ, VCI_CAN_OBJ_DTYPE, VCI_RET_OK, VCI_RET_NODEVICE
+
+__all__ = ["Histogram", "ChannelMetrics", "MeteredControlCAN", "prometheus_text"]
+
+LATENCY_BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+BACKLOG_BUCKETS = (0, 1, 10, 50, 100, 250, 500, 1000, 1500, 2000, 5000)
+
+
+class Histogram(object):
+    """Fixed bucket histogram, buckets are upper bounds (le)."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile `q`."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            total += n
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip(self.buckets + (float("inf"),), self.counts)),
+        }
+
+
+class ChannelMetrics(object):
+    def __init__(self):
+        self.frames = {"tx": 0, "rx": 0}
+        self.bytes = {"tx": 0, "rx": 0}
+        self.short_transmits = 0
+        self.partial_transmits = 0
+        self.errors = 0
+        self.latency = {"VCI_Transmit": Histogram(LATENCY_BUCKETS),
+                        "VCI_Receive": Histogram(LATENCY_BUCKETS)}
+        self.backlog = Histogram(BACKLOG_BUCKETS)
+        self.backlog_last = 0
+        self.backlog_peak = 0
+        self.bus = None
+        self._rate_mark = (time.monotonic(), 0, 0)
+
+    def snapshot(self):
+        now = time.monotonic()
+        then, tx, rx = self._rate_mark
+        elapsed = max(now - then, 1e-9)
+        self._rate_mark = (now, self.frames["tx"], self.frames["rx"])
+        return {
+            "frames": dict(self.frames),
+            "bytes": dict(self.bytes),
+            "tx_fps": (self.frames["tx"] - tx) / elapsed,
+            "rx_fps": (self.frames["rx"] - rx) / elapsed,
+            "short_transmits": self.short_transmits,
+            "partial_transmits": self.partial_transmits,
+            "errors": self.errors,
+            "bus_load": self.bus.load if self.bus is not None else None,
+            "latency": {name: h.snapshot() for name, h in self.latency.items()},
+            "backlog": {"last": self.backlog_last, "peak": self.backlog_peak,
+                        **self.backlog.snapshot()},
+        }
+
+
+def _frames_at(p, count):
+    """numpy view of `count` frames at pointer (or byref()) `p`."""
+    try:
+        address = cast(p, c_void_p).value
+    except TypeError:
+        address = addressof(p._obj)  # byref() argument
+    raw = (c_char * (count * sizeof(VCI_CAN_OBJ))).from_address(address)
+    return np.frombuffer(raw, dtype=VCI_CAN_OBJ_DTYPE)
+
+
+def _count_frames(metrics, direction, p, count):
+    frames = _frames_at(p, count)
+    metrics.frames[direction] += count
+    metrics.bytes[direction] += int(frames["DataLen"].sum(dtype=np.int64))
+    if metrics.bus is not None:
+        metrics.bus.add(frames)
+
+
+class MeteredControlCAN(ControlCAN):
+    """ControlCAN recording per-channel metrics of its I/O calls."""
+
+    def __init__(self, *args, clock=time.perf_counter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.clock = clock
+        self.channels = {}
+
+    def channel_metrics(self, CANInd):
+        metrics = self.channels.get(CANInd)
+        if metrics is None:
+            metrics = self.channels[CANInd] = ChannelMetrics()
+        return metrics
+
+    def InitCAN(self, CANInd, pInitConfig, mute=False):
+        ret = super().InitCAN(CANInd, pInitConfig, mute)
+        if ret == VCI_RET_OK:
+            self.channel_metrics(CANInd).bus = BusLoadMeter(self.bitrates[CANInd], clock=self.clock)
+        return ret
+
+    def Transmit(self, CANInd, pSend, Len, mute=False):
+        metrics = self.channel_metrics(CANInd)
+        start = self.clock()
+        try:
+            ret = super().Transmit(CANInd, pSend, Len, mute)
+        except CANError:
+            metrics.errors += 1
+            raise
+        finally:
+            metrics.latency["VCI_Transmit"].observe(self.clock() - start)
+        if ret == VCI_RET_NODEVICE:
+            metrics.errors += 1
+        elif ret <= 0:
+            metrics.short_transmits += 1
+        else:
+            if ret < Len:
+                metrics.partial_transmits += 1
+            _count_frames(metrics, "tx", pSend, ret)
+        return ret
+
+    def Receive(self, CANInd, pReceive, Len, mute=False, WaitTime=0):
+        metrics = self.channel_metrics(CANInd)
+        start = self.clock()
+        try:
+            ret = super().Receive(CANInd, pReceive, Len, mute, WaitTime)
+        except CANError:
+            metrics.errors += 1
+            raise
+        finally:
+            metrics.latency["VCI_Receive"].observe(self.clock() - start)
+        if ret == VCI_RET_NODEVICE:
+            metrics.errors += 1
+        elif ret > 0:
+            _count_frames(metrics, "rx", pReceive, ret)
+        return ret
+
+    def GetReceiveNum(self, CANInd, mute=False):
+        ret = super().GetReceiveNum(CANInd, mute)
+        if ret >= 0:
+            metrics = self.channel_metrics(CANInd)
+            metrics.backlog.observe(ret)
+            metrics.backlog_last = ret
+            if ret > metrics.backlog_peak:
+                metrics.backlog_peak = ret
+        return ret
+
+    def snapshot(self):
+        """Metrics of every channel used so far, rates since the last snapshot."""
+        return {
+            "device_type": self.device_type,
+            "device_index": self.device_index,
+            "channels": {ch: m.snapshot() for ch, m in sorted(self.channels.items())},
+        }
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def _histogram_lines(name, hist, **labels):
+    lines = []
+    total = 0
+    for bound, n in zip(hist.buckets + (float("inf"),), hist.counts):
+        total += n
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{name}_bucket{_labels(**labels, le=le)} {total}")
+    lines.append(f"{name}_sum{_labels(**labels)} {hist.sum}")
+    lines.append(f"{name}_count{_labels(**labels)} {hist.count}")
+    return lines
+
+
+def prometheus_text(*devices, supervisors=()):
+    """
+    Metrics of MeteredControlCAN `devices`, and of
+    can_bringup.DeviceSupervisor `supervisors`, in Prometheus text format.
+    """
+    metrics = {
+        "controlcan_frames_total": ("counter", "Frames transferred.", []),
+        "controlcan_bytes_total": ("counter", "Payload bytes transferred.", []),
+        "controlcan_transmit_short_total": ("counter", "VCI_Transmit calls accepting no frame.", []),
+        "controlcan_transmit_partial_total": ("counter", "VCI_Transmit calls accepting part of the frames.", []),
+        "controlcan_errors_total": ("counter", "Failed driver calls.", []),
+        "controlcan_call_duration_seconds": ("histogram", "Driver call latency.", []),
+        "controlcan_receive_backlog_frames": ("histogram", "GetReceiveNum samples.", []),
+        "controlcan_receive_backlog_peak_frames": ("gauge", "Largest GetReceiveNum sample.", []),
+        "controlcan_bus_load_ratio": ("gauge", "Share of the bus time used over the last second.", []),
+        "controlcan_device_up": ("gauge", "Supervised device usable.", []),
+        "controlcan_disconnects_total": ("counter", "Device losses detected.", []),
+        "controlcan_reconnect_attempts_total": ("counter", "Reconnect attempts.", []),
+        "controlcan_recovery_seconds": ("histogram", "Time from device loss to usable again.", []),
+    }
+    for dev in devices:
+        for ch, m in sorted(dev.channels.items()):
+            base = {"device": dev.device_index, "channel": ch}
+            for direction in ("tx", "rx"):
+                labels = _labels(**base, direction=direction)
+                metrics["controlcan_frames_total"][2].append(
+                    f"controlcan_frames_total{labels} {m.frames[direction]}")
+                metrics["controlcan_bytes_total"][2].append(
+                    f"controlcan_bytes_total{labels} {m.bytes[direction]}")
+            labels = _labels(**base)
+            metrics["controlcan_transmit_short_total"][2].append(
+                f"controlcan_transmit_short_total{labels} {m.short_transmits}")
+            metrics["controlcan_transmit_partial_total"][2].append(
+                f"controlcan_transmit_partial_total{labels} {m.partial_transmits}")
+            metrics["controlcan_errors_total"][2].append(f"controlcan_errors_total{labels} {m.errors}")
+            for call, hist in m.latency.items():
+                metrics["controlcan_call_duration_seconds"][2].extend(
+                    _histogram_lines("controlcan_call_duration_seconds", hist, **base, call=call))
+            metrics["controlcan_receive_backlog_frames"][2].extend(
+                _histogram_lines("controlcan_receive_backlog_frames", m.backlog, **base))
+            metrics["controlcan_receive_backlog_peak_frames"][2].append(
+                f"controlcan_receive_backlog_peak_frames{labels} {m.backlog_peak}")
+            if m.bus is not None:
+                metrics["controlcan_bus_load_ratio"][2].append(f"controlcan_bus_load_ratio{labels} {m.bus.load}")
+
+    for sup in supervisors:
+        labels = _labels(device=sup.device.device_index)
+        metrics["controlcan_device_up"][2].append(f"controlcan_device_up{labels} {int(sup.ready.is_set())}")
+        metrics["controlcan_disconnects_total"][2].append(f"controlcan_disconnects_total{labels} {sup.disconnects}")
+        metrics["controlcan_reconnect_attempts_total"][2].append(
+            f"controlcan_reconnect_attempts_total{labels} {sup.attempts}")
+        metrics["controlcan_recovery_seconds"][2].extend(
+            _histogram_lines("controlcan_recovery_seconds", sup.recovery, device=sup.device.device_index))
+
+    lines = []
+    for name, (kind, help_text, samples) in metrics.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
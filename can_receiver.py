@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Adaptive receive loop for ControlCAN.
+
+Instead of polling at a fixed interval, `AdaptiveReceiver` sizes every read
+with GetReceiveNum, polls again immediately while frames keep coming and
+backs off exponentially once the bus goes idle, so latency stays low under
+traffic without spinning a core when nothing is received.
+
+`OverflowAwareReceiver` additionally watches VCI_ReadErrInfo and
+VCI_ReadCANStatus: lost frames (FIFO or driver buffer overflow), error
+passive and bus-off are reported as timestamped `LossEvent`s, and an
+overflow makes the receiver read more per call and poll more often.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from collections import deque, namedtuple
+import logging
+import time
+
+import numpy as np
+
+from controlcan import (VCI_CAN_OBJ_DTYPE, VCI_ERR_INFO, VCI_CAN_STATUS, VCI_RET_OK,
+                        ERR_CAN_OVERFLOW, ERR_CAN_PASSIVE, ERR_BUFFEROVERFLOW)
+
+__all__ = ["AdaptiveReceiver", "OverflowAwareReceiver", "LossEvent"]
+
+log = logging.getLogger("controlcan.receiver")
+
+
+class AdaptiveReceiver(object):
+    """
+    Receive loop of one channel.
+
+    buf_size: max frames read per Receive call
+    min_interval, max_interval: bounds of the idle backoff, in seconds
+    wait_time: driver side WaitTime (ms) used instead of sleeping when the
+        driver honors it
+    fifo_size: capacity of the driver receive buffer, used to report fill
+    frame_filter: optional can_filter.AcceptanceFilter applied to every batch
+
+    Batches returned by `poll()` are views over an internal buffer, they
+    stay valid until the next `poll()`.
+    """
+
+    def __init__(self, device, channel, buf_size=5000, min_interval=50e-6,
+                 max_interval=500e-6, wait_time=0, fifo_size=2000, frame_filter=None):
+        self.device = device
+        self.channel = channel
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.wait_time = wait_time
+        self.fifo_size = fifo_size
+        self.frame_filter = frame_filter
+        self.buffer = np.zeros(buf_size, dtype=VCI_CAN_OBJ_DTYPE)
+        self.interval = min_interval
+        self.backlog = 0
+
+        self.polls = 0
+        self.idle_polls = 0
+        self.frames = 0
+        self.peak_backlog = 0
+
+    @property
+    def stats(self):
+        return {
+            "polls": self.polls,
+            "idle_polls": self.idle_polls,
+            "frames": self.frames,
+            "peak_backlog": self.peak_backlog,
+            "peak_fill": self.peak_backlog / self.fifo_size,
+            "interval": self.interval,
+        }
+
+    def poll(self):
+        """
+        Read the frames currently waiting in the driver, without sleeping.
+        Returns a (possibly empty) record array.
+        """
+        self.polls += 1
+        backlog = self.backlog = self.device.GetReceiveNum(self.channel, mute=True)
+        if backlog > self.peak_backlog:
+            self.peak_backlog = backlog
+            if backlog >= self.fifo_size:
+                log.warning(f"CAN{self.channel} driver buffer full ({backlog} frames)")
+        if backlog <= 0:
+            if not self.wait_time:
+                self.idle_polls += 1
+                return self.buffer[:0].view(np.recarray)
+            # let the driver block until something arrives
+            backlog = len(self.buffer)
+        frames = self.device.receive_into(self.channel, self.buffer[:min(backlog, len(self.buffer))],
+                                          mute=True, WaitTime=self.wait_time)
+        if len(frames):
+            self.frames += len(frames)
+            if self.frame_filter is not None:
+                frames = self.frame_filter.apply(frames)
+        else:
+            self.idle_polls += 1
+        return frames
+
+    def wait(self, timeout=None):
+        """
+        Poll until at least one frame is received or `timeout` seconds have
+        elapsed, backing off between idle polls. Returns the batch.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            frames = self.poll()
+            if len(frames):
+                self.interval = self.min_interval
+                return frames
+            if deadline is not None and time.perf_counter() >= deadline:
+                return frames
+            if not self.wait_time:
+                time.sleep(self.interval)
+                self.interval = min(self.interval * 2, self.max_interval)
+
+    def run(self, callback, event_stop, ready=None):
+        """
+        Call `callback(frames)` with every batch until `event_stop` is set.
+        With a `ready` event (e.g. DeviceSupervisor.ready), reading pauses
+        while it is cleared.
+        """
+        while not event_stop.is_set():
+            if ready is not None and not ready.is_set():
+                ready.wait(0.1)
+                continue
+            frames = self.wait(timeout=0.1)
+            if len(frames):
+                callback(frames)
+
+
+# kind: "overflow", "error_passive" or "bus_off"
+# time: host wall clock, device_time: TimeStamp of the last frame read
+#   before detection (frames were lost after it)
+LossEvent = namedtuple("LossEvent", "time device_time channel kind err_code backlog rec tec")
+
+
+class OverflowAwareReceiver(AdaptiveReceiver):
+    """
+    AdaptiveReceiver reacting to frame loss and bus errors.
+
+    The error state is read every `check_interval` seconds, and right away
+    when the backlog reaches `high_water` of `fifo_size`. On overflow the
+    read buffer doubles (up to `max_buf_size`) and `max_interval` halves
+    (down to `min_interval`).
+
+    max_buf_size: upper bound of the read buffer growth
+    check_interval: max time between two error state reads, in seconds
+    high_water: backlog fraction of fifo_size triggering an error state read
+    restart_bus_off: restart (ResetCAN/StartCAN) a channel found bus-off
+    on_event: optional callback(LossEvent), called from the receive thread
+    max_events: number of recent events kept in `events`
+    """
+
+    def __init__(self, device, channel, max_buf_size=50000, check_interval=0.1, high_water=0.5,
+                 restart_bus_off=False, on_event=None, max_events=1000, **kwargs):
+        super().__init__(device, channel, **kwargs)
+        self.max_buf_size = max_buf_size
+        self.check_interval = check_interval
+        self.high_water = high_water
+        self.restart_bus_off = restart_bus_off
+        self.on_event = on_event
+        self.events = deque(maxlen=max_events)
+        self._err_info = VCI_ERR_INFO()
+        self._status = VCI_CAN_STATUS()
+        self._next_check = 0.0
+        self._device_time = None
+        self._passive = False
+        self._bus_off = False
+
+        self.overflows = 0
+        self.bus_offs = 0
+
+    @property
+    def stats(self):
+        return {
+            **super().stats,
+            "buf_size": len(self.buffer),
+            "max_interval": self.max_interval,
+            "overflows": self.overflows,
+            "bus_offs": self.bus_offs,
+            "error_passive": self._passive,
+            "bus_off": self._bus_off,
+        }
+
+    def poll(self):
+        frames = super().poll()
+        if len(frames):
+            self._device_time = int(frames["TimeStamp"][-1])
+        now = time.monotonic()
+        if now >= self._next_check or self.backlog >= self.high_water * self.fifo_size:
+            self._next_check = now + self.check_interval
+            self.check()
+        return frames
+
+    def check(self):
+        """Read the error state of the channel, returns the new events."""
+        if self.device.ReadErrInfo(self.channel, self._err_info, mute=True) != VCI_RET_OK:
+            return []
+        if self.device.ReadCANStatus(self.channel, self._status, mute=True) != VCI_RET_OK:
+            return []
+        code = self._err_info.ErrCode
+        status = self._status
+        events = []
+        if code & (ERR_CAN_OVERFLOW | ERR_BUFFEROVERFLOW):
+            self.overflows += 1
+            events.append(self._event("overflow", code))
+            self._adapt()
+        passive = bool(code & ERR_CAN_PASSIVE) or status.error_passive
+        if passive and not self._passive:
+            events.append(self._event("error_passive", code))
+        self._passive = passive
+        # reported once per bus-off, not on every check while it lasts
+        bus_off = bool(status.bus_off)
+        if bus_off and not self._bus_off:
+            self.bus_offs += 1
+            events.append(self._event("bus_off", code))
+            if self.restart_bus_off:
+                log.warning(f"CAN{self.channel} bus-off, restarting")
+                self.device.ResetCAN(self.channel, mute=True)
+                self.device.StartCAN(self.channel, mute=True)
+        self._bus_off = bus_off
+        for event in events:
+            self.events.append(event)
+            if self.on_event is not None:
+                self.on_event(event)
+        return events
+
+    def _event(self, kind, code):
+        event = LossEvent(time.time(), self._device_time, self.channel, kind, code,
+                          self.backlog, self._status.regRECounter, self._status.regTECounter)
+        log.warning(f"CAN{self.channel} {kind}: err_code 0x{code:04x}, backlog {self.backlog}, "
+                    f"REC {event.rec}, TEC {event.tec}, last device timestamp {self._device_time}")
+        return event
+
+    def _adapt(self):
+        size = min(2 * len(self.buffer), self.max_buf_size)
+        if size > len(self.buffer):
+            self.buffer = np.zeros(size, dtype=VCI_CAN_OBJ_DTYPE)
+        self.max_interval = max(self.max_interval / 2, self.min_interval)
+        self.interval = self.min_interval
+        log.info(f"CAN{self.channel} read buffer {len(self.buffer)} frames, "
+                 f"max poll interval {self.max_interval * 1e6:.0f} us")
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Rotating compressed capture recorder.
+
+`Recorder` takes received batches from the receive loop without blocking
+on disk: batches are queued, and a background thread groups them into
+blocks of capture records (can_capture.CAPTURE_DTYPE), compresses every
+block with gzip or lzma and appends it to the current file, which is
+rotated by size or age:
+
+    with Recorder("logs/can-{index:04d}.vcz", rotate_bytes=64 << 20) as rec:
+        AdaptiveReceiver(dev, 0).run(rec.write, stop)
+
+Memory is bounded by `max_backlog` queued records: past it, `write()` waits
+for the writer (no frame is dropped); `backlog` and `stats` tell how far
+behind the writer is.
+
+File format:
+
+    file header   64 bytes: magic, version, record size, codec, start time
+    block         32 byte header (magic, compressed size, record count,
+                  first and last host_time) + compressed records
+    ...
+    index         one BLOCK_INDEX_DTYPE entry per block
+    trailer       24 bytes: magic, index offset, block count
+
+The index lets `open_recording()` seek to a block by record number or
+time without decompressing the others. A file left without index by an
+interrupted recording is indexed by walking the block headers.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from collections import deque
+import datetime
+import gzip
+import logging
+import lzma
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from can_capture import CAPTURE_DTYPE, to_records
+
+__all__ = ["Recorder", "Recording", "open_recording", "BLOCK_INDEX_DTYPE"]
+
+log = logging.getLogger("controlcan.recorder")
+
+RECORDING_MAGIC = b"VCICAPZ\x01"
+RECORDING_VERSION = 1
+BLOCK_MAGIC = b"BLK1"
+INDEX_MAGIC = b"VCIIDX\x01\x00"
+
+_FILE_HEADER = struct.Struct("<8sHHB3xd40x")
+_BLOCK_HEADER = struct.Struct("<4sII4xdd")
+_TRAILER = struct.Struct("<8sQQ")
+
+CODECS = {
+    "gzip": (1, lambda data, level: gzip.compress(data, 6 if level is None else level), gzip.decompress),
+    "lzma": (2, lambda data, level: lzma.compress(data, preset=1 if level is None else level), lzma.decompress),
+}
+_CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+BLOCK_INDEX_DTYPE = np.dtype([
+    ("offset", "<u8"),          # file offset of the block header
+    ("size", "<u4"),            # compressed size
+    ("count", "<u4"),           # records in the block
+    ("first_record", "<u8"),    # number of records in the blocks before
+    ("first_time", "<f8"),
+    ("last_time", "<f8"),
+])
+
+
+class _File(object):
+    """One recording file being written."""
+
+    def __init__(self, filename, codec_id):
+        self.filename = filename
+        self.start = time.monotonic()
+        self._f = open(filename, "wb")
+        self._f.write(_FILE_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, CAPTURE_DTYPE.itemsize,
+                                        codec_id, time.time()))
+        self.size = _FILE_HEADER.size
+        self.records = 0
+        self.index = []
+
+    def write_block(self, payload, records):
+        times = records["host_time"]
+        header = _BLOCK_HEADER.pack(BLOCK_MAGIC, len(payload), len(records), times.min(), times.max())
+        self.index.append((self.size, len(payload), len(records), self.records, times.min(), times.max()))
+        self._f.write(header)
+        self._f.write(payload)
+        self._f.flush()
+        self.size += len(header) + len(payload)
+        self.records += len(records)
+
+    def close(self):
+        index = np.array(self.index, dtype=BLOCK_INDEX_DTYPE)
+        self._f.write(index.tobytes())
+        self._f.write(_TRAILER.pack(INDEX_MAGIC, self.size, len(index)))
+        self._f.close()
+
+
+class Recorder(object):
+    """
+    Background recorder of capture records into rotating compressed files.
+
+    pattern: file name, formatted with `index` (file number) and `time`
+        (datetime of the file start), e.g. "can-{time:%Y%m%d-%H%M%S}.vcz"
+    codec: "gzip" or "lzma", `level` its compression level
+    block_records, block_interval: a block is written once it holds
+        `block_records` records or its oldest record waited `block_interval`
+        seconds
+    rotate_bytes, rotate_interval: start a new file once the current one
+        exceeds this size (bytes) or age (seconds), None to disable
+    max_backlog: queued records past which write() waits for the writer
+    """
+
+    def __init__(self, pattern, codec="gzip", level=None, block_records=16384, block_interval=1.0,
+                 rotate_bytes=64 << 20, rotate_interval=None, max_backlog=1 << 20):
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec {codec!r}, expected one of {list(CODECS)}")
+        self.pattern = pattern
+        self.codec = codec
+        self.level = level
+        self.block_records = block_records
+        self.block_interval = block_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.max_backlog = max_backlog
+        self.files = []
+
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._drained = threading.Event()
+        self._stop = threading.Event()
+        self._error = None
+        self._file = None
+
+        # written by the producer only, resp. by the writer only
+        self.queued = 0
+        self.written = 0
+        self.blocks = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.waits = 0
+
+        self._thread = threading.Thread(target=self._run, name="Recorder", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def backlog(self):
+        """Records accepted by write() and not yet on disk."""
+        return self.queued - self.written
+
+    def write(self, frames, channel=0, device=0, host_time=None, flags=0):
+        """Queue a batch of driver frames (VCI_CAN_OBJ_DTYPE)."""
+        self._put(to_records(frames, channel, device, host_time, flags))
+
+    def write_records(self, records):
+        """Queue capture records (CAPTURE_DTYPE), copied."""
+        self._put(np.array(records, dtype=CAPTURE_DTYPE))
+
+    def _put(self, records):
+        if self._error is not None:
+            raise self._error
+        if not len(records):
+            return
+        while self.backlog >= self.max_backlog and self._thread.is_alive():
+            self.waits += 1
+            self._drained.clear()
+            self._drained.wait(0.01)
+        self._queue.append(records)
+        self.queued += len(records)
+        if self.backlog >= self.block_records:
+            self._wakeup.set()
+
+    @property
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "written": self.written,
+            "backlog": self.backlog,
+            "blocks": self.blocks,
+            "ratio": self.bytes_out / self.bytes_in if self.bytes_in else 0.0,
+            "bytes_written": self.bytes_out,
+            "waits": self.waits,
+            "files": list(self.files),
+        }
+
+    def close(self):
+        """Write the queued records, the index of the last file and stop."""
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            pending = []
+            count = 0
+            oldest = None
+            while True:
+                stopping = self._stop.is_set()
+                while self._queue:
+                    records = self._queue.popleft()
+                    if oldest is None:
+                        oldest = time.monotonic()
+                    pending.append(records)
+                    count += len(records)
+                    if count >= self.block_records:
+                        self._write_block(np.concatenate(pending, dtype=CAPTURE_DTYPE))
+                        pending, count, oldest = [], 0, None
+                if pending and (stopping or time.monotonic() - oldest >= self.block_interval):
+                    self._write_block(np.concatenate(pending, dtype=CAPTURE_DTYPE))
+                    pending, count, oldest = [], 0, None
+                if stopping and not self._queue:
+                    break
+                self._wakeup.wait(self.block_interval / 4)
+                self._wakeup.clear()
+        except Exception as e:
+            log.exception("recorder stopped")
+            self._error = e
+        finally:
+            self._drained.set()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write_block(self, records):
+        self._rotate()
+        data = records.tobytes()
+        # zlib and lzma release the GIL while compressing
+        payload = CODECS[self.codec][1](data, self.level)
+        self._file.write_block(payload, records)
+        self.blocks += 1
+        self.bytes_in += len(data)
+        self.bytes_out += _BLOCK_HEADER.size + len(payload)
+        self.written += len(records)
+        self._drained.set()
+
+    def _rotate(self):
+        f = self._file
+        if f is not None:
+            too_big = self.rotate_bytes is not None and f.size >= self.rotate_bytes
+            too_old = self.rotate_interval is not None and time.monotonic() - f.start >= self.rotate_interval
+            if not (too_big or too_old):
+                return
+            f.close()
+            log.info(f"closed {f.filename}: {f.records} records, {f.size} bytes")
+        filename = self.pattern.format(index=len(self.files), time=datetime.datetime.now())
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = _File(filename, CODECS[self.codec][0])
+        self.files.append(filename)
+
+
+class Recording(object):
+    """
+    Reader of a recording file, see open_recording(). Blocks are
+    decompressed on demand.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._f = open(filename, "rb")
+        magic, version, record_size, codec_id, self.start_time = _FILE_HEADER.unpack(
+            self._f.read(_FILE_HEADER.size))
+        if magic != RECORDING_MAGIC:
+            raise ValueError(f"{filename} is not a recording")
+        if version != RECORDING_VERSION or record_size != CAPTURE_DTYPE.itemsize:
+            raise ValueError(f"unsupported recording version {version} (record size {record_size})")
+        self.codec = _CODEC_NAMES[codec_id]
+        self._decompress = CODECS[self.codec][2]
+        self.index = self._read_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        if not len(self.index):
+            return 0
+        return int(self.index["first_record"][-1] + self.index["count"][-1])
+
+    def _read_index(self):
+        size = os.fstat(self._f.fileno()).st_size
+        if size >= _FILE_HEADER.size + _TRAILER.size:
+            self._f.seek(size - _TRAILER.size)
+            magic, offset, count = _TRAILER.unpack(self._f.read(_TRAILER.size))
+            if magic == INDEX_MAGIC:
+                self._f.seek(offset)
+                return np.frombuffer(self._f.read(count * BLOCK_INDEX_DTYPE.itemsize), dtype=BLOCK_INDEX_DTYPE)
+
+        # no trailer: interrupted recording, walk the block headers
+        log.info(f"{self.filename} has no index, scanning blocks")
+        entries = []
+        offset = _FILE_HEADER.size
+        records = 0
+        while offset + _BLOCK_HEADER.size <= size:
+            self._f.seek(offset)
+            magic, length, count, first, last = _BLOCK_HEADER.unpack(self._f.read(_BLOCK_HEADER.size))
+            if magic != BLOCK_MAGIC or offset + _BLOCK_HEADER.size + length > size:
+                break
+            entries.append((offset, length, count, records, first, last))
+            offset += _BLOCK_HEADER.size + length
+            records += count
+        return np.array(entries, dtype=BLOCK_INDEX_DTYPE)
+
+    def read_block(self, i):
+        """Records of block `i` as a CAPTURE_DTYPE record array."""
+        entry = self.index[i]
+        self._f.seek(int(entry["offset"]) + _BLOCK_HEADER.size)
+        data = self._decompress(self._f.read(int(entry["size"])))
+        return np.frombuffer(data, dtype=CAPTURE_DTYPE).view(np.recarray)
+
+    def __iter__(self):
+        """Blocks in file order."""
+        for i in range(len(self.index)):
+            yield self.read_block(i)
+
+    def block_of(self, record):
+        """Index of the block holding record number `record`."""
+        return int(np.searchsorted(self.index["first_record"], record, "right")) - 1
+
+    def records(self, start, stop):
+        """Records `start` to `stop` (exclusive), decompressing only their blocks."""
+        stop = min(stop, len(self))
+        if start >= stop:
+            return np.zeros(0, dtype=CAPTURE_DTYPE).view(np.recarray)
+        blocks = [self.read_block(i) for i in range(self.block_of(start), self.block_of(stop - 1) + 1)]
+        first = int(self.index["first_record"][self.block_of(start)])
+        return np.concatenate(blocks, dtype=CAPTURE_DTYPE)[start - first:stop - first].view(np.recarray)
+
+    def between(self, t0=None, t1=None):
+        """
+        Records with t0 <= host_time < t1, decompressing only the blocks
+        whose time range overlaps.
+        """
+        index = self.index
+        keep = np.ones(len(index), dtype=bool)
+        if t0 is not None:
+            keep &= index["last_time"] >= t0
+        if t1 is not None:
+            keep &= index["first_time"] < t1
+        out = []
+        for i in np.flatnonzero(keep):
+            records = self.read_block(i)
+            sel = np.ones(len(records), dtype=bool)
+            if t0 is not None:
+                sel &= records["host_time"] >= t0
+            if t1 is not None:
+                sel &= records["host_time"] < t1
+            out.append(records[sel])
+        if not out:
+            return np.zeros(0, dtype=CAPTURE_DTYPE).view(np.recarray)
+        return np.concatenate(out, dtype=CAPTURE_DTYPE).view(np.recarray)
+
+    def close(self):
+        self._f.close()
+
+
+def open_recording(filename):
+    """Open a recording written by Recorder."""
+    return Recording(filename)
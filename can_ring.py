@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Shared memory frame ring for multi-process fan-out.
+
+A `FrameRing` is a single producer, multiple consumer ring buffer of raw
+VCI_CAN_OBJ records in multiprocessing.shared_memory. The producer receives
+straight into the ring (no copy, no pickling) and never waits for
+consumers; every consumer attaches by name and reads batches with its own
+cursor:
+
+    # reader process
+    ring = FrameRing.create("can0", capacity=1 << 16)
+    ring.run(dev, 0, stop)
+
+    # any number of consumer processes
+    with RingReader("can0") as reader:
+        for frames in reader:
+            ...
+
+Consumers falling more than `capacity` frames behind lose the oldest
+frames; the loss is detected and counted (`lost`, `overruns`), also when
+the producer overwrites records while they are being copied.
+
+Shared memory layout:
+
+    offset  size                  field
+    0       64                    control block, 8 x uint64:
+                                  magic, capacity, reserve, head,
+                                  max_consumers, closed, 0, 0
+    64      32 * max_consumers    consumer slots, 4 x uint64:
+                                  cursor, lost, overruns, pid
+    ...     24 * capacity         VCI_CAN_OBJ records
+
+`head` is the number of frames published so far, record `i` is stored at
+`i % capacity`. Before writing, the producer raises `reserve` to the end of
+the frames being written: a consumer which copied records below
+`reserve - capacity` knows they may have been overwritten.
+
+Control words are plain aligned 64 bit stores, ordered as written on x86
+(total store order).
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import logging
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from controlcan import VCI_CAN_OBJ_DTYPE
+
+__all__ = ["FrameRing", "RingReader"]
+
+log = logging.getLogger("controlcan.ring")
+
+RING_MAGIC = 0x0147_4e49_5249_4356  # b"VCIRING\x01" little endian
+
+_CTL_WORDS = 8
+_MAGIC, _CAPACITY, _RESERVE, _HEAD, _MAX_CONSUMERS, _CLOSED = range(6)
+_SLOT_WORDS = 4
+_CURSOR, _LOST, _OVERRUNS, _PID = range(4)
+
+
+def _attach(name):
+    """Attach an existing segment without handing it to the resource tracker."""
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    # before Python 3.13 attaching registers the segment, and the resource
+    # tracker would unlink it when this process exits
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+
+class _RingView(object):
+    """numpy views of the control block, slots and records of a segment."""
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.ctl = np.ndarray(_CTL_WORDS, dtype=np.uint64, buffer=shm.buf)
+        if int(self.ctl[_MAGIC]) != RING_MAGIC:
+            raise ValueError(f"{shm.name} is not a frame ring")
+        self.capacity = int(self.ctl[_CAPACITY])
+        self.max_consumers = int(self.ctl[_MAX_CONSUMERS])
+        offset = _CTL_WORDS * 8
+        self.slots = np.ndarray((self.max_consumers, _SLOT_WORDS), dtype=np.uint64,
+                                buffer=shm.buf, offset=offset)
+        offset += self.slots.nbytes
+        self.records = np.ndarray(self.capacity, dtype=VCI_CAN_OBJ_DTYPE, buffer=shm.buf, offset=offset)
+
+    def release(self):
+        # numpy views must go before the segment can be closed
+        del self.ctl, self.slots, self.records
+        self.shm.close()
+
+
+class FrameRing(object):
+    """
+    Producer side of a ring, created with `FrameRing.create()`.
+
+    The producer owns the segment: `close()` marks the ring closed (readers
+    stop once drained) and unlinks it.
+    """
+
+    def __init__(self, view):
+        self._view = view
+        self.name = view.shm.name
+        self.capacity = view.capacity
+        self.frames = 0
+        self.batches = 0
+
+    @classmethod
+    def create(cls, name=None, capacity=65536, max_consumers=16):
+        """
+        Create a ring of `capacity` frames. `name` defaults to a random one,
+        consumers attach with `ring.name`.
+        """
+        size = _CTL_WORDS * 8 + max_consumers * _SLOT_WORDS * 8 + capacity * VCI_CAN_OBJ_DTYPE.itemsize
+        shm = shared_memory.SharedMemory(name, create=True, size=size)
+        ctl = np.ndarray(_CTL_WORDS, dtype=np.uint64, buffer=shm.buf)
+        ctl[:] = 0
+        ctl[_CAPACITY] = capacity
+        ctl[_MAX_CONSUMERS] = max_consumers
+        np.ndarray(max_consumers * _SLOT_WORDS, dtype=np.uint64, buffer=shm.buf, offset=ctl.nbytes)[:] = 0
+        ctl[_MAGIC] = RING_MAGIC
+        del ctl
+        return cls(_RingView(shm))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def head(self):
+        return int(self._view.ctl[_HEAD])
+
+    def write(self, frames):
+        """
+        Publish a batch of VCI_CAN_OBJ_DTYPE records (e.g. from
+        ControlCAN.receive_into). A batch larger than the ring only keeps
+        its last `capacity` frames.
+        """
+        view = self._view
+        n = len(frames)
+        if not n:
+            return 0
+        head = int(view.ctl[_HEAD])
+        if n > self.capacity:
+            frames = frames[-self.capacity:]
+        view.ctl[_RESERVE] = head + n
+        start = head + n - len(frames)
+        pos = start % self.capacity
+        first = min(len(frames), self.capacity - pos)
+        view.records[pos:pos + first] = frames[:first]
+        view.records[:len(frames) - first] = frames[first:]
+        view.ctl[_HEAD] = head + n
+        self.frames += n
+        self.batches += 1
+        return n
+
+    def receive(self, device, channel, max_frames=None, WaitTime=0):
+        """
+        Receive from `device` straight into the ring and publish the frames.
+        Reads at most up to the end of the ring, call again to wrap around.
+        Returns the number of frames published.
+        """
+        view = self._view
+        backlog = device.GetReceiveNum(channel, mute=True)
+        if backlog <= 0:
+            if not WaitTime:
+                return 0
+            backlog = self.capacity
+        head = int(view.ctl[_HEAD])
+        pos = head % self.capacity
+        n = min(backlog, self.capacity - pos)
+        if max_frames is not None:
+            n = min(n, max_frames)
+        view.ctl[_RESERVE] = head + n
+        received = len(device.receive_into(channel, view.records[pos:pos + n], mute=True, WaitTime=WaitTime))
+        view.ctl[_RESERVE] = head + received
+        view.ctl[_HEAD] = head + received
+        if received:
+            self.frames += received
+            self.batches += 1
+        return received
+
+    def run(self, device, channel, event_stop, ready=None, min_interval=50e-6, max_interval=500e-6):
+        """
+        Feed the ring from `channel` until `event_stop` is set, backing off
+        while the bus is idle. With a `ready` event (e.g.
+        DeviceSupervisor.ready), reading pauses while it is cleared.
+        """
+        interval = min_interval
+        while not event_stop.is_set():
+            if ready is not None and not ready.is_set():
+                ready.wait(0.1)
+                continue
+            if self.receive(device, channel):
+                interval = min_interval
+            else:
+                time.sleep(interval)
+                interval = min(interval * 2, max_interval)
+
+    def stats(self):
+        """Producer counters and, per attached consumer slot, its lag and losses."""
+        view = self._view
+        head = self.head
+        consumers = {}
+        for i, (cursor, lost, overruns, pid) in enumerate(view.slots.tolist()):
+            if pid:
+                consumers[i] = {"pid": pid, "lag": head - cursor, "lost": lost, "overruns": overruns}
+        return {
+            "name": self.name,
+            "capacity": self.capacity,
+            "head": head,
+            "frames": self.frames,
+            "batches": self.batches,
+            "consumers": consumers,
+        }
+
+    def close(self, unlink=True):
+        if self._view is None:
+            return
+        self._view.ctl[_CLOSED] = 1
+        shm = self._view.shm
+        self._view.release()
+        self._view = None
+        if unlink:
+            shm.unlink()
+
+
+class RingReader(object):
+    """
+    Consumer of the ring `name`.
+
+    slot: consumer slot publishing this reader's cursor and losses to
+        FrameRing.stats(); the first free one by default (pass explicit
+        slots when several consumers attach at the same moment), or False
+        to keep the cursor private
+    start: "latest" to read only frames published from now on, "oldest"
+        to begin with the oldest frame still in the ring
+    buf_size: max frames per batch
+    min_interval, max_interval: bounds of the idle backoff of `wait()`
+
+    Batches are views over an internal buffer, they stay valid until the
+    next read.
+    """
+
+    def __init__(self, name, slot=None, start="latest", buf_size=None, min_interval=50e-6, max_interval=500e-6):
+        self._view = view = _RingView(_attach(name))
+        self.name = name
+        self.capacity = view.capacity
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.buffer = np.zeros(buf_size or self.capacity, dtype=VCI_CAN_OBJ_DTYPE)
+        head = int(view.ctl[_HEAD])
+        if start == "latest":
+            self.cursor = head
+        elif start == "oldest":
+            self.cursor = max(head - self.capacity, 0)
+        else:
+            raise ValueError(f"unknown start {start!r}")
+
+        self.slot = None
+        if slot is None:
+            free = np.flatnonzero(view.slots[:, _PID] == 0)
+            if not len(free):
+                raise ValueError(f"no free consumer slot in ring {name}")
+            slot = int(free[0])
+        if slot is not False:
+            self.slot = slot
+            view.slots[slot] = (self.cursor, 0, 0, os.getpid())
+
+        self.frames = 0
+        self.lost = 0
+        self.overruns = 0
+        self.last_lost = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def closed(self):
+        """Producer closed the ring."""
+        return bool(self._view.ctl[_CLOSED])
+
+    @property
+    def lag(self):
+        """Frames published but not read yet."""
+        return int(self._view.ctl[_HEAD]) - self.cursor
+
+    def read(self, max_frames=None):
+        """
+        Read the frames published since the last read, without waiting.
+        Returns a (possibly empty) record array; `last_lost` is the number
+        of frames overwritten before they could be read, just before it.
+        """
+        view = self._view
+        capacity = self.capacity
+        head = int(view.ctl[_HEAD])
+        cursor = self.cursor
+        lost = 0
+        if head - cursor > capacity:
+            lost = head - capacity - cursor
+            cursor = head - capacity
+        n = min(head - cursor, len(self.buffer))
+        if max_frames is not None:
+            n = min(n, max_frames)
+
+        pos = cursor % capacity
+        first = min(n, capacity - pos)
+        self.buffer[:first] = view.records[pos:pos + first]
+        self.buffer[first:n] = view.records[:n - first]
+
+        # records below reserve - capacity may have changed while copying
+        skip = min(max(int(view.ctl[_RESERVE]) - capacity - cursor, 0), n)
+        lost += skip
+        self.cursor = cursor + n
+
+        self.last_lost = lost
+        if lost:
+            self.lost += lost
+            self.overruns += 1
+            log.warning(f"ring {self.name}: consumer overrun, {lost} frames lost")
+        self.frames += n - skip
+        if self.slot is not None:
+            view.slots[self.slot, :_PID] = (self.cursor, self.lost, self.overruns)
+        return self.buffer[skip:n].view(np.recarray)
+
+    def wait(self, timeout=None, max_frames=None):
+        """
+        Read until at least one frame arrives, the ring is closed or
+        `timeout` seconds have elapsed, backing off between empty reads.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        interval = self.min_interval
+        while True:
+            frames = self.read(max_frames)
+            if len(frames) or self.closed:
+                return frames
+            if deadline is not None and time.perf_counter() >= deadline:
+                return frames
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_interval)
+
+    def __iter__(self):
+        """Batches until the producer closes the ring and it is drained."""
+        while True:
+            frames = self.wait(timeout=0.1)
+            if len(frames):
+                yield frames
+            elif self.closed and not self.lag:
+                return
+
+    def close(self):
+        if self._view is None:
+            return
+        if self.slot is not None:
+            self._view.slots[self.slot] = 0
+        self._view.release()
+        self._view = None
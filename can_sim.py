@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+Simulated ControlCAN driver for hardware-free testing and benchmarking.
+
+`VCISimulator` exposes the same VCI_* functions as ControlCAN.dll/.so, as
+real C function pointers, so it can be handed straight to `ControlCAN`:
+
+    dev = ControlCAN(library=VCISimulator())
+
+Each simulated device has two channels wired to the same bus. Frames sent
+on one channel are delivered to the other one (and to the sender itself in
+loopback mode) after their on-wire time, stuff bits included (see
+can_busload.frame_bits), at the bitrate configured through
+VCI_INIT_CONFIG, stamped with a 32 bit 0.1 ms device timestamp. Every
+channel has a finite receive FIFO, frames arriving at a full FIFO are lost
+and flagged with ERR_CAN_OVERFLOW. The AccCode/AccMask acceptance filter
+and the Filter frame type selection of VCI_INIT_CONFIG are applied.
+Channels configured with different bitrates see bus errors instead of
+frames: the error counters rise like on a real bus, up to error passive
+and (for the sender) bus-off, as reported by VCI_ReadErrInfo and
+VCI_ReadCANStatus. ResetCAN clears the counters.
+
+With `realtime=False` the bus clock runs virtually: frames are readable as
+soon as they are sent (their timestamps still follow the bus timing), which
+allows benchmarking the Python side at rates far above a real bus.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from bisect import bisect_right
+from collections import deque
+from ctypes import *
+import logging
+import struct
+import threading
+import time
+
+import numpy as np
+
+from controlcan import (VCI_INIT_CONFIG, VCI_CAN_OBJ, VCI_CAN_OBJ_DTYPE, VCI_BOARD_INFO, VCI_CAN_STATUS,
+                        VCI_ERR_INFO, VCI_RET_OK, VCI_RET_FAIL, VCI_RET_NODEVICE,
+                        ERR_CAN_OVERFLOW, ERR_CAN_ERRALARM, ERR_CAN_PASSIVE, ERR_CAN_BUSERR)
+from can_busload import frame_bits
+
+__all__ = ["VCISimulator", "NullLibrary"]
+
+log = logging.getLogger("controlcan.sim")
+
+_REC = sizeof(VCI_CAN_OBJ)
+_TS = struct.Struct("=I")
+
+_PROTOTYPES = {
+    "VCI_OpenDevice": (c_uint32, c_uint32, c_uint32),
+    "VCI_CloseDevice": (c_uint32, c_uint32),
+    "VCI_InitCAN": (c_uint32, c_uint32, c_uint32, c_void_p),
+    "VCI_ReadBoardInfo": (c_uint32, c_uint32, c_void_p),
+    "VCI_ReadErrInfo": (c_uint32, c_uint32, c_uint32, c_void_p),
+    "VCI_ReadCANStatus": (c_uint32, c_uint32, c_uint32, c_void_p),
+    "VCI_GetReference": (c_uint32, c_uint32, c_uint32, c_uint32, c_void_p),
+    "VCI_SetReference": (c_uint32, c_uint32, c_uint32, c_uint32, c_void_p),
+    "VCI_GetReceiveNum": (c_uint32, c_uint32, c_uint32),
+    "VCI_ClearBuffer": (c_uint32, c_uint32, c_uint32),
+    "VCI_StartCAN": (c_uint32, c_uint32, c_uint32),
+    "VCI_ResetCAN": (c_uint32, c_uint32, c_uint32),
+    "VCI_Transmit": (c_uint32, c_uint32, c_uint32, c_void_p, c_uint32),
+    "VCI_Receive": (c_uint32, c_uint32, c_uint32, c_void_p, c_uint32, c_int32),
+    "VCI_UsbDeviceReset": (c_uint32, c_uint32, c_uint32),
+}
+
+
+class _Channel(object):
+    def __init__(self):
+        self.config = None
+        self.started = False
+        self.err_code = 0
+        self.tec = 0
+        self.rec = 0
+        # FIFO of [buffer, arrival times, read position] chunks
+        self.chunks = deque()
+        self.count = 0
+
+    def clear(self):
+        self.chunks.clear()
+        self.count = 0
+
+    @property
+    def bus_off(self):
+        return self.tec > 255
+
+    def count_errors(self, tec=0, rec=0):
+        """Update the error counters, flagging warning and passive levels."""
+        self.tec = max(self.tec + tec, 0)
+        self.rec = min(max(self.rec + rec, 0), 255)
+        if tec > 0 or rec > 0:
+            self.err_code |= ERR_CAN_BUSERR
+            if max(self.tec, self.rec) >= 96:
+                self.err_code |= ERR_CAN_ERRALARM
+            if max(self.tec, self.rec) >= 128:
+                self.err_code |= ERR_CAN_PASSIVE
+
+
+class _Device(object):
+    def __init__(self):
+        self.opened = False
+        self.t_open = 0.0
+        self.bus_free = 0.0
+        # arrival times of the frames still waiting for the bus (tx_buffer)
+        self.tx_pending = deque()
+        self.channels = (_Channel(), _Channel())
+
+
+class VCISimulator(object):
+    """
+    In-process ControlCAN library with two wired channels per device.
+
+    devices: number of devices present on the simulated USB bus
+    fifo_size: receive FIFO depth of each channel, in frames
+    realtime: deliver frames only after their on-wire time has elapsed
+    tx_limit: max frames accepted per VCI_Transmit call (None: unlimited)
+    tx_buffer: max frames of a device waiting for the bus, further frames
+        are refused by VCI_Transmit (None: unlimited, realtime mode only)
+    timestamp_offset: initial value of the device timestamp counter
+    clock: host clock used for the bus timing
+    """
+
+    def __init__(self, devices=1, fifo_size=2000, realtime=True, tx_limit=None, tx_buffer=None,
+                 timestamp_offset=0, clock=time.perf_counter):
+        self.fifo_size = fifo_size
+        self.realtime = realtime
+        self.tx_limit = tx_limit
+        self.tx_buffer = tx_buffer
+        self.timestamp_offset = timestamp_offset
+        self.clock = clock
+        self._devices = [_Device() for _ in range(devices)]
+        self._cond = threading.Condition()
+        self._bits = {}
+
+        for name, argtypes in _PROTOTYPES.items():
+            func = CFUNCTYPE(c_int32, *argtypes)(getattr(self, "_" + name))
+            func.__name__ = name
+            setattr(self, name, func)
+
+    def _device(self, DeviceInd):
+        if DeviceInd < len(self._devices):
+            return self._devices[DeviceInd]
+        return None
+
+    def unplug(self, DeviceInd=0):
+        """Simulate the device being unplugged: every call returns VCI_RET_NODEVICE."""
+        with self._cond:
+            self._devices[DeviceInd] = None
+            self._cond.notify_all()
+
+    def plug(self, DeviceInd=0):
+        """Plug a fresh (closed, unconfigured) device back in."""
+        with self._cond:
+            self._devices[DeviceInd] = _Device()
+
+    def _channel(self, DeviceInd, CANInd):
+        dev = self._device(DeviceInd)
+        if dev is None or not dev.opened or CANInd > 1:
+            return dev, None
+        return dev, dev.channels[CANInd]
+
+    def _ready(self, ch, now):
+        """Number of frames in `ch` that already arrived at `now`."""
+        if not self.realtime:
+            return ch.count
+        ready = 0
+        for buf, arrivals, pos in ch.chunks:
+            n = bisect_right(arrivals, now, pos) - pos
+            ready += n
+            if pos + n < len(arrivals):
+                break
+        return ready
+
+    def _frame_bits(self, buf, count):
+        """
+        On-wire bits of the `count` frames of `buf`. frame_bits costs tens
+        of microseconds per call whatever the batch size, small batches use
+        a cache keyed on the frame content (ID, flags, DataLen, Data).
+        """
+        if count > 64:
+            return frame_bits(np.frombuffer(bytes(buf), dtype=VCI_CAN_OBJ_DTYPE)).tolist()
+        cache = self._bits
+        if len(cache) > 65536:
+            cache = self._bits = {}
+        keys = [bytes(buf[off:off + 4]) + bytes(buf[off + 10:off + 21]) for off in range(0, count * _REC, _REC)]
+        bits = [cache.get(key) for key in keys]
+        missing = [i for i, n in enumerate(bits) if n is None]
+        if missing:
+            frames = np.frombuffer(bytes(buf), dtype=VCI_CAN_OBJ_DTYPE)[missing]
+            for i, n in zip(missing, frame_bits(frames).tolist()):
+                bits[i] = cache[keys[i]] = n
+        return bits
+
+    def _accepts(self, config, buf, off):
+        """SJA1000 single filter: AccMask bits set to 1 are don't care."""
+        if config.Filter == VCI_INIT_CONFIG.FILTER_PRESERVE_NORMAL and buf[off + 11]:
+            return False
+        if config.Filter == VCI_INIT_CONFIG.FILTER_PRESERVE_EXT and not buf[off + 11]:
+            return False
+        pid = _TS.unpack_from(buf, off)[0]
+        if buf[off + 11]:
+            reg = (pid << 3) | (buf[off + 10] << 2)
+        else:
+            reg = (pid << 21) | (buf[off + 10] << 20) | (buf[off + 13] << 8) | buf[off + 14]
+        return not ((reg ^ config.AccCode) & ~config.AccMask & 0xffffffff)
+
+    def _deliver(self, ch, buf, arrivals, cfg):
+        config = ch.config
+        if config.Filter in (VCI_INIT_CONFIG.FILTER_PRESERVE_NORMAL,
+                             VCI_INIT_CONFIG.FILTER_PRESERVE_EXT) \
+                or config.AccMask != 0xffffffff:
+            keep = [i for i in range(len(arrivals)) if self._accepts(config, buf, i * _REC)]
+            if len(keep) != len(arrivals):
+                buf = bytearray().join(buf[i * _REC:(i + 1) * _REC] for i in keep)
+                arrivals = [arrivals[i] for i in keep]
+
+        if config.bitrate != cfg.bitrate:
+            ch.count_errors(rec=len(arrivals))
+            return False
+        space = self.fifo_size - ch.count
+        if len(arrivals) > space:
+            ch.err_code |= ERR_CAN_OVERFLOW
+            log.debug(f"receive FIFO overflow, {len(arrivals) - space} frames lost")
+            buf = buf[:space * _REC]
+            arrivals = arrivals[:space]
+        if arrivals:
+            ch.chunks.append([(c_char * len(buf)).from_buffer(buf), arrivals, 0])
+            ch.count += len(arrivals)
+        ch.count_errors(rec=-len(arrivals))
+        return True
+
+    def _VCI_OpenDevice(self, DeviceType, DeviceInd, Reserved):
+        dev = self._device(DeviceInd)
+        if dev is None:
+            return VCI_RET_NODEVICE
+        with self._cond:
+            if not dev.opened:
+                dev.opened = True
+                dev.t_open = dev.bus_free = self.clock()
+        return VCI_RET_OK
+
+    def _VCI_CloseDevice(self, DeviceType, DeviceInd):
+        dev = self._device(DeviceInd)
+        if dev is None:
+            return VCI_RET_NODEVICE
+        with self._cond:
+            dev.opened = False
+            for ch in dev.channels:
+                ch.started = False
+                ch.clear()
+        return VCI_RET_OK
+
+    def _VCI_InitCAN(self, DeviceType, DeviceInd, CANInd, pInitConfig):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else VCI_RET_FAIL
+        with self._cond:
+            ch.config = VCI_INIT_CONFIG.from_buffer_copy(
+                string_at(pInitConfig, sizeof(VCI_INIT_CONFIG)))
+        return VCI_RET_OK
+
+    def _VCI_ReadBoardInfo(self, DeviceType, DeviceInd, pInfo):
+        dev = self._device(DeviceInd)
+        if dev is None:
+            return VCI_RET_NODEVICE
+        info = VCI_BOARD_INFO.from_address(pInfo)
+        info.hw_Version = info.fw_Version = info.dr_Version = 0x0100
+        info.can_Num = 2
+        serial = f"SIM{DeviceInd:08d}".encode()
+        info.str_Serial_Num[:len(serial)] = serial
+        hw_type = b"VCISimulator"
+        info.str_hw_Type[:len(hw_type)] = hw_type
+        return VCI_RET_OK
+
+    def _VCI_ReadErrInfo(self, DeviceType, DeviceInd, CANInd, pErrInfo):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else VCI_RET_FAIL
+        info = VCI_ERR_INFO.from_address(pErrInfo)
+        with self._cond:
+            info.ErrCode = ch.err_code
+            info.Passive_ErrData[:] = (0, ch.rec, min(ch.tec, 255))
+            info.ArLost_ErrData = 0
+            ch.err_code = 0
+        return VCI_RET_OK
+
+    def _VCI_ReadCANStatus(self, DeviceType, DeviceInd, CANInd, pCANStatus):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else VCI_RET_FAIL
+        status = VCI_CAN_STATUS.from_address(pCANStatus)
+        with self._cond:
+            mode = ch.config.Mode if ch.config is not None else VCI_INIT_CONFIG.MODE_NORMAL
+            status.regMode = ((0 if ch.started else VCI_CAN_STATUS.MODE_RESET)
+                              | (VCI_CAN_STATUS.MODE_LISTEN_ONLY if mode == VCI_INIT_CONFIG.MODE_LISTEN else 0)
+                              | (VCI_CAN_STATUS.MODE_SELF_TEST if mode == VCI_INIT_CONFIG.MODE_LOOPBACK else 0))
+            status.regStatus = ((VCI_CAN_STATUS.STATUS_BUS_OFF if ch.bus_off else 0)
+                                | (VCI_CAN_STATUS.STATUS_ERROR if max(ch.tec, ch.rec) >= 96 else 0))
+            status.regEWLimit = 96
+            status.regRECounter = ch.rec
+            status.regTECounter = min(ch.tec, 255)
+        return VCI_RET_OK
+
+    def _VCI_GetReference(self, DeviceType, DeviceInd, CANInd, RefType, pData):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else VCI_RET_FAIL
+        return VCI_RET_OK
+
+    def _VCI_SetReference(self, DeviceType, DeviceInd, CANInd, RefType, pData):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else VCI_RET_FAIL
+        return VCI_RET_OK
+
+    def _VCI_GetReceiveNum(self, DeviceType, DeviceInd, CANInd):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else 0
+        with self._cond:
+            return self._ready(ch, self.clock())
+
+    def _VCI_ClearBuffer(self, DeviceType, DeviceInd, CANInd):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else VCI_RET_FAIL
+        with self._cond:
+            ch.clear()
+        return VCI_RET_OK
+
+    def _VCI_StartCAN(self, DeviceType, DeviceInd, CANInd):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None or ch.config is None:
+            return VCI_RET_NODEVICE if dev is None else VCI_RET_FAIL
+        with self._cond:
+            ch.started = True
+        return VCI_RET_OK
+
+    def _VCI_ResetCAN(self, DeviceType, DeviceInd, CANInd):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else VCI_RET_FAIL
+        with self._cond:
+            ch.started = False
+            ch.clear()
+            ch.tec = ch.rec = 0
+        return VCI_RET_OK
+
+    def _VCI_Transmit(self, DeviceType, DeviceInd, CANInd, pSend, Len):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else 0
+        if not ch.started or ch.bus_off or ch.config.Mode == VCI_INIT_CONFIG.MODE_LISTEN:
+            return 0
+        if self.tx_limit is not None:
+            Len = min(Len, self.tx_limit)
+        if Len <= 0:
+            return 0
+
+        bit_time = 1.0 / ch.config.bitrate
+        arrivals = []
+        # outside the lock, receivers need not wait for it
+        buf = bytearray(string_at(pSend, Len * _REC))
+        bits = self._frame_bits(buf, Len)
+        with self._cond:
+            now = self.clock()
+            if self.tx_buffer is not None and self.realtime:
+                while dev.tx_pending and dev.tx_pending[0] <= now:
+                    dev.tx_pending.popleft()
+                Len = min(Len, self.tx_buffer - len(dev.tx_pending))
+                if Len <= 0:
+                    return 0
+                del buf[Len * _REC:]
+            t = max(dev.bus_free, now)
+            for off, n in zip(range(0, Len * _REC, _REC), bits):
+                t += n * bit_time
+                arrivals.append(t)
+                ts = int((t - dev.t_open) * 10000) + self.timestamp_offset
+                _TS.pack_into(buf, off + 4, ts & 0xffffffff)
+                buf[off + 8] = 1
+            dev.bus_free = t
+            if self.tx_buffer is not None and self.realtime:
+                dev.tx_pending.extend(arrivals)
+
+            acked = True
+            for peer in dev.channels:
+                if not peer.started:
+                    continue
+                if peer is ch and ch.config.Mode != VCI_INIT_CONFIG.MODE_LOOPBACK:
+                    continue
+                acked &= self._deliver(peer, buf, arrivals, ch.config)
+            # a transmitter error counts 8, a successful frame -1
+            ch.count_errors(tec=8 * Len if not acked else -Len)
+            if ch.bus_off:
+                log.debug(f"CAN{CANInd} of device {DeviceInd} bus-off")
+            self._cond.notify_all()
+        return Len
+
+    def _VCI_Receive(self, DeviceType, DeviceInd, CANInd, pReceive, Len, WaitTime):
+        dev, ch = self._channel(DeviceInd, CANInd)
+        if ch is None:
+            return VCI_RET_NODEVICE if dev is None else 0
+
+        with self._cond:
+            now = self.clock()
+            ready = self._ready(ch, now)
+            if not ready and WaitTime > 0:
+                deadline = now + WaitTime / 1000
+                while not ready and now < deadline:
+                    timeout = deadline - now
+                    if ch.chunks:
+                        # next frame is already on the wire
+                        buf, arrivals, pos = ch.chunks[0]
+                        timeout = min(timeout, max(arrivals[pos] - now, 0))
+                    self._cond.wait(timeout)
+                    now = self.clock()
+                    ready = self._ready(ch, now)
+
+            total = min(ready, Len)
+            copied = 0
+            while copied < total:
+                chunk = ch.chunks[0]
+                buf, arrivals, pos = chunk
+                n = min(len(arrivals) - pos, total - copied)
+                memmove(pReceive + copied * _REC,
+                        addressof(buf) + pos * _REC, n * _REC)
+                copied += n
+                if pos + n == len(arrivals):
+                    ch.chunks.popleft()
+                else:
+                    chunk[2] = pos + n
+            ch.count -= copied
+        return copied
+
+    def _VCI_UsbDeviceReset(self, DeviceType, DeviceInd, Reserved):
+        dev = self._device(DeviceInd)
+        if dev is None:
+            return VCI_RET_NODEVICE
+        with self._cond:
+            self._devices[DeviceInd] = _Device()
+        return VCI_RET_OK
+
+
+class NullLibrary(object):
+    """
+    ControlCAN library stub doing no work at all, to measure the Python
+    side cost of the wrapper: every call succeeds, VCI_Transmit accepts and
+    VCI_Receive returns `Len` frames (the receive buffer is left untouched),
+    VCI_GetReceiveNum returns `backlog`.
+    """
+
+    def __init__(self, backlog=0):
+        self.backlog = backlog
+        for name, argtypes in _PROTOTYPES.items():
+            if name in ("VCI_Transmit", "VCI_Receive"):
+                impl = self._frames
+            elif name == "VCI_GetReceiveNum":
+                impl = self._backlog
+            else:
+                impl = self._ok
+            func = CFUNCTYPE(c_int32, *argtypes)(impl)
+            func.__name__ = name
+            setattr(self, name, func)
+
+    def _ok(self, *args):
+        return VCI_RET_OK
+
+    def _frames(self, DeviceType, DeviceInd, CANInd, pFrames, Len, *args):
+        return Len
+
+    def _backlog(self, DeviceType, DeviceInd, CANInd):
+        return self.backlog
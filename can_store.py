@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Indexed in-memory frame store.
+
+Frames are kept in columnar numpy arrays (ID, ExternFlag, time, DataLen,
+Data, channel) and every ID keeps its own index of row positions and
+times, extended batch by batch as frames arrive. Per-ID time range queries
+and ID counts therefore cost time proportional to the result, not to the
+store size. A standard and an extended frame with the same ID value are
+distinct IDs.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+import numpy as np
+
+__all__ = ["FrameStore", "STORE_DTYPE"]
+
+STORE_DTYPE = np.dtype([
+    ("ID", "u4"),
+    ("ExternFlag", "u1"),
+    ("time", "f8"),
+    ("DataLen", "u1"),
+    ("Data", "u1", (8,)),
+    ("channel", "u1"),
+])
+
+
+class _Growable(object):
+    """Append-only numpy array with amortized O(1) appends."""
+
+    def __init__(self, dtype, shape=(), capacity=1024):
+        self._data = np.empty((capacity,) + shape, dtype=dtype)
+        self.size = 0
+
+    def append(self, values):
+        end = self.size + len(values)
+        if end > len(self._data):
+            grown = np.empty((max(end, 2 * len(self._data)),) + self._data.shape[1:],
+                             dtype=self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:end] = values
+        self.size = end
+
+    @property
+    def view(self):
+        return self._data[:self.size]
+
+
+class _IdIndex(object):
+    def __init__(self):
+        self.rows = _Growable(np.int64, capacity=16)
+        self.times = _Growable(np.float64, capacity=16)
+        self.sorted = True
+
+    def append(self, rows, times, ordered=True):
+        if not ordered or (self.times.size and times[0] < self.times.view[-1]):
+            self.sorted = False
+        self.rows.append(rows)
+        self.times.append(times)
+
+    def sort(self):
+        order = np.argsort(self.times.view, kind="stable")
+        self.rows.view[:] = self.rows.view[order]
+        self.times.view[:] = self.times.view[order]
+        self.sorted = True
+
+
+class FrameStore(object):
+    """
+    Columnar frame store with incremental per-ID indexes.
+
+    Frames of one ID are expected to arrive mostly in time order, an out of
+    order batch makes the next query of that ID sort its index once.
+    """
+
+    def __init__(self, capacity=65536):
+        self._ids = _Growable(np.uint32, capacity=capacity)
+        self._ext = _Growable(np.uint8, capacity=capacity)
+        self._times = _Growable(np.float64, capacity=capacity)
+        self._dlc = _Growable(np.uint8, capacity=capacity)
+        self._data = _Growable(np.uint8, shape=(8,), capacity=capacity)
+        self._channels = _Growable(np.uint8, capacity=capacity)
+        self._index = {}
+
+    def __len__(self):
+        return self._ids.size
+
+    def add(self, frames, times=None, channel=0):
+        """
+        Add a batch of frames: capture records (can_capture.CAPTURE_DTYPE)
+        or driver frames (VCI_CAN_OBJ_DTYPE). `times` defaults to the
+        records' host_time, or to the driver TimeStamp in seconds.
+        """
+        if not len(frames):
+            return
+        names = frames.dtype.names
+        if times is None:
+            times = frames["host_time"] if "host_time" in names else frames["TimeStamp"] * 1e-4
+        times = np.broadcast_to(np.asarray(times, dtype=np.float64), (len(frames),))
+        ids = frames["ID"]
+        ext = frames["ExternFlag"]
+        # index key: ID | ExternFlag << 32
+        keys = ids.astype(np.int64) | (ext != 0).astype(np.int64) << 32
+        ordered = bool(np.all(times[1:] >= times[:-1]))
+
+        start = len(self)
+        self._ids.append(ids)
+        self._ext.append(ext)
+        self._times.append(times)
+        self._dlc.append(frames["DataLen"])
+        self._data.append(frames["Data"])
+        self._channels.append(frames["channel"] if "channel" in names
+                              else np.full(len(frames), channel, dtype=np.uint8))
+
+        order = np.argsort(keys, kind="stable")
+        uniq, first = np.unique(keys[order], return_index=True)
+        bounds = np.append(first, len(order))
+        for i, key in enumerate(uniq.tolist()):
+            sel = order[bounds[i]:bounds[i + 1]]
+            index = self._index.get(key)
+            if index is None:
+                index = self._index[key] = _IdIndex()
+            index.append(sel + start, times[sel], ordered)
+
+    def counts(self, extended=None):
+        """
+        Return a {ID: frame count} dict of the distinct IDs of standard
+        (`extended` False) or extended (True) frames, or of both (None,
+        the counts of a standard and an extended ID of the same value
+        are added).
+        """
+        counts = {}
+        for key, index in self._index.items():
+            if extended is None or bool(key >> 32) == bool(extended):
+                pid = key & 0xffffffff
+                counts[pid] = counts.get(pid, 0) + index.rows.size
+        return counts
+
+    def ids(self, extended=None):
+        """Distinct IDs, filtered on `extended` like counts()."""
+        return list(self.counts(extended))
+
+    def rows(self, pid, t0=None, t1=None, extended=None):
+        """
+        Row positions of the frames of `pid` with t0 <= time < t1.
+        extended: ExternFlag of the frames, defaults to ID > 0x7ff
+        """
+        extended = pid > 0x7ff if extended is None else bool(extended)
+        index = self._index.get(pid | int(extended) << 32)
+        if index is None:
+            return np.zeros(0, dtype=np.int64)
+        if not index.sorted:
+            index.sort()
+        times = index.times.view
+        lo = 0 if t0 is None else np.searchsorted(times, t0, "left")
+        hi = len(times) if t1 is None else np.searchsorted(times, t1, "left")
+        return index.rows.view[lo:hi]
+
+    def query(self, pid, t0=None, t1=None, extended=None):
+        """Frames of `pid` with t0 <= time < t1, as a STORE_DTYPE record array."""
+        return self.take(self.rows(pid, t0, t1, extended))
+
+    def take(self, rows):
+        """Gather rows of the store into a STORE_DTYPE record array."""
+        out = np.empty(len(rows), dtype=STORE_DTYPE)
+        out["ID"] = self._ids.view[rows]
+        out["ExternFlag"] = self._ext.view[rows]
+        out["time"] = self._times.view[rows]
+        out["DataLen"] = self._dlc.view[rows]
+        out["Data"] = self._data.view[rows]
+        out["channel"] = self._channels.view[rows]
+        return out.view(np.recarray)
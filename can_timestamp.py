@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Reconstruction of host time from device timestamps.
+
+VCI_CAN_OBJ.TimeStamp is a free running 32 bit counter of 0.1 ms ticks
+which wraps after about 119 hours and drifts against the host clock.
+`TimestampReconstructor` unwraps it and maps it onto time.monotonic() (or
+wall clock time) for whole receive batches at once.
+
+Every batch is an observation: its last frame was received by the device
+before the host got the batch back, so `host - device` is an upper bound
+of the clock offset. The smallest bound of each `segment` seconds of
+device time is kept, and a least squares line through those minima gives
+the offset and the drift rate of the device clock.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from collections import deque
+import time
+
+import numpy as np
+
+__all__ = ["TimestampReconstructor"]
+
+_WRAP = 1 << 32
+
+
+class TimestampReconstructor(object):
+    """
+    Per-device (or per-channel) timestamp reconstructor.
+
+    tick: duration of a TimeStamp tick in seconds
+    segment: device time span over which one offset minimum is kept
+    segments: number of minima kept for the drift estimation
+    clock: host clock the timestamps are mapped onto
+    """
+
+    def __init__(self, tick=1e-4, segment=1.0, segments=60, clock=time.monotonic):
+        self.tick = tick
+        self.segment = segment
+        self.clock = clock
+        self._minima = deque(maxlen=segments)
+        self._last_raw = None
+        self._wraps = 0
+        self._last_time = -np.inf
+        self.offset = None
+        self.drift = 0.0
+        # offset between `clock` and the wall clock, for wall()
+        self._wall_offset = time.time() - clock()
+
+    def reset(self):
+        """
+        Forget the device time base, e.g. after the device was reconnected
+        and its counter restarted. Returned times stay monotonic.
+        """
+        self._minima.clear()
+        self._last_raw = None
+        self._wraps = 0
+        self.offset = None
+        self.drift = 0.0
+
+    def unwrap(self, raw):
+        """Unwrapped tick counts (int64) of a batch of raw TimeStamps."""
+        raw = np.asarray(raw, dtype=np.int64)
+        if not len(raw):
+            return raw
+        prev = raw[0] if self._last_raw is None else self._last_raw
+        steps = np.diff(raw, prepend=prev)
+        wraps = self._wraps + np.cumsum(steps < -(_WRAP // 2))
+        self._last_raw = int(raw[-1])
+        self._wraps = int(wraps[-1])
+        return raw + wraps * _WRAP
+
+    def _observe(self, device_time, host_time):
+        bound = host_time - device_time
+        seg = int(device_time // self.segment)
+        if self._minima and self._minima[-1][0] == seg:
+            if bound < self._minima[-1][2]:
+                self._minima[-1] = (seg, device_time, bound)
+        else:
+            self._minima.append((seg, device_time, bound))
+
+        if len(self._minima) < 2:
+            self.offset, self.drift = self._minima[-1][2], 0.0
+            return
+        d = np.array([m[1] for m in self._minima])
+        b = np.array([m[2] for m in self._minima])
+        self.drift, self.offset = np.polyfit(d - d[0], b, 1)
+        self.offset -= self.drift * d[0]
+
+    def update(self, raw, host_time=None):
+        """
+        Convert the TimeStamps of a batch received at `host_time` (now by
+        default) to host clock times, returns a float64 array.
+        """
+        ticks = self.unwrap(raw)
+        if not len(ticks):
+            return np.zeros(0)
+        device_time = ticks * self.tick
+        self._observe(float(device_time[-1]), self.clock() if host_time is None else host_time)
+        times = device_time * (1 + self.drift) + self.offset
+        # a new estimate must not move time backwards
+        np.maximum(times, self._last_time, out=times)
+        self._last_time = times[-1]
+        return times
+
+    def wall(self, times):
+        """Convert host clock times returned by update() to wall clock time."""
+        return times + self._wall_offset
+
+    @property
+    def drift_ppm(self):
+        return self.drift * 1e6
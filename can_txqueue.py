@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Bounded, batching transmit queue.
+
+Producers `put()` frames into a bounded buffer and a sender thread hands
+them to ControlCAN.transmit_many in batches: a batch leaves as soon as
+`batch_size` frames are waiting, or when the oldest waiting frame has been
+queued for `linger` seconds. With `priority`, waiting frames are sent
+lowest ID first, like bus arbitration would (high IDs may starve under
+sustained load, as on the bus). A full buffer blocks or drops, depending
+on `block`. With a `ready` event (e.g. DeviceSupervisor.ready), sending
+pauses while it is cleared and frames wait in the queue.
+"""
+
+__author__      = "ttimasdf"
+__copyright__   = "Copyright 2018, ttimasdf. All rights reserved"
+__license__     = "MIT"
+
+
+from collections import deque
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+
+__all__ = ["TransmitQueue"]
+
+log = logging.getLogger("controlcan.txqueue")
+
+
+class TransmitQueue(object):
+    """
+    Transmit pipeline of one channel.
+
+    maxsize: max frames waiting in the queue
+    batch_size: max frames per transmit_many call
+    linger: max time a frame waits for its batch to fill, in seconds
+    priority: send the lowest IDs first instead of FIFO order
+    block: block producers when the queue is full instead of dropping
+    samples: number of recent queueing delays kept for the percentiles
+    limiter: optional can_busload.TransmitLimiter of the channel, pacing
+        the batches to its bus load ceiling
+    ready: optional threading.Event, sending pauses while it is cleared
+    """
+
+    def __init__(self, device, channel, maxsize=10000, batch_size=1000, linger=0.001,
+                 priority=False, block=True, samples=10000, limiter=None, ready=None,
+                 clock=time.perf_counter):
+        self.device = device
+        self.channel = channel
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.linger = linger
+        self.priority = priority
+        self.block = block
+        self.limiter = limiter
+        self.ready = ready
+        self.clock = clock
+        self._items = [] if priority else deque()
+        self._seq = itertools.count()
+        self._oldest = None
+        self._inflight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self._delays = np.zeros(samples)
+        self._samples = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.short = 0
+        self.batches = 0
+
+        self._thread = threading.Thread(target=self._run, name=f"TransmitQueue-{channel}", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, pid, data, extended=None, timeout=None):
+        """
+        Queue a data frame. Returns False when it was dropped because the
+        queue is full (non-blocking mode, or `timeout` elapsed).
+        """
+        now = self.clock()
+        item = (pid, next(self._seq), now, data, extended)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("transmit queue closed")
+            if len(self._items) >= self.maxsize:
+                if not self.block or not self._cond.wait_for(
+                        lambda: len(self._items) < self.maxsize, timeout):
+                    self.dropped += 1
+                    return False
+            if self.priority:
+                heapq.heappush(self._items, item)
+            else:
+                self._items.append(item)
+            if self._oldest is None:
+                self._oldest = now
+            self.enqueued += 1
+            if len(self._items) == 1 or len(self._items) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued frame has been handed to the driver, which
+        includes waiting for `ready` while the device is down.
+        """
+        with self._cond:
+            self._oldest = self.clock() - self.linger if self._items else None
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._items and not self._inflight, timeout)
+
+    def close(self):
+        """Send the remaining frames and stop the sender thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _take(self):
+        count = min(len(self._items), self.batch_size)
+        if self.priority:
+            batch = [heapq.heappop(self._items) for _ in range(count)]
+            self._oldest = min((item[2] for item in self._items), default=None)
+        else:
+            batch = [self._items.popleft() for _ in range(count)]
+            self._oldest = self._items[0][2] if self._items else None
+        return batch
+
+    def _run(self):
+        while True:
+            # device down: keep the frames queued until it is back, unless closing
+            while self.ready is not None and not self.ready.is_set() and not self._closed:
+                self.ready.wait(0.1)
+            with self._cond:
+                while True:
+                    if len(self._items) >= self.batch_size or (self._items and self._closed):
+                        break
+                    if self._items:
+                        wait = self._oldest + self.linger - self.clock()
+                        if wait <= 0:
+                            break
+                    elif self._closed:
+                        return
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                if self.ready is not None and not self.ready.is_set() and not self._closed:
+                    continue
+                batch = self._take()
+                self._inflight = len(batch)
+                self._cond.notify_all()
+
+            ids, _, queued, payloads, extended = zip(*batch)
+            if all(e is None for e in extended):
+                extended = None
+            else:
+                extended = [pid > 0x7ff if e is None else e for pid, e in zip(ids, extended)]
+            try:
+                if self.limiter is not None:
+                    sent = self.limiter.transmit_many(ids, payloads, extended=extended)
+                else:
+                    sent = self.device.transmit_many(self.channel, ids, payloads, extended=extended, mute=True)
+            except Exception:
+                log.exception(f"CAN{self.channel} transmit failed")
+                sent = 0
+            self._record(self.clock() - np.array(queued))
+
+            with self._cond:
+                self.batches += 1
+                self.sent += sent
+                if sent < len(batch):
+                    self.short += len(batch) - sent
+                    log.warning(f"CAN{self.channel} {len(batch) - sent} of {len(batch)} frames not sent")
+                self._inflight = 0
+                self._cond.notify_all()
+
+    def _record(self, delays):
+        delays = delays[-len(self._delays):]
+        index = (self._samples + np.arange(len(delays))) % len(self._delays)
+        self._delays[index] = delays
+        self._samples += len(delays)
+
+    def stats(self):
+        """Counters and queueing delay percentiles in seconds."""
+        samples = self._delays[:min(self._samples, len(self._delays))]
+        p50, p99, worst = np.percentile(samples, (50, 99, 100)) if len(samples) else (0.0, 0.0, 0.0)
+        return {
+            "queued": len(self._items),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "short": self.short,
+            "batches": self.batches,
+            "delay_p50": float(p50),
+            "delay_p99": float(p99),
+            "delay_max": float(worst),
+        }
@@ -14,10 +14,20 @@ from ctypes import *
 import logging
 import time
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 __all__ = [
     "VCI_INIT_CONFIG", "PVCI_INIT_CONFIG",
-    "VCI_CAN_OBJ", "PVCI_CAN_OBJ",
+    "VCI_CAN_OBJ", "PVCI_CAN_OBJ", "VCI_CAN_OBJ_DTYPE",
     "VCI_BOARD_INFO", "PVCI_BOARD_INFO",
+    "VCI_CAN_STATUS", "PVCI_CAN_STATUS",
+    "VCI_ERR_INFO", "PVCI_ERR_INFO",
+    "ERR_CAN_OVERFLOW", "ERR_CAN_ERRALARM", "ERR_CAN_PASSIVE", "ERR_CAN_LOSE", "ERR_CAN_BUSERR",
+    "ERR_DEVICEOPENED", "ERR_DEVICEOPEN", "ERR_DEVICENOTOPEN", "ERR_BUFFEROVERFLOW",
+    "ERR_DEVICENOTEXIST", "ERR_LOADKERNELDLL", "ERR_CMDFAILED", "ERR_BUFFERCREATE",
     "ControlCAN", "CANError"
 ]
 
@@ -27,6 +37,23 @@ VCI_RET_OK = 1
 VCI_RET_FAIL = 0
 VCI_RET_NODEVICE = -1
 
+# CAN error codes (VCI_ERR_INFO.ErrCode)
+ERR_CAN_OVERFLOW = 0x0001    # CAN controller FIFO overflow
+ERR_CAN_ERRALARM = 0x0002    # CAN controller error warning
+ERR_CAN_PASSIVE = 0x0004     # CAN controller error passive
+ERR_CAN_LOSE = 0x0008        # CAN controller arbitration lost
+ERR_CAN_BUSERR = 0x0010      # CAN controller bus error
+
+# Generic error codes
+ERR_DEVICEOPENED = 0x0100    # device already opened
+ERR_DEVICEOPEN = 0x0200      # open device failed
+ERR_DEVICENOTOPEN = 0x0400   # device not opened
+ERR_BUFFEROVERFLOW = 0x0800  # driver buffer overflow
+ERR_DEVICENOTEXIST = 0x1000  # device does not exist
+ERR_LOADKERNELDLL = 0x2000   # loading the kernel library failed
+ERR_CMDFAILED = 0x4000       # command failed
+ERR_BUFFERCREATE = 0x8000    # out of memory
+
 class VCI_INIT_CONFIG(Structure):
     """
     typedef struct _INIT_CONFIG{
@@ -40,9 +67,9 @@ class VCI_INIT_CONFIG(Structure):
     }VCI_INIT_CONFIG,*PVCI_INIT_CONFIG;
     """
     _fields_ = [
-        ("AccCode", c_ulong),
-        ("AccMask", c_ulong),
-        ("Reserved", c_ulong),
+        ("AccCode", c_uint32),
+        ("AccMask", c_uint32),
+        ("Reserved", c_uint32),
         ("Filter", c_ubyte),
         ("Timing0", c_ubyte),
         ("Timing1", c_ubyte),
@@ -87,6 +114,17 @@ class VCI_INIT_CONFIG(Structure):
             t0, t1 = self.TIMING_REGS[baud]
         return super().__init__(pid, mask, 0, filter_mode, t0, t1, mode)
 
+    @property
+    def bitrate(self):
+        """
+        Bus bitrate in bit/s decoded from the SJA1000 style BTR0/BTR1
+        registers (16 MHz controller clock).
+        """
+        brp = (self.Timing0 & 0x3f) + 1
+        tseg1 = (self.Timing1 & 0x0f) + 1
+        tseg2 = ((self.Timing1 >> 4) & 0x07) + 1
+        return 8000000 / (brp * (1 + tseg1 + tseg2))
+
 PVCI_INIT_CONFIG = POINTER(VCI_INIT_CONFIG)
 
 
@@ -129,6 +167,17 @@ class VCI_CAN_OBJ(Structure):
 
 PVCI_CAN_OBJ = POINTER(VCI_CAN_OBJ)
 
+# NumPy structured dtype with the exact memory layout of VCI_CAN_OBJ
+if np is not None:
+    VCI_CAN_OBJ_DTYPE = np.dtype({
+        "names": [name for name, _ in VCI_CAN_OBJ._fields_],
+        "formats": ["u4", "u4", "u1", "u1", "u1", "u1", "u1", ("u1", 8), ("u1", 3)],
+        "offsets": [getattr(VCI_CAN_OBJ, name).offset for name, _ in VCI_CAN_OBJ._fields_],
+        "itemsize": sizeof(VCI_CAN_OBJ),
+    })
+else:
+    VCI_CAN_OBJ_DTYPE = None
+
 
 class VCI_BOARD_INFO(Structure):
     """
@@ -159,7 +208,88 @@ class VCI_BOARD_INFO(Structure):
 PVCI_BOARD_INFO = POINTER(VCI_BOARD_INFO)
 
 
+class VCI_CAN_STATUS(Structure):
+    """
+    typedef struct _VCI_CAN_STATUS{
+        UCHAR	ErrInterrupt;
+        UCHAR	regMode;
+        UCHAR	regStatus;
+        UCHAR	regALCapture;
+        UCHAR	regECCapture;
+        UCHAR	regEWLimit;
+        UCHAR	regRECounter;
+        UCHAR	regTECounter;
+        DWORD	Reserved;
+    }VCI_CAN_STATUS,*PVCI_CAN_STATUS;
+    """
+    _fields_ = [
+        ("ErrInterrupt", c_ubyte),
+        ("regMode", c_ubyte),
+        ("regStatus", c_ubyte),
+        ("regALCapture", c_ubyte),
+        ("regECCapture", c_ubyte),
+        ("regEWLimit", c_ubyte),
+        ("regRECounter", c_ubyte),
+        ("regTECounter", c_ubyte),
+        ("Reserved", c_uint32),
+    ]
+
+    # SJA1000 mode and status register bits
+    MODE_RESET = 0x01
+    MODE_LISTEN_ONLY = 0x02
+    MODE_SELF_TEST = 0x04
+    STATUS_BUS_OFF = 0x80
+    STATUS_ERROR = 0x40
+
+    @property
+    def in_reset(self):
+        """Controller in reset mode, i.e. not started."""
+        return bool(self.regMode & self.MODE_RESET)
+
+    @property
+    def bus_off(self):
+        return bool(self.regStatus & self.STATUS_BUS_OFF)
+
+    @property
+    def error_passive(self):
+        return self.regRECounter >= 128 or self.regTECounter >= 128
+
+PVCI_CAN_STATUS = POINTER(VCI_CAN_STATUS)
+
+
+class VCI_ERR_INFO(Structure):
+    """
+    typedef struct _ERR_INFO{
+        UINT	ErrCode;
+        BYTE	Passive_ErrData[3];
+        BYTE	ArLost_ErrData;
+    } VCI_ERR_INFO,*PVCI_ERR_INFO;
+    """
+    _fields_ = [
+        ("ErrCode", c_uint32),
+        ("Passive_ErrData", c_ubyte * 3),
+        ("ArLost_ErrData", c_ubyte),
+    ]
+
+PVCI_ERR_INFO = POINTER(VCI_ERR_INFO)
+
+
 class ControlCAN(object):
+    """
+    Wrapper of one ControlCAN device.
+
+    Every call carries its own error policy (`mute`), no state is shared
+    between calls, so the wrapper needs no lock. Concurrency rules:
+
+    - Transmit/transmit_many and Receive/receive_into/GetReceiveNum on the
+      same channel may run in two threads at once (full duplex), and any
+      I/O call may run concurrently with I/O on the other channel.
+    - transmit_many uses a buffer per channel, use one sender thread per
+      channel.
+    - OpenDevice/CloseDevice/UsbDeviceReset, and InitCAN/StartCAN/ResetCAN/
+      ClearBuffer of a channel, must not overlap with I/O on the affected
+      channels.
+    """
     TYPE_VCI_USBCAN1 = 3
     TYPE_VCI_USBCAN2 = 4
     TYPE_VCI_USBCAN2A = 4
@@ -167,10 +297,17 @@ class ControlCAN(object):
     TYPE_VCI_USBCAN_2E_U = 21
 
     def __init__(self, library='ControlCAN.dll', device_type=TYPE_VCI_USBCAN2, device_index=0):
+        """
+        `library` is either the path of ControlCAN.dll/.so, or an object
+        already exposing the VCI_* functions (e.g. can_sim.VCISimulator).
+        """
         from pathlib import Path
+        import os
         import sys
 
-        if sys.platform == "win32":
+        if not isinstance(library, (str, os.PathLike)):
+            self._l = library
+        elif sys.platform == "win32":
             self._l = windll.LoadLibrary(str(Path(library).resolve()))
         elif sys.platform == "linux":
             self._l = cdll.LoadLibrary(str(Path(library).resolve()))
@@ -187,186 +324,297 @@ class ControlCAN(object):
         self._VCI_OpenDevice = self._l.VCI_OpenDevice
         self._VCI_OpenDevice.argtypes = (c_uint32, c_uint32, c_uint32)
         self._VCI_OpenDevice.restype = c_int32
-        self._VCI_OpenDevice.errcheck = self._vci_errcheck()
 
         self._VCI_CloseDevice = self._l.VCI_CloseDevice
         self._VCI_CloseDevice.argtypes=(c_uint32, c_uint32)  # $1$3, DWORD DeviceInd)
         self._VCI_CloseDevice.restype = c_int32
-        self._VCI_CloseDevice.errcheck = self._vci_errcheck()
 
         self._VCI_InitCAN = self._l.VCI_InitCAN
         self._VCI_InitCAN.argtypes=(c_uint32, c_uint32, c_uint32, POINTER(VCI_INIT_CONFIG))  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_INIT_CONFIG pInitConfig)
         self._VCI_InitCAN.restype = c_int32
-        self._VCI_InitCAN.errcheck = self._vci_errcheck()
 
         # Device info
         self._VCI_ReadBoardInfo = self._l.VCI_ReadBoardInfo
         self._VCI_ReadBoardInfo.argtypes=(c_uint32, c_uint32, POINTER(VCI_BOARD_INFO))  # (DWORD DeviceType, DWORD DeviceInd, PVCI_BOARD_INFO pInfo)
         self._VCI_ReadBoardInfo.restype = c_int32
-        self._VCI_ReadBoardInfo.errcheck = self._vci_errcheck()
+
+        self._VCI_ReadErrInfo = self._l.VCI_ReadErrInfo
+        self._VCI_ReadErrInfo.argtypes=(c_uint32, c_uint32, c_uint32, POINTER(VCI_ERR_INFO))  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_ERR_INFO pErrInfo)
+        self._VCI_ReadErrInfo.restype = c_int32
+
+        self._VCI_ReadCANStatus = self._l.VCI_ReadCANStatus
+        self._VCI_ReadCANStatus.argtypes=(c_uint32, c_uint32, c_uint32, POINTER(VCI_CAN_STATUS))  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_CAN_STATUS pCANStatus)
+        self._VCI_ReadCANStatus.restype = c_int32
 
         # Baud rate
+        self._VCI_GetReference = self._l.VCI_GetReference
+        self._VCI_GetReference.argtypes=(c_uint32, c_uint32, c_uint32, c_uint32, c_void_p)  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, DWORD RefType, PVOID pData)
+        self._VCI_GetReference.restype = c_int32
+
         self._VCI_SetReference = self._l.VCI_SetReference
         self._VCI_SetReference.argtypes=(c_uint32, c_uint32, c_uint32, c_uint32, c_void_p)  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, DWORD RefType, PVOID pData)
         self._VCI_SetReference.restype = c_int32
-        self._VCI_SetReference.errcheck = self._vci_errcheck()
 
         # Buffer related
         self._VCI_GetReceiveNum = self._l.VCI_GetReceiveNum
         self._VCI_GetReceiveNum.argtypes=(c_uint32, c_uint32, c_uint32)  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd)
         self._VCI_GetReceiveNum.restype = c_int32
-        self._VCI_GetReceiveNum.errcheck = self._vci_errcheck()
 
         self._VCI_ClearBuffer = self._l.VCI_ClearBuffer
         self._VCI_ClearBuffer.argtypes=(c_uint32, c_uint32, c_uint32)  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd)
         self._VCI_ClearBuffer.restype = c_int32
-        self._VCI_ClearBuffer.errcheck = self._vci_errcheck()
 
         # CAN operation
         self._VCI_StartCAN = self._l.VCI_StartCAN
         self._VCI_StartCAN.argtypes=(c_uint32, c_uint32, c_uint32)  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd)
         self._VCI_StartCAN.restype = c_int32
-        self._VCI_StartCAN.errcheck = self._vci_errcheck()
 
         self._VCI_ResetCAN = self._l.VCI_ResetCAN
         self._VCI_ResetCAN.argtypes=(c_uint32, c_uint32, c_uint32)  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd)
         self._VCI_ResetCAN.restype = c_int32
-        self._VCI_ResetCAN.errcheck = self._vci_errcheck()
 
         # Data transmission
         self._VCI_Transmit = self._l.VCI_Transmit
         self._VCI_Transmit.argtypes=(c_uint32, c_uint32, c_uint32, PVCI_CAN_OBJ, c_ulong)  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_CAN_OBJ pSend, ULONG Len)
         self._VCI_Transmit.restype = c_int32
-        self._VCI_Transmit.errcheck = self._vci_errcheck()
 
         self._VCI_Receive = self._l.VCI_Receive
         self._VCI_Receive.argtypes=(c_uint32, c_uint32, c_uint32, PVCI_CAN_OBJ, c_ulong, c_int)  # (DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_CAN_OBJ pReceive, ULONG Len, INT WaitTime)
         self._VCI_Receive.restype = c_int32
-        self._VCI_Receive.errcheck = self._vci_errcheck()
 
         # Device Reset
         # *NOT* ZLG Compatible!
         self._VCI_UsbDeviceReset = self._l.VCI_UsbDeviceReset
         self._VCI_UsbDeviceReset.argtypes=(c_uint32, c_uint32, c_uint32)  # (DWORD DevType,DWORD DevIndex,DWORD Reserved)
         self._VCI_UsbDeviceReset.restype = c_int32
-        self._VCI_UsbDeviceReset.errcheck = self._vci_errcheck()
-
-        self._vci_ignoreonce = False
-
-    def _vci_errcheck(self):
-        def ret(result, func, arguments):
-            log.debug(f"function {func.__name__} returned {result}")
-            if result == VCI_RET_NODEVICE:
-                err = f"Device {self.device_index} (type {self.device_type}) not found"
-            elif result == VCI_RET_FAIL and func is not self._VCI_Receive:
-                err = f"Operation failed"
-            else:
-                return result
-            if self._vci_ignoreonce:
-                self._vci_ignoreonce = False
-                log.error(err)
-                return result
-            else:
-                raise CANError(err, self)
-        return ret
+
+        self._tx_buffers = {}
+        # bitrate in bit/s of every channel initialized so far
+        self.bitrates = {}
+        # called with the device whenever a call returns VCI_RET_NODEVICE,
+        # from the calling thread (see can_bringup.DeviceSupervisor)
+        self.on_nodevice = None
+
+    def _vci_call(self, func, args, mute=False, count=False):
+        """
+        Call driver function `func` and apply the error policy of this very
+        call: raise CANError, or only log it when `mute` is set. With
+        `count`, the result is a frame count and 0 is not an error.
+        """
+        result = func(*args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"function {func.__name__}{args} returned {result}")
+        if result == VCI_RET_NODEVICE:
+            err = f"Device {self.device_index} (type {self.device_type}) not found"
+            if self.on_nodevice is not None:
+                self.on_nodevice(self)
+        elif result == VCI_RET_FAIL and not count:
+            err = f"Operation failed"
+        else:
+            return result
+        if mute:
+            log.error(err)
+            return result
+        else:
+            raise CANError(err, self)
 
     def OpenDevice(self, mute=False, block=False):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD Reserved
         """
         if block:
+            delay = 0.01
             while self.OpenDevice(mute=True) != VCI_RET_OK:
-                log.error("Open device failed. Retrying in 1 second")
-                time.sleep(1)
+                log.error(f"Open device failed. Retrying in {delay:.2f} seconds")
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
                 self.CloseDevice(mute=True)
             return VCI_RET_OK
 
-        self._vci_ignoreonce = mute
-        return self._VCI_OpenDevice(self.device_type, self.device_index, 0)
+        return self._vci_call(self._VCI_OpenDevice, (self.device_type, self.device_index, 0), mute)
 
     def CloseDevice(self, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_CloseDevice(self.device_type, self.device_index)
+        return self._vci_call(self._VCI_CloseDevice, (self.device_type, self.device_index), mute)
 
     def InitCAN(self, CANInd, pInitConfig: VCI_INIT_CONFIG, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_INIT_CONFIG pInitConfig
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_InitCAN(self.device_type, self.device_index, CANInd, byref(pInitConfig))
+        ret = self._vci_call(self._VCI_InitCAN, (self.device_type, self.device_index, CANInd, byref(pInitConfig)), mute)
+        if ret == VCI_RET_OK:
+            self.bitrates[CANInd] = pInitConfig.bitrate
+        return ret
 
 
     def ReadBoardInfo(self, pInfo: VCI_BOARD_INFO, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd, PVCI_BOARD_INFO pInfo
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_ReadBoardInfo(self.device_type, self.device_index, byref(pInfo))
+        return self._vci_call(self._VCI_ReadBoardInfo, (self.device_type, self.device_index, byref(pInfo)), mute)
+
+
+    def ReadErrInfo(self, CANInd, pErrInfo: VCI_ERR_INFO, mute=False):
+        """
+        DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_ERR_INFO pErrInfo
 
+        Reading the error information clears it in the driver.
+        """
+        return self._vci_call(self._VCI_ReadErrInfo, (self.device_type, self.device_index, CANInd, byref(pErrInfo)), mute)
+
+    def ReadCANStatus(self, CANInd, pCANStatus: VCI_CAN_STATUS, mute=False):
+        """
+        DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_CAN_STATUS pCANStatus
+        """
+        return self._vci_call(self._VCI_ReadCANStatus, (self.device_type, self.device_index, CANInd, byref(pCANStatus)), mute)
+
+    def GetReference(self, CANInd, RefType, pData, mute=False):
+        """
+        DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, DWORD RefType, PVOID pData
+        """
+        return self._vci_call(self._VCI_GetReference, (self.device_type, self.device_index, CANInd, RefType, pData), mute)
 
     def SetReference(self, CANInd, RefType, pData, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, DWORD RefType, PVOID pData
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_SetReference(self.device_type, self.device_index, CANInd, RefType, pData)
+        return self._vci_call(self._VCI_SetReference, (self.device_type, self.device_index, CANInd, RefType, pData), mute)
 
 
     def GetReceiveNum(self, CANInd, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD CANInd
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_GetReceiveNum(self.device_type, self.device_index, CANInd)
+        return self._vci_call(self._VCI_GetReceiveNum, (self.device_type, self.device_index, CANInd), mute, count=True)
 
     def ClearBuffer(self, CANInd, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD CANInd
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_ClearBuffer(self.device_type, self.device_index, CANInd)
+        return self._vci_call(self._VCI_ClearBuffer, (self.device_type, self.device_index, CANInd), mute)
 
 
     def StartCAN(self, CANInd, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD CANInd
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_StartCAN(self.device_type, self.device_index, CANInd)
+        return self._vci_call(self._VCI_StartCAN, (self.device_type, self.device_index, CANInd), mute)
 
     def ResetCAN(self, CANInd, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD CANInd
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_ResetCAN(self.device_type, self.device_index, CANInd)
+        return self._vci_call(self._VCI_ResetCAN, (self.device_type, self.device_index, CANInd), mute)
 
 
     def Transmit(self, CANInd, pSend: PVCI_CAN_OBJ, Len, mute=False):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_CAN_OBJ pSend, ULONG Len
+
+        Returns the number of frames accepted, 0 when the driver buffer is
+        full (backpressure, not an error).
         """
-        log.debug(f"_VCI_Transmit({self.device_type}, {self.device_index}, {CANInd}, {pSend}, {Len})")
-        self._vci_ignoreonce = mute
-        return self._VCI_Transmit(self.device_type, self.device_index, CANInd, pSend, Len)
+        return self._vci_call(self._VCI_Transmit, (self.device_type, self.device_index, CANInd, pSend, Len), mute,
+                              count=True)
 
-    def Receive(self, CANInd, pReceive: PVCI_CAN_OBJ, Len, mute=False):
+    def Receive(self, CANInd, pReceive: PVCI_CAN_OBJ, Len, mute=False, WaitTime=0):
         """
         DWORD DeviceType, DWORD DeviceInd, DWORD CANInd, PVCI_CAN_OBJ pReceive, ULONG Len, INT WaitTime
+
+        WaitTime is the driver side timeout in ms when no frame is
+        available (some CANalyst-II drivers ignore it and return at once).
+        """
+        return self._vci_call(self._VCI_Receive, (self.device_type, self.device_index, CANInd, pReceive, Len, WaitTime), mute, count=True)
+
+    def receive_into(self, CANInd, buffer, mute=False, WaitTime=0):
+        """
+        Receive into `buffer` (a VCI_CAN_OBJ_DTYPE array, or any writable
+        buffer of VCI_CAN_OBJ records such as `(VCI_CAN_OBJ * n)()`) and
+        return a numpy record array view of the received frames.
+
+        No per-frame Python object is created, fields are accessed as whole
+        columns, e.g. `frames.ID` or `frames.Data[:, 0]`.
+        """
+        if np is None:
+            raise ImportError("receive_into requires numpy")
+        if not isinstance(buffer, np.ndarray):
+            buffer = np.frombuffer(buffer, dtype=VCI_CAN_OBJ_DTYPE)
+        elif buffer.dtype != VCI_CAN_OBJ_DTYPE or not buffer.flags.c_contiguous:
+            raise ValueError("buffer must be a contiguous VCI_CAN_OBJ_DTYPE array")
+        recv = self.Receive(CANInd, buffer.ctypes.data_as(PVCI_CAN_OBJ), len(buffer), mute=mute, WaitTime=WaitTime)
+        return buffer[:max(recv, 0)].view(np.recarray)
+
+    def tx_frames(self, CANInd, ids, payloads, lengths=None, extended=None):
+        """
+        Assemble a batch of data frames in bulk from arrays, in a
+        per-channel VCI_CAN_OBJ buffer which is reused between calls (the
+        result is valid until the next call for the channel).
+
+        ids: sequence/array of frame IDs
+        payloads: (n, <=8) uint8 array, a contiguous bytes-like buffer of
+            n * 8 bytes, or a sequence of bytes objects
+        lengths: DataLen of each frame, defaults to the payload width (or
+            to len() of each bytes object)
+        extended: ExternFlag of each frame, defaults to ID > 0x7ff
+        """
+        if np is None:
+            raise ImportError("tx_frames requires numpy")
+        ids = np.asarray(ids, dtype=np.uint32).reshape(-1)
+        count = len(ids)
+        if not count:
+            return np.zeros(0, dtype=VCI_CAN_OBJ_DTYPE)
+        if isinstance(payloads, np.ndarray):
+            data = payloads.astype(np.uint8, copy=False).reshape(count, -1)
+        elif isinstance(payloads, (bytes, bytearray, memoryview)):
+            data = np.frombuffer(payloads, dtype=np.uint8).reshape(count, 8)
+        else:
+            payloads = list(payloads)
+            if lengths is None:
+                lengths = [len(p) for p in payloads]
+            data = np.frombuffer(b"".join(bytes(p).ljust(8, b"\0") for p in payloads),
+                                 dtype=np.uint8).reshape(count, -1)
+        if data.shape[1] > 8:
+            raise ValueError("VCI_CAN_OBJ only support payloads under 8 bytes")
+
+        buf = self._tx_buffers.get(CANInd)
+        if buf is None or len(buf) < count:
+            buf = self._tx_buffers[CANInd] = np.zeros(max(count, 64), dtype=VCI_CAN_OBJ_DTYPE)
+        frames = buf[:count]
+        frames["ID"] = ids
+        frames["SendType"] = 1
+        frames["RemoteFlag"] = 0
+        frames["ExternFlag"] = ids > 0x7ff if extended is None else extended
+        frames["DataLen"] = data.shape[1] if lengths is None else lengths
+        frames["Data"][:, :data.shape[1]] = data
+        frames["Data"][:, data.shape[1]:] = 0
+        return frames
+
+    def transmit_many(self, CANInd, ids, payloads, lengths=None, extended=None, mute=False):
+        """
+        Send a batch of data frames built in bulk from arrays, see
+        tx_frames() for the arguments. The part of the batch not accepted
+        by VCI_Transmit is resubmitted until the driver accepts nothing
+        more. Returns the number of frames sent, fewer than the batch when
+        the driver buffer is full; only a lost device raises CANError
+        (unless `mute`).
         """
-        log.debug(f"_VCI_Receive({self.device_type}, {self.device_index}, {CANInd}, {pReceive}, {Len}, 0)")
-        self._vci_ignoreonce = mute
-        return self._VCI_Receive(self.device_type, self.device_index, CANInd, pReceive, Len, 0)
+        frames = self.tx_frames(CANInd, ids, payloads, lengths, extended)
+        count = len(frames)
+        sent = 0
+        while sent < count:
+            ret = self.Transmit(CANInd, frames[sent:].ctypes.data_as(PVCI_CAN_OBJ), count - sent, mute=mute)
+            if ret <= 0:
+                break
+            sent += ret
+        return sent
 
     def UsbDeviceReset(self, mute=False):
         """
         DWORD DevType, DWORD DevIndex, DWORD Reserved
         """
-        self._vci_ignoreonce = mute
-        return self._VCI_UsbDeviceReset(self.device_type, self.device_index, 0)
+        return self._vci_call(self._VCI_UsbDeviceReset, (self.device_type, self.device_index, 0), mute)
 
 
 class CANError(Exception):
@@ -395,7 +643,6 @@ EXTERNC DWORD __stdcall VCI_OpenDevice(DWORD DeviceType,DWORD DeviceInd,DWORD Re
 self._VCI_OpenDevice = self._l.VCI_OpenDevice
 self._VCI_OpenDevice.argtypes=(c_uint32, c_uint32, c_uint32)  # (DWORD DeviceType, DWORD DeviceInd, DWORD Reserved)
 self._VCI_OpenDevice.restype = c_int32
-self._VCI_OpenDevice.errcheck = self._vci_errcheck()
 
 
 正则替换函数声明为Python定义：
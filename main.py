@@ -1,80 +1,54 @@
 import logging
-import pickle
 import queue
 import struct
 import time
 import threading
-from ctypes import cast, byref, c_ubyte
 from controlcan import *
+from can_bringup import DeviceSupervisor, bring_up
+from can_cache import LastValueCache
+from can_receiver import AdaptiveReceiver
+from can_capture import CaptureWriter, open_capture, to_records
+from can_recorder import Recorder
+from can_store import FrameStore
+from can_timestamp import TimestampReconstructor
+from can_txqueue import TransmitQueue
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
 
-def t_send(device, bus_index, event_stop, q):
-    bulk_count = 1000
-    while True:
-        pkts =  (VCI_CAN_OBJ * bulk_count)()
-        for i in range(bulk_count):
-            try:
-                pid, data = q.get(timeout=2)
-            except queue.Empty as e:
-                break
-            else:
-                pkts[i].ID = pid
-                import pdb; pdb.set_trace()
-                if isinstance(data, int):
-                    pkts[i].Data = (c_ubyte*8)(*struct.pack('<I', data))
-                elif isinstance(data, bytes):
-                    pkts[i].Data = (c_ubyte*8)(*data)
-                else:
-                    log.warning(f"data {data} not available")
-                q.task_done()
-        if i > 0:
-            start = time.perf_counter()
-            sen = device.Transmit(bus_index, cast(pkts, PVCI_CAN_OBJ), i)
-            log.info(f"sending {bulk_count} packets to id {pid:08x} in {time.perf_counter()-start:.8f}s")
-        if event_stop.is_set():
-            return
-
-def t_recv(device, bus_index, event_stop, q):
-    buf_size = 5000
-    buf = (VCI_CAN_OBJ * buf_size)()
-    while True:
-        start = time.perf_counter()
-        recv = device.Receive(bus_index, cast(buf, PVCI_CAN_OBJ), buf_size, mute=True)
-        log.debug(f"Receiving {recv} packets in {time.perf_counter()-start:.8f}s")
-        for n in range(recv):
-            obj = buf[n]
-            log.debug(f"{obj.ID:08x}: {obj.Data[:]}")
-            q.put((obj.ID, obj.Data[:]))
-        if event_stop.is_set():
-            return
-        time.sleep(0.5)
+def t_recv(device, bus_index, event_stop, q, supervisor, cache, recorder=None):
+    timebase = TimestampReconstructor()
+    supervisor.on_up.append(timebase.reset)
+
+    def forward(frames):
+        log.debug(f"Receiving {len(frames)} packets")
+        times = timebase.wall(timebase.update(frames.TimeStamp))
+        cache.update(frames, times)
+        records = to_records(frames, channel=bus_index, host_time=times)
+        if recorder is not None:
+            recorder.write_records(records)
+        q.put(records)
+
+    AdaptiveReceiver(device, bus_index).run(forward, event_stop, supervisor.ready)
 
 
 def main(*args):
     dev = ControlCAN()
     # dev.UsbDeviceReset()
     # log.info("Device reset")
-    dev.OpenDevice(block=True)
-    log.info("Device opened")
-    conf = VCI_INIT_CONFIG(baud=100)
-    dev.InitCAN(0, conf)
-    time.sleep(0.5)
-    dev.StartCAN(0)
-    log.info("CAN0 init and started")
-    dev.InitCAN(1, conf)
-    time.sleep(0.5)
-    dev.StartCAN(1)
-    log.info("CAN1 init and started")
+    setup = bring_up(dev, channels=(0, 1), baud=100)
+    log.info("CAN0 and CAN1 init and started")
+    supervisor = DeviceSupervisor(dev, setup)
+    supervisor.start(bring_up=False)
 
     stop = threading.Event()
-    qsend = queue.Queue()
+    txq = TransmitQueue(dev, 0, ready=supervisor.ready)
     qrecv = queue.Queue()
-    send = threading.Thread(target=t_send, args=(dev, 0, stop, qsend))
-    recv = threading.Thread(target=t_recv, args=(dev, 0, stop, qrecv))
-    send.start()
+    cache = LastValueCache(0)
+    # -r: record everything to rotating compressed files in logs/
+    recorder = Recorder("logs/can-{time:%Y%m%d-%H%M%S}.vcz") if '-r' in args else None
+    recv = threading.Thread(target=t_recv, args=(dev, 0, stop, qrecv, supervisor, cache, recorder))
     recv.start()
 
     if '-i' in args:
@@ -87,29 +61,37 @@ def main(*args):
 
 
         def put(id, data):
-            qsend.put((id, data))
+            if isinstance(data, int):
+                data = struct.pack('<I', data)
+            txq.put(id, data)
 
         def putall(plist):
             for p in plist:
-                qsend.put(p)
+                put(*p)
 
         def get():
             while not qrecv.empty():
-                buf.append(qrecv.get())
+                records = qrecv.get()
+                buf.append(records)
+                store.add(records)
                 qrecv.task_done()
 
         def save(filename):
-            with open(filename, "wb") as f:
-                pickle.dump(buf, f)
+            with CaptureWriter(filename, append=False) as f:
+                for records in buf:
+                    f.write_records(records)
 
         def load(filename):
-            with open(filename, "rb") as f:
-                return pickle.load(f)
+            return open_capture(filename)
 
         buf = []
+        store = FrameStore()
 
-        def filterid(pid):
-            return list(filter(lambda i: i[0]==pid, buf))
+        def filterid(pid, t0=None, t1=None):
+            return store.query(pid, t0, t1)
+
+        def last(pid):
+            return cache.get(pid)
 
         log.info("to stop background threads, run stop.set()")
         if have_ptpython:
@@ -119,10 +101,9 @@ def main(*args):
 
         stop.set()
         log.info("Stopping background threads")
-        send.join()
         recv.join()
     else:
-        while send.is_alive() or recv.is_alive():
+        while recv.is_alive():
             if stop.is_set():
                 log.info("still waiting for finish")
             # Use time.sleep instead of join to void signal stuck because of GIL
@@ -132,7 +113,13 @@ def main(*args):
                 stop.set()
                 log.info("Stopping background threads")
 
-
+    txq.close()
+    log.info(f"transmit queue stats: {txq.stats()}")
+    if recorder is not None:
+        recorder.close()
+        log.info(f"recorder stats: {recorder.stats}")
+    supervisor.stop()
+    log.info(f"supervisor stats: {supervisor.stats}")
     dev.CloseDevice()
     log.info("device closed")
 
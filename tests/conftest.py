@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+# the modules are flat files at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from can_bringup import bring_up
+from can_sim import VCISimulator
+from controlcan import ControlCAN, VCI_CAN_OBJ_DTYPE
+
+
+def open_sim(channels=(0, 1), baud=500, **sim_args):
+    """ControlCAN on a VCISimulator, opened and with `channels` started."""
+    dev = ControlCAN(library=VCISimulator(**sim_args))
+    bring_up(dev, channels=channels, baud=baud)
+    return dev
+
+
+@pytest.fixture
+def dev():
+    """Realtime simulated device, CAN0 and CAN1 at 500 kbit/s."""
+    dev = open_sim()
+    yield dev
+    dev.CloseDevice(mute=True)
+
+
+@pytest.fixture
+def fast_dev():
+    """Simulated device with a virtual bus clock, frames are readable right away."""
+    dev = open_sim(realtime=False, fifo_size=100000)
+    yield dev
+    dev.CloseDevice(mute=True)
+
+
+def receive(dev, channel, count, timeout=2.0):
+    """Read frames from `channel` until `count` arrived or `timeout` seconds elapsed."""
+    buf = np.zeros(count, dtype=VCI_CAN_OBJ_DTYPE)
+    received = 0
+    deadline = time.perf_counter() + timeout
+    while received < count and time.perf_counter() < deadline:
+        received += len(dev.receive_into(channel, buf[received:], WaitTime=10))
+    return buf[:received].view(np.recarray)
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from can_dbc import parse_dbc
+from conftest import receive
+
+DBC = """
+VERSION ""
+
+BU_: ECU TESTER
+
+BO_ 256 ENGINE: 8 ECU
+ SG_ Speed : 0|16@1+ (0.01,0) [0|655.35] "km/h" TESTER
+ SG_ Temp : 16|8@1- (1,-40) [-168|87] "degC" TESTER
+ SG_ Torque : 31|12@0- (0.5,0) [-1024|1023.5] "Nm" TESTER
+ SG_ Gear : 35|3@0+ (1,0) [0|7] "" TESTER
+
+BO_ 512 FLOATS: 8 ECU
+ SG_ Ratio : 0|32@1- (1,0) [0|0] "" TESTER
+ SG_ Scaled : 39|32@0- (2,1) [0|0] "" TESTER
+
+BO_ 2564485392 DIAG: 8 TESTER
+ SG_ Mode M : 0|8@1+ (1,0) [0|255] "" ECU
+ SG_ Voltage m1 : 8|16@1+ (0.001,0) [0|65.535] "V" ECU
+ SG_ Current m2 : 8|16@1- (0.01,0) [-327.68|327.67] "A" ECU
+ SG_ Counter : 56|8@1+ (1,0) [0|255] "" ECU
+
+VAL_ 256 Gear 0 "P" 1 "R" 2 "N" 3 "D" ;
+SIG_VALTYPE_ 512 Ratio : 1;
+SIG_VALTYPE_ 512 Scaled : 1;
+"""
+
+
+@pytest.fixture(scope="module")
+def db():
+    return parse_dbc(DBC)
+
+
+def engine_values(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "Speed": rng.integers(0, 65536, n) * 0.01,
+        "Temp": rng.integers(-128, 128, n) - 40,
+        "Torque": rng.integers(-2048, 2048, n) * 0.5,
+        "Gear": rng.integers(0, 8, n),
+    }
+
+
+def float_values(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # exactly representable after the float32 round trip
+    ratio = rng.standard_normal(n).astype(np.float32).astype(np.float64)
+    return {"Ratio": ratio, "Scaled": ratio * 2 + 1}
+
+
+def test_parse(db):
+    engine = db.message("ENGINE")
+    assert engine.frame_id == 0x100 and not engine.extended
+    assert db.message("DIAG").extended
+    assert db.message("FLOATS").signal("Ratio").float_bits == 32
+    assert db.message_by_id(0x18daf110).name == "DIAG"
+
+
+def test_encode_decode_single(db):
+    engine = db.message("ENGINE")
+    values = {"Speed": 123.45, "Temp": -12, "Torque": -100.5, "Gear": 3}
+    decoded = engine.decode(engine.encode(values))
+    assert decoded["Speed"] == pytest.approx(123.45)
+    assert decoded["Temp"] == -12
+    assert decoded["Torque"] == pytest.approx(-100.5)
+    assert decoded["Gear"] == 3
+    floats = db.message("FLOATS")
+    assert floats.decode(floats.encode({"Ratio": 0.5, "Scaled": -3.0})) == {"Ratio": 0.5, "Scaled": -3.0}
+    assert engine.decode(engine.encode({"Gear": "D"}), choices=True)["Gear"] == "D"
+
+
+@pytest.mark.parametrize("name, make_values", [("ENGINE", engine_values), ("FLOATS", float_values)])
+def test_batch_matches_single(db, name, make_values):
+    msg = db.message(name)
+    values = make_values(200)
+    data = msg.encode_batch(values)
+    for i in range(len(data)):
+        single = {signal: v[i].item() for signal, v in values.items()}
+        assert bytes(data[i]) == msg.encode(single)
+    decoded = msg.decode_batch({"Data": data})
+    for i in range(len(data)):
+        single = msg.decode(bytes(data[i]))
+        for signal in values:
+            assert decoded[signal][i] == pytest.approx(single[signal])
+    for signal, v in values.items():
+        assert decoded[signal] == pytest.approx(v)
+
+
+def test_multiplexed_batch(db):
+    diag = db.message("DIAG")
+    values = {"Mode": np.array([1, 2, 1, 2]), "Voltage": np.array([12.5, 0, 13.8, 0]),
+              "Current": np.array([0, -1.5, 0, 2.25]), "Counter": np.arange(4)}
+    decoded = diag.decode_batch({"Data": diag.encode_batch(values)})
+    assert decoded["Voltage"].mask.tolist() == [False, True, False, True]
+    assert decoded["Voltage"].compressed() == pytest.approx([12.5, 13.8])
+    assert decoded["Current"].compressed() == pytest.approx([-1.5, 2.25])
+    assert decoded["Counter"].tolist() == [0, 1, 2, 3]
+    assert diag.decode(diag.encode({"Mode": 2, "Current": -1.5})) == {"Mode": 2, "Current": -1.5, "Counter": 0}
+
+
+def test_decode_frames_over_the_bus(db, fast_dev):
+    engine, diag = db.message("ENGINE"), db.message("DIAG")
+    values = engine_values(50, seed=1)
+    fast_dev.transmit_many(0, [engine.frame_id] * 50, engine.encode_batch(values))
+    fast_dev.transmit_many(0, [diag.frame_id] * 10 + [0x123] * 5,
+                           np.vstack([diag.encode_batch({"Mode": 1, "Voltage": 5.0}, count=10),
+                                      np.zeros((5, 8), dtype=np.uint8)]),
+                           extended=[True] * 10 + [False] * 5)
+    frames = receive(fast_dev, 1, 65)
+    decoded = db.decode_frames(frames)
+    assert set(decoded) == {"ENGINE", "DIAG"}
+    assert decoded["ENGINE"]["index"].tolist() == list(range(50))
+    for name, v in values.items():
+        assert decoded["ENGINE"][name] == pytest.approx(v)
+    assert decoded["DIAG"]["Voltage"].compressed() == pytest.approx([5.0] * 10)
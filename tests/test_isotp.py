@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from can_isotp import IsoTpError, IsoTpTransport
+
+
+def round_trip(dev, payload, tester_args={}, ecu_args={}, tx_id=0x7e0, rx_id=0x7e8):
+    with IsoTpTransport(dev, 0, **tester_args) as tester, IsoTpTransport(dev, 1, **ecu_args) as ecu:
+        request = tester.open(tx_id, rx_id)
+        response = ecu.open(rx_id, tx_id)
+        request.send(payload, timeout=5)
+        assert response.recv(timeout=5) == payload
+        response.send(payload[::-1], timeout=5)
+        assert request.recv(timeout=5) == payload[::-1]
+        return request, response
+
+
+@pytest.mark.parametrize("size", [1, 7, 8, 62, 63, 300, 4095, 4096, 10000])
+def test_round_trip_sizes(dev, size):
+    round_trip(dev, os.urandom(size))
+
+
+def test_round_trip_flow_control(dev):
+    # block size 4 with 1 ms STmin on the receiver side
+    request, _ = round_trip(dev, os.urandom(200), ecu_args={"block_size": 4, "st_min": 1e-3})
+    assert request.stats["tx_messages"] == 1
+
+
+def test_round_trip_without_padding(dev):
+    round_trip(dev, os.urandom(30), tester_args={"padding": None}, ecu_args={"padding": None})
+
+
+def test_round_trip_extended_ids(dev):
+    round_trip(dev, os.urandom(100), tx_id=0x18da10f1, rx_id=0x18daf110)
+
+
+def test_sessions_are_independent(dev):
+    with IsoTpTransport(dev, 0) as tester, IsoTpTransport(dev, 1) as ecu:
+        pairs = [(tester.open(0x700 + i, 0x780 + i), ecu.open(0x780 + i, 0x700 + i)) for i in range(4)]
+        payloads = [os.urandom(100 * (i + 1)) for i in range(4)]
+        futures = [a.send_async(p) for (a, _), p in zip(pairs, payloads)]
+        for future in futures:
+            future.result(timeout=5)
+        for (_, b), payload in zip(pairs, payloads):
+            assert b.recv(timeout=5) == payload
+
+
+def test_close_and_reopen_mixed_formats(dev):
+    with IsoTpTransport(dev, 0) as tester:
+        session = tester.open(0x7e0, 0x18daf110)
+        with pytest.raises(KeyError):
+            tester.open(0x7e1, 0x18daf110)
+        tester.close_session(session)
+        tester.open(0x7e0, 0x18daf110)
+
+
+def test_receiver_refuses_oversized_payload(dev):
+    with IsoTpTransport(dev, 0) as tester, IsoTpTransport(dev, 1, max_rx_size=100) as ecu:
+        request = tester.open(0x7e0, 0x7e8)
+        response = ecu.open(0x7e8, 0x7e0)
+        with pytest.raises(IsoTpError):
+            request.send(os.urandom(200), timeout=5)
+        request.send(b"small", timeout=5)
+        assert response.recv(timeout=5) == b"small"
+
+
+def test_send_times_out_without_peer(dev):
+    with IsoTpTransport(dev, 0, timeout=0.1) as tester:
+        with pytest.raises(IsoTpError):
+            tester.open(0x7e0, 0x7e8).send(os.urandom(100), timeout=5)
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+from can_capture import CAPTURE_DTYPE, CAPTURE_FLAG_TX, CaptureWriter, open_capture, to_records
+from can_logfile import convert, open_reader, open_writer
+from can_recorder import open_recording
+from conftest import receive
+
+FORMATS = [".log", ".asc", ".blf", ".vcz"]
+
+
+@pytest.fixture
+def records(fast_dev):
+    """Mixed frames received from the simulated bus, as capture records of two channels."""
+    rng = np.random.default_rng(0)
+    n = 500
+    ids = rng.integers(0, 0x800, n)
+    extended = rng.random(n) < 0.3
+    ids[extended] = rng.integers(0, 1 << 29, extended.sum())
+    lengths = rng.integers(0, 9, n)
+    fast_dev.transmit_many(0, ids, rng.integers(0, 256, (n, 8), dtype=np.uint8), lengths=lengths,
+                           extended=extended)
+    frames = receive(fast_dev, 1, n)
+    assert len(frames) == n
+    frames.RemoteFlag[::7] = 1
+    # keep the payload bytes past DataLen (and of remote frames) zero, formats do not store them
+    frames.Data[(np.arange(8) >= frames.DataLen[:, None]) | (frames.RemoteFlag[:, None] != 0)] = 0
+    host_time = 1500000000.0 + frames.TimeStamp * 1e-4
+    records = to_records(frames, channel=1, host_time=host_time)
+    records.channel[::2] = 0
+    records.frame_flags[::3] = CAPTURE_FLAG_TX
+    return records
+
+
+def read_all(reader):
+    with reader:
+        return np.concatenate(list(reader), dtype=CAPTURE_DTYPE).view(np.recarray)
+
+
+def assert_same_frames(a, b, tx=True):
+    assert len(a) == len(b)
+    for field in ("ID", "ExternFlag", "RemoteFlag", "DataLen", "Data", "channel"):
+        assert (a[field] == b[field]).all(), field
+    if tx:
+        assert ((a.frame_flags & CAPTURE_FLAG_TX) == (b.frame_flags & CAPTURE_FLAG_TX)).all()
+    assert (b.host_time - b.host_time[0]) == pytest.approx(a.host_time - a.host_time[0], abs=2e-6)
+
+
+def test_capture_round_trip(tmp_path, records):
+    filename = str(tmp_path / "trace.cap")
+    with CaptureWriter(filename) as writer:
+        writer.write_records(records[:200])
+    with CaptureWriter(filename) as writer:
+        writer.write_records(records[200:])
+    capture = open_capture(filename)
+    assert len(capture) == len(records)
+    assert (np.asarray(capture) == np.asarray(records)).all()
+    with CaptureWriter(filename, append=False) as writer:
+        writer.write_records(records[:10])
+    assert len(open_capture(filename)) == 10
+
+
+def test_capture_drops_partial_record(tmp_path, records):
+    filename = str(tmp_path / "trace.cap")
+    with CaptureWriter(filename) as writer:
+        writer.write_records(records[:10])
+    with open(filename, "ab") as f:
+        f.write(b"\0" * 7)
+    with CaptureWriter(filename) as writer:
+        writer.write_records(records[10:20])
+    assert (np.asarray(open_capture(filename)) == np.asarray(records[:20])).all()
+
+
+@pytest.mark.parametrize("ext", FORMATS)
+def test_logfile_round_trip(tmp_path, records, ext):
+    filename = str(tmp_path / ("trace" + ext))
+    with open_writer(filename) as writer:
+        for start in range(0, len(records), 100):
+            writer.write_records(records[start:start + 100])
+    back = read_all(open_reader(filename))
+    assert_same_frames(records, back, tx=ext != ".log")
+
+
+@pytest.mark.parametrize("ext", [".log", ".asc", ".blf"])
+def test_logfile_small_chunks(tmp_path, records, ext):
+    filename = str(tmp_path / ("trace" + ext))
+    with open_writer(filename) as writer:
+        writer.write_records(records)
+    # chunks much smaller than the file, lines and objects span chunk ends
+    assert_same_frames(records, read_all(open_reader(filename, chunk_size=1000)),
+                       tx=ext != ".log")
+
+
+def test_convert_chain(tmp_path, records):
+    first = str(tmp_path / "trace.blf")
+    with open_writer(first) as writer:
+        writer.write_records(records)
+    previous = first
+    for ext in (".asc", ".vcz", ".log", ".blf"):
+        filename = str(tmp_path / ("converted" + ext))
+        frames, _ = convert(previous, filename)
+        assert frames == len(records)
+        previous = filename
+    assert_same_frames(records, read_all(open_reader(previous)), tx=False)
+
+
+def test_recording_time_range(tmp_path, records):
+    filename = str(tmp_path / "trace.vcz")
+    with open_writer(filename) as writer:
+        writer.write_records(records)
+    with open_recording(filename) as recording:
+        assert len(recording) == len(records)
+        t0, t1 = records.host_time[100], records.host_time[200]
+        selected = recording.between(t0, t1)
+        expected = records[(records.host_time >= t0) & (records.host_time < t1)]
+        assert (np.asarray(selected) == np.asarray(expected)).all()
@@ -0,0 +1,88 @@
+import numpy as np
+
+from can_bringup import ChannelSetup
+from can_filter import AcceptanceFilter
+from can_receiver import AdaptiveReceiver, OverflowAwareReceiver
+from conftest import open_sim
+
+
+def send(dev, n, channel=0):
+    return dev.transmit_many(channel, np.arange(n) & 0x7ff, np.zeros((n, 8), dtype=np.uint8))
+
+
+def test_adaptive_receiver_wait(fast_dev):
+    rx = AdaptiveReceiver(fast_dev, 1, buf_size=64)
+    assert len(rx.wait(timeout=0.01)) == 0
+    send(fast_dev, 100)
+    assert rx.wait(timeout=1).ID.tolist() == list(range(64))
+    assert rx.wait(timeout=1).ID.tolist() == list(range(64, 100))
+    assert rx.stats["frames"] == 100
+
+
+def test_receiver_filter(fast_dev):
+    frame_filter = AcceptanceFilter()
+    frame_filter.add_ids([0x10, 0x20])
+    rx = AdaptiveReceiver(fast_dev, 1, frame_filter=frame_filter)
+    send(fast_dev, 50)
+    assert rx.wait(timeout=1).ID.tolist() == [0x10, 0x20]
+
+
+def test_overflow_event():
+    dev = open_sim(realtime=False, fifo_size=100)
+    events = []
+    rx = OverflowAwareReceiver(dev, 1, buf_size=64, fifo_size=100, on_event=events.append)
+    send(dev, 300)
+    assert dev.GetReceiveNum(1) == 100
+    assert [e.kind for e in rx.check()] == ["overflow"]
+    assert [e.kind for e in events] == ["overflow"]
+    assert rx.overflows == 1
+    # reads more per call and polls faster afterwards
+    assert len(rx.buffer) == 128
+    assert rx.max_interval < AdaptiveReceiver(dev, 1).max_interval
+    # the error is cleared by reading it
+    assert rx.check() == []
+
+
+def test_overflow_detected_by_poll():
+    dev = open_sim(realtime=False, fifo_size=100)
+    rx = OverflowAwareReceiver(dev, 1, fifo_size=100)
+    rx.poll()
+    send(dev, 300)
+    frames = rx.poll()
+    assert len(frames) == 100
+    assert rx.overflows == 1
+    assert rx.events[-1].kind == "overflow"
+    assert rx.events[-1].device_time == int(frames.TimeStamp[-1])
+
+
+def bus_off_device():
+    # CAN1 at another bitrate: CAN0 frames are never acknowledged
+    dev = open_sim(channels=(0, ChannelSetup(1, baud=250)), realtime=False)
+    for _ in range(40):
+        send(dev, 1)
+    return dev
+
+
+def test_bus_off_reported_once():
+    dev = bus_off_device()
+    rx = OverflowAwareReceiver(dev, 0)
+    assert [e.kind for e in rx.check()] == ["error_passive", "bus_off"]
+    assert rx.check() == []
+    assert rx.check() == []
+    assert rx.bus_offs == 1
+    assert rx.stats["bus_off"]
+    # a transmitter in bus-off does not send
+    assert send(dev, 1) == 0
+
+
+def test_bus_off_restart():
+    dev = bus_off_device()
+    rx = OverflowAwareReceiver(dev, 0, restart_bus_off=True)
+    assert "bus_off" in [e.kind for e in rx.check()]
+    rx.check()
+    assert not rx.stats["bus_off"]
+    assert send(dev, 1) == 1
+    for _ in range(40):
+        send(dev, 1)
+    assert "bus_off" in [e.kind for e in rx.check()]
+    assert rx.bus_offs == 2
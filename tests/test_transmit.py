@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from can_busload import TransmitLimiter, frame_bits
+from can_txqueue import TransmitQueue
+from controlcan import CANError, VCI_CAN_OBJ_DTYPE
+from conftest import open_sim, receive
+
+
+def payloads(n):
+    return np.arange(n * 8, dtype=np.uint8).reshape(n, 8)
+
+
+def test_transmit_many_delivers_in_order(dev):
+    ids = np.arange(100) + 0x100
+    assert dev.transmit_many(0, ids, payloads(100)) == 100
+    frames = receive(dev, 1, 100)
+    assert len(frames) == 100
+    assert (frames.ID == ids).all()
+    assert (frames.Data == payloads(100)).all()
+
+
+def test_transmit_many_extended_and_lengths(fast_dev):
+    ids = [0x7ff, 0x800, 0x18daf110]
+    sent = fast_dev.transmit_many(0, ids, [b"\x01", b"\x02\x03", b""], lengths=[1, 2, 0],
+                                  extended=[True, False, True])
+    assert sent == 3
+    frames = receive(fast_dev, 1, 3)
+    assert frames.ID.tolist() == ids
+    assert frames.ExternFlag.tolist() == [1, 0, 1]
+    assert frames.DataLen.tolist() == [1, 2, 0]
+
+
+def test_transmit_many_empty_batch(dev):
+    assert dev.transmit_many(0, [], np.zeros((0, 8), dtype=np.uint8)) == 0
+
+
+def test_transmit_many_backpressure(caplog):
+    # the driver accepts 10 frames until the bus has sent them, a frame
+    # takes about 2.6 ms at 50 kbit/s
+    dev = open_sim(baud=50, tx_buffer=10)
+    with caplog.at_level(logging.ERROR, logger="controlcan"):
+        assert dev.transmit_many(0, np.arange(50), payloads(50)) == 10
+        assert dev.transmit_many(0, np.arange(50), payloads(50)) == 0
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+    time.sleep(0.1)
+    assert dev.transmit_many(0, np.arange(5), payloads(5)) == 5
+    assert len(receive(dev, 1, 15)) == 15
+
+
+def test_transmit_many_partial_calls():
+    # every Transmit call takes at most 3 frames, transmit_many sends the rest
+    dev = open_sim(realtime=False, tx_limit=3)
+    assert dev.transmit_many(0, np.arange(10), payloads(10)) == 10
+    assert receive(dev, 1, 10).ID.tolist() == list(range(10))
+
+
+def test_transmit_many_lost_device():
+    dev = open_sim()
+    dev._l.unplug()
+    with pytest.raises(CANError):
+        dev.transmit_many(0, [1], payloads(1))
+    assert dev.transmit_many(0, [1], payloads(1), mute=True) == 0
+
+
+def test_transmit_queue_flush():
+    dev = open_sim(realtime=False)
+    with TransmitQueue(dev, 0, batch_size=16) as txq:
+        for i in range(100):
+            assert txq.put(i, bytes([i]))
+        assert txq.flush(2)
+        assert txq.stats()["sent"] == 100
+    frames = receive(dev, 1, 100)
+    assert frames.ID.tolist() == list(range(100))
+
+
+def test_transmit_queue_waits_for_ready():
+    dev = open_sim(realtime=False)
+    ready = threading.Event()
+    with TransmitQueue(dev, 0, ready=ready) as txq:
+        for i in range(10):
+            txq.put(i, b"\x00")
+        assert not txq.flush(0.2)
+        assert txq.stats()["sent"] == 0
+        ready.set()
+        assert txq.flush(2)
+        assert txq.stats()["sent"] == 10
+
+
+def test_transmit_queue_priority():
+    dev = open_sim(realtime=False)
+    ready = threading.Event()
+    with TransmitQueue(dev, 0, priority=True, ready=ready) as txq:
+        for pid in (0x300, 0x100, 0x200):
+            txq.put(pid, b"")
+        ready.set()
+        assert txq.flush(2)
+    assert receive(dev, 1, 3).ID.tolist() == [0x100, 0x200, 0x300]
+
+
+def test_frame_bits_matches_simulated_timing(fast_dev):
+    rng = np.random.default_rng(0)
+    fast_dev.transmit_many(0, rng.integers(0, 0x800, 200), rng.integers(0, 256, (200, 8), dtype=np.uint8))
+    frames = receive(fast_dev, 1, 200)
+    # 0.1 ms timestamps of back to back frames
+    elapsed = (int(frames.TimeStamp[-1]) - int(frames.TimeStamp[0])) * 1e-4
+    assert elapsed == pytest.approx(frame_bits(frames)[1:].sum() / 500e3, abs=2e-4)
+
+
+def test_frame_bits_known_lengths():
+    frames = np.zeros(3, dtype=VCI_CAN_OBJ_DTYPE)
+    frames["DataLen"] = [0, 8, 8]
+    frames["ExternFlag"] = [0, 0, 1]
+    assert frame_bits(frames, stuffing=False).tolist() == [47, 111, 131]
+    # all zero fields: stuff bits on top of the nominal length
+    assert (frame_bits(frames) > frame_bits(frames, stuffing=False)).all()
+
+
+def test_limiter_caps_bus_load():
+    dev = open_sim()
+    limiter = TransmitLimiter(dev, 0, max_load=0.3, bitrate=500000)
+    start = time.perf_counter()
+    assert limiter.transmit_many(np.arange(200) & 0x7ff, payloads(200)) == 200
+    elapsed = time.perf_counter() - start
+    frames = receive(dev, 1, 200)
+    bus_time = frame_bits(frames).sum() / 500e3
+    assert bus_time / elapsed < 0.4